@@ -1177,6 +1177,15 @@ window.batchKickOffGeneration = () => {
                 batch_progressNotes.innerHTML = `${window.i18n.SYNTHESIZING} ${linesBatch.length} ${window.i18n.LINES}`
             }
         }
+        // If the next batch switches voice, let the server start reading that voice's checkpoint while this one runs
+        const nextRecord = window.batch_state.lines[window.batch_state.lineIndex+linesBatch.length]
+        const prefetch = []
+        if (nextRecord && nextRecord[0].voice_id!=voice_id) {
+            prefetch.push({
+                modelType: nextRecord[0].modelType,
+                model: `${window.userSettings[`modelspath_${nextRecord[0].game_id}`]}/${nextRecord[0].voice_id}`
+            })
+        }
         const batchPostData = {
             modelType: records[0][0].modelType,
             batchSize: window.userSettings.batch_batchSize,
@@ -1185,7 +1194,7 @@ window.batchKickOffGeneration = () => {
             outputJSON: window.userSettings.batch_json,
             useSR: batch_useSRCkbx.checked,
             useCleanup: batch_useCleanupCkbx.checked,
-            speaker_i, vocoder, linesBatch
+            speaker_i, vocoder, linesBatch, prefetch
         }
         doFetch(`http://localhost:8008/synthesize_batch`, {
             method: "Post",
@@ -0,0 +1,80 @@
+import math
+import threading
+
+ENDPOINT_CLASSES = {
+    "inference": ["/synthesize", "/synthesizeSimple", "/synthesize_stream", "/synthesize_batch", "/runSpeechToSpeech", "/getWavV3StyleEmb", "/computeEmbsAndDimReduction"],
+    "audio_post": ["/outputAudio", "/batchOutputAudio", "/normalizeAudio", "/move_recorded_file"],
+}
+# Never turned away: the health checks (GET /health and /ready), the app control/state requests the front-end doesn't
+# retry (POST /checkReady being its start-up handshake), and the long-lived progress streams
+UNLIMITED_PATHS = ["/health", "/ready", "/checkReady", "/loadModel", "/setDevice", "/setVocoder", "/stopServer", "/start_microphone_recording", "/batch_job/stream"]
+
+
+class EndpointClass(object):
+    def __init__(self, name, concurrency, queue_depth):
+        super(EndpointClass, self).__init__()
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.queue_depth = max(0, queue_depth)
+        self.running = 0
+        self.waiting = 0
+        self.avg_duration = None # Moving average of how long a request of this class takes, for the Retry-After estimate
+
+
+class AdmissionController(object):
+    """
+    Bounded concurrency for each class of endpoint (inference, audio post-processing, and everything else as metadata).
+    Up to "concurrency" requests of a class run at once, up to "queue" more wait for a slot, and anything past that is
+    turned away straight away, with an estimate of when to retry, instead of piling more threads onto the same cores.
+    """
+
+    def __init__(self, logger, limits):
+        super(AdmissionController, self).__init__()
+
+        self.logger = logger
+        self.lock = threading.Condition()
+        self.classes = {}
+        for name in limits.keys():
+            self.classes[name] = EndpointClass(name, limits[name]["concurrency"], limits[name]["queue"])
+
+    def classify (self, path):
+        if path in UNLIMITED_PATHS:
+            return None
+        for name in ENDPOINT_CLASSES.keys():
+            if path in ENDPOINT_CLASSES[name]:
+                return name if name in self.classes.keys() else None
+        return "metadata" if "metadata" in self.classes.keys() else None
+
+
+    # Returns True once the request can run, or False straight away if the class' queue is full
+    def enter (self, class_name):
+        if class_name is None:
+            return True
+        endpoint_class = self.classes[class_name]
+        with self.lock:
+            if endpoint_class.running>=endpoint_class.concurrency:
+                if endpoint_class.waiting>=endpoint_class.queue_depth:
+                    return False
+                endpoint_class.waiting += 1
+                while endpoint_class.running>=endpoint_class.concurrency:
+                    self.lock.wait()
+                endpoint_class.waiting -= 1
+            endpoint_class.running += 1
+            return True
+
+    def exit (self, class_name, duration):
+        if class_name is None:
+            return
+        endpoint_class = self.classes[class_name]
+        with self.lock:
+            endpoint_class.running -= 1
+            endpoint_class.avg_duration = duration if endpoint_class.avg_duration is None else 0.9*endpoint_class.avg_duration + 0.1*duration
+            self.lock.notify_all()
+
+    # Seconds until the queue should have drained enough to take the request
+    def retry_after (self, class_name):
+        endpoint_class = self.classes[class_name]
+        with self.lock:
+            if endpoint_class.avg_duration is None:
+                return 1
+            return max(1, int(math.ceil(endpoint_class.avg_duration * (endpoint_class.waiting+1) / endpoint_class.concurrency)))
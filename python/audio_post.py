@@ -1,4 +1,5 @@
 import os
+import io
 import shutil
 import ffmpeg
 import traceback
@@ -8,6 +9,7 @@ from lib.ffmpeg_normalize._ffmpeg_normalize import FFmpegNormalize
 import platform
 
 import multiprocessing as mp
+import scipy.io.wavfile
 
 def mp_ffmpeg_output (PROD, logger, processes, input_paths, output_paths, options):
 
@@ -199,6 +201,17 @@ def prepare_input_audio(PROD, logger, path, removeNoise, removeNoiseStrength):
 
     return final_path
 
+# Encode an int16 waveform for sending straight back in an HTTP response body, either as a WAV file, or as raw
+# little-endian 16 bit PCM samples
+def encode_audio_bytes (wav, sr, audio_format="wav"):
+    if audio_format=="pcm":
+        return wav.astype("<i2").tobytes()
+
+    buffer = io.BytesIO()
+    scipy.io.wavfile.write(buffer, sr, wav)
+    return buffer.getvalue()
+
+
 def normalize_audio (input_path, output_path):
     startupinfo = subprocess.STARTUPINFO()
     startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
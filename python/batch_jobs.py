@@ -0,0 +1,355 @@
+import time
+import uuid
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import scipy.io.wavfile
+
+from python.models_manager import inference_lock
+
+
+# Line: [sequence, pitch, duration, pace, tempFileLocation, outPath, outFolder, pitch_amp, base_lang, base_emb, vc_content, vc_style]
+LINE_LANG_INDEX = 8
+
+# Re-group a job's lines so that each voice is loaded once: lines are pooled across the manifest's groups by
+# (voice, speaker, vocoder, language, SR/cleanup flags), and the pools of each voice are run back to back, starting
+# with the voices which are already loaded, then in the order in which the voices first appear. Each planned group
+# keeps the original (manifest order) index of every line, as line_indexes. The output paths are part of the lines, so
+# the files are still written under their original names.
+# A group with no "model" runs on whichever voice is loaded at that point: the one loaded by the last group before it
+# (of the same model type), or else the one loaded before the job started
+def plan_job_groups (groups, manifest, loaded_models=None):
+    loaded_models = loaded_models or []
+    group_keys = {} # group key -> planned group
+    voice_order = []
+    voice_groups = {} # voice -> [planned group]
+    last_model = {} # model type -> the voice loaded by the last group so far
+
+    line_offset = 0
+    for group in groups:
+        modelType = group["modelType"].lower().replace(".", "_").replace(" ", "")
+        if "model" in group:
+            last_model[modelType] = group["model"]
+        elif modelType in last_model.keys():
+            group = dict(group, model=last_model[modelType])
+        voice = (modelType, group["model"] if "model" in group else None)
+        flags = tuple([group[key] if key in group else (manifest[key] if key in manifest else False) for key in ["useSR", "useCleanup"]])
+        for li, line in enumerate(group["linesBatch"]):
+            lang = line[LINE_LANG_INDEX] if len(line)>LINE_LANG_INDEX else None
+            key = (voice, group["speaker_i"] if "speaker_i" in group else None, group["vocoder"] if "vocoder" in group else None, \
+                group["model_speakers"] if "model_speakers" in group else None, group["base_lang"] if "base_lang" in group else None, lang, flags)
+            if key not in group_keys.keys():
+                planned = dict(group, linesBatch=[], line_indexes=[], useSR=flags[0], useCleanup=flags[1])
+                group_keys[key] = planned
+                if voice not in voice_groups.keys():
+                    voice_order.append(voice)
+                    voice_groups[voice] = []
+                voice_groups[voice].append(planned)
+            group_keys[key]["linesBatch"].append(line)
+            group_keys[key]["line_indexes"].append(line_offset+li)
+        line_offset += len(group["linesBatch"])
+
+    first = [voice for voice in voice_order if voice[1] is None or voice in loaded_models]
+    voice_order = first + [voice for voice in voice_order if voice not in first]
+    # Within a voice, the same vocoder's groups together, so that it's only switched to once
+    plan = []
+    for voice in voice_order:
+        vocoders = []
+        for planned in voice_groups[voice]:
+            if planned.get("vocoder") not in vocoders:
+                vocoders.append(planned.get("vocoder"))
+        plan += sorted(voice_groups[voice], key=lambda planned: vocoders.index(planned.get("vocoder")))
+    return plan
+
+
+class BatchJob(object):
+    """
+    A whole batch synthesis manifest, submitted in one go. The lines are grouped by voice ("groups"), each group
+    being the same data as a /synthesize_batch request (modelType, speaker_i, vocoder, linesBatch), plus the voice
+    checkpoint to load for it, if the job should switch voices by itself
+    """
+
+    def __init__(self, manifest):
+        super(BatchJob, self).__init__()
+
+        self.job_id = uuid.uuid4().hex
+        self.manifest = manifest
+        self.groups = manifest["groups"] if "groups" in manifest else [manifest]
+
+        self.status = "queued" # queued, running, done, cancelled, error
+        self.lines_total = sum([len(group["linesBatch"]) for group in self.groups])
+        self.lines_done = 0
+        self.completed = [] # Line indexes (across all groups, in manifest order), in the order they were finished
+        self.errors = [] # [line index, error], or [None, error] for job-wide failures
+        self.lines_finished = set() # Line indexes finished (or failed), for in_order_done
+        self.in_order_done = 0 # The lines are run re-ordered by voice: this many, from the start of the manifest, are all finished
+        self.audio_seconds = 0
+        self.synth_seconds = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock() # For the progress counters, when batches run concurrently on the worker pool
+        self.version = 0 # Bumped on every progress update, for the streaming clients to wait on
+        self.updated = threading.Condition()
+
+    def is_finished (self):
+        return self.status in ["done", "cancelled", "error"]
+
+    def notify (self):
+        with self.updated:
+            self.version += 1
+            self.updated.notify_all()
+
+    def wait_for_update (self, version, timeout=None):
+        with self.updated:
+            if self.version==version and not self.is_finished():
+                self.updated.wait(timeout)
+            return self.version
+
+    # "since" is an offset into the completed lines list, so that the clients can fetch only the newly finished lines
+    def progress (self, since=0):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "lines_total": self.lines_total,
+            "lines_done": self.lines_done,
+            "completed": self.completed[since:],
+            "in_order_done": self.in_order_done,
+            "next_since": len(self.completed),
+            "errors": self.errors,
+            "audio_seconds": self.audio_seconds,
+            "synth_seconds": self.synth_seconds,
+            "rtf": (self.synth_seconds/self.audio_seconds) if self.audio_seconds>0 else None,
+            "elapsed": ((self.finished or time.time())-self.started) if self.started is not None else 0,
+        }
+
+
+class BatchJobManager(object):
+    """
+    Runs submitted batch jobs on a background thread, one at a time, chopping each into model batches of its own
+    sizing. This keeps the model busy across the whole job, without the per-batch HTTP round trips of /synthesize_batch.
+    With a worker pool or voice replicas, the batches of a job are spread over all of them. The lines are re-grouped by
+    voice first (see plan_job_groups), so that interleaved dialogue doesn't reload the voices line by line.
+    """
+
+    def __init__(self, logger, PROD, models_manager, plugin_manager, batch_size=16, max_finished_jobs=50, worker_pool=None, voice_affinity=True):
+        super(BatchJobManager, self).__init__()
+
+        self.logger = logger
+        self.PROD = PROD
+        self.models_manager = models_manager
+        self.plugin_manager = plugin_manager
+        self.batch_size = max(1, batch_size)
+        self.max_finished_jobs = max_finished_jobs
+        self.worker_pool = worker_pool
+        self.voice_affinity = voice_affinity
+
+        self.lock = threading.Condition()
+        self.jobs = {} # job_id -> BatchJob, in submission order
+        self.queue = []
+        self.worker = None
+
+
+    def submit (self, manifest):
+        job = BatchJob(manifest)
+        with self.lock:
+            self._prune_finished()
+            self.jobs[job.job_id] = job
+            self.queue.append(job)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._work, daemon=True)
+                self.worker.start()
+            self.lock.notify_all()
+        self.logger.info(f'[BatchJobManager] Queued job {job.job_id}, with {job.lines_total} lines')
+        return job.job_id
+
+    def get (self, job_id):
+        with self.lock:
+            return self.jobs[job_id] if job_id in self.jobs.keys() else None
+
+    def list_jobs (self):
+        with self.lock:
+            return [job.progress(since=len(job.completed)) for job in self.jobs.values()]
+
+    def cancel (self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return False
+        job.cancel_event.set()
+        with self.lock:
+            if job in self.queue:
+                self.queue.remove(job)
+                job.status = "cancelled"
+                job.finished = time.time()
+        job.notify()
+        return True
+
+
+    def _prune_finished (self):
+        finished = [job_id for job_id in self.jobs.keys() if self.jobs[job_id].is_finished()]
+        for job_id in finished[:max(0, len(finished)-self.max_finished_jobs)]:
+            del self.jobs[job_id]
+
+    def _work (self):
+        while True:
+            with self.lock:
+                while not len(self.queue):
+                    self.lock.wait()
+                job = self.queue.pop(0)
+
+            job.status = "running"
+            job.started = time.time()
+            job.notify()
+            try:
+                self._run_job(job)
+                job.status = "cancelled" if job.cancel_event.is_set() else "done"
+            except:
+                self.logger.info(traceback.format_exc())
+                job.errors.append([None, traceback.format_exc()])
+                job.status = "error"
+            job.finished = time.time()
+            job.notify()
+            self.logger.info(f'[BatchJobManager] Job {job.job_id} {job.status}: {job.lines_done}/{job.lines_total} lines')
+
+
+    def _run_job (self, job):
+        pluginsContext = job.manifest["pluginsContext"] if "pluginsContext" in job.manifest else {}
+        self.plugin_manager.set_context(pluginsContext)
+
+        groups = self._plan(job)
+        for group_i, group in enumerate(groups):
+            if job.cancel_event.is_set():
+                return
+            model = self._get_model(group)
+            # Read the next group's voice in the background, while this one's lines are synthesized
+            if group_i+1<len(groups) and "model" in groups[group_i+1] and groups[group_i+1]["model"]!=group.get("model"):
+                next_group = groups[group_i+1]
+                self.models_manager.prefetch(next_group["modelType"], next_group["model"]+".pt", page_cache_only=self.worker_pool is not None)
+
+            linesBatch = group["linesBatch"]
+            batches = []
+            for start in range(0, len(linesBatch), self.batch_size):
+                batches.append([linesBatch[start:start+self.batch_size], group["line_indexes"][start:start+self.batch_size]])
+
+            parallel_slots = getattr(model, "parallel_slots", 1)
+            if parallel_slots<=1:
+                for lines, line_indexes in batches:
+                    if job.cancel_event.is_set():
+                        return
+                    self._run_lines(job, model, group, lines, line_indexes)
+            else:
+                with ThreadPoolExecutor(max_workers=parallel_slots) as pool:
+                    futures = [pool.submit(self._run_lines, job, model, group, lines, line_indexes) for lines, line_indexes in batches]
+                    for future in futures:
+                        future.result()
+
+
+    # The groups to run, with the original index of each line. Re-ordered by voice, unless turned off (server-wide, or
+    # with "reorder": false in the manifest)
+    def _plan (self, job):
+        if not self.voice_affinity or ("reorder" in job.manifest and not job.manifest["reorder"]):
+            groups = []
+            line_offset = 0
+            for group in job.groups:
+                groups.append(dict(group, line_indexes=list(range(line_offset, line_offset+len(group["linesBatch"])))))
+                line_offset += len(group["linesBatch"])
+            return groups
+
+        loaded_models = []
+        if self.worker_pool is None:
+            models_bank = self.models_manager.models_bank
+            for modelType in models_bank.keys():
+                ckpt_path = getattr(models_bank[modelType][0], "ckpt_path", None) if 0 in models_bank[modelType].keys() else None
+                if ckpt_path:
+                    loaded_models.append((modelType, ckpt_path[:-3] if ckpt_path.endswith(".pt") else ckpt_path))
+        groups = plan_job_groups(job.groups, job.manifest, loaded_models=loaded_models)
+
+        voices = len(set([(group["modelType"], group["model"] if "model" in group else None) for group in groups]))
+        self.logger.info(f'[BatchJobManager] Job {job.job_id}: planned {job.lines_total} lines from {len(job.groups)} groups into {len(groups)} groups over {voices} voices')
+        return groups
+
+    def _get_model (self, group):
+        modelType = group["modelType"].lower().replace(".", "_").replace(" ", "")
+        n_speakers = group["model_speakers"] if "model_speakers" in group else None
+        base_lang = group["base_lang"] if "base_lang" in group else None
+
+        if self.worker_pool is not None and "model" in group:
+            from python.worker_pool import WorkerVoice, make_voice_spec
+            return WorkerVoice(self.worker_pool, make_voice_spec(modelType, group["model"]+".pt", n_speakers=n_speakers, base_lang=base_lang))
+
+        if "model" in group:
+            self.models_manager.load_model(modelType, group["model"]+".pt", n_speakers=n_speakers, base_lang=base_lang)
+            if modelType=="fastpitch1_1" or modelType=="xvapitch":
+                self.models_manager.models_bank[modelType][0].init_arpabet_dicts()
+        return self.models_manager.inference_model(modelType)
+
+
+    def _run_lines (self, job, model, group, lines, line_indexes):
+        if job.cancel_event.is_set():
+            return
+        start_time = time.time()
+        error = self._infer_batch(job, model, group, lines)
+
+        if error and len(lines)>1:
+            # Find the line(s) at fault (or get a smaller batch through, on OOM), instead of failing all of them
+            for line, line_index in zip(lines, line_indexes):
+                if job.cancel_event.is_set():
+                    return
+                self._run_lines(job, model, group, [line], [line_index])
+            return
+
+        audio_seconds = 0 if error else sum([self._audio_duration(line[4]) for line in lines])
+        with job.lock:
+            job.synth_seconds += time.time()-start_time
+            if error:
+                job.errors.append([line_indexes[0], error])
+            else:
+                job.audio_seconds += audio_seconds
+                job.completed += line_indexes
+            job.lines_done += len(lines)
+            job.lines_finished.update(line_indexes)
+            while job.in_order_done in job.lines_finished:
+                job.in_order_done += 1
+        job.notify()
+
+
+    # Same as the /synthesize_batch request, including its plugin hooks. Returns an error string, or ""
+    def _infer_batch (self, job, model, group, lines):
+        data = {
+            "modelType": group["modelType"],
+            "linesBatch": lines,
+            "speaker_i": group["speaker_i"] if "speaker_i" in group else None,
+            "vocoder": group["vocoder"] if "vocoder" in group else None,
+            "outputJSON": job.manifest["outputJSON"] if "outputJSON" in job.manifest else False,
+            "useSR": group["useSR"] if "useSR" in group else (job.manifest["useSR"] if "useSR" in job.manifest else False),
+            "useCleanup": group["useCleanup"] if "useCleanup" in group else (job.manifest["useCleanup"] if "useCleanup" in job.manifest else False),
+            "pluginsContext": job.manifest["pluginsContext"] if "pluginsContext" in job.manifest else {},
+            "job_id": job.job_id,
+        }
+        self.plugin_manager.run_plugins(plist=self.plugin_manager.plugins["batch-synth-line"]["pre"], event="pre batch-synth-line", data=data)
+
+        with torch.no_grad(), inference_lock(model):
+            try:
+                req_response = model.infer_batch(self.plugin_manager, lines, outputJSON=data["outputJSON"], vocoder=data["vocoder"], speaker_i=data["speaker_i"], useSR=data["useSR"], useCleanup=data["useCleanup"])
+            except:
+                req_response = traceback.format_exc()
+                if "CUDA out of memory" in req_response:
+                    req_response = "CUDA OOM"
+                else:
+                    self.logger.info(req_response)
+
+        data["req_response"] = req_response
+        self.plugin_manager.run_plugins(plist=self.plugin_manager.plugins["batch-synth-line"]["post"], event="post batch-synth-line", data=data)
+        return req_response if req_response else ""
+
+
+    def _audio_duration (self, wav_path):
+        try:
+            sr, wav = scipy.io.wavfile.read(wav_path, mmap=True)
+            return len(wav)/sr
+        except:
+            return 0
@@ -0,0 +1,113 @@
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+# Bytes held by the tensors in a loaded checkpoint (nested dicts/lists of tensors, and other values)
+def checkpoint_bytes (obj):
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum([checkpoint_bytes(value) for value in obj.values()])
+    if isinstance(obj, (list, tuple)):
+        return sum([checkpoint_bytes(value) for value in obj])
+    return 0
+
+
+class CheckpointCache(object):
+    """
+    Recently loaded voice checkpoints, kept in RAM (on the CPU) so that switching back to a voice is an in-memory
+    load_state_dict instead of a torch.load from disk. Entries are keyed by the file's path, mtime and size, so an
+    overwritten checkpoint is read again. The least recently used ones are dropped past max_mb.
+
+    The model classes copy the weights out of the state dict in load_state_dict, and only ever re-bind (never
+    modify) the dict they're given, so one cached checkpoint can be loaded into any number of instances.
+    """
+
+    def __init__(self, max_mb=1024, metrics=None, weight_store=None):
+        super(CheckpointCache, self).__init__()
+
+        self.max_bytes = int(max_mb*1024*1024)
+        self.metrics = metrics
+        self.weight_store = weight_store
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # (path, mtime, size) -> [checkpoint, bytes], least recently used first
+        self.total_bytes = 0
+        self.loading = {} # (path, mtime, size) -> Event, for the reads in progress (eg prefetches)
+
+    def load (self, ckpt_path):
+        stat = os.stat(ckpt_path)
+        key = (os.path.realpath(ckpt_path), stat.st_mtime, stat.st_size)
+
+        while True:
+            with self.lock:
+                if key in self.entries.keys():
+                    self.entries.move_to_end(key)
+                    if self.metrics is not None:
+                        self.metrics.inc("xva_checkpoint_cache_total", result="hit")
+                    return self.entries[key][0]
+                # Another thread is already reading this file; wait for it rather than reading it twice
+                loading = self.loading[key] if key in self.loading.keys() else None
+                if loading is None:
+                    self.loading[key] = threading.Event()
+                    break
+            # (if it turned out too big to cache, it's then read again)
+            loading.wait()
+
+        try:
+            ckpt = self._read(ckpt_path, key)
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+        return ckpt
+
+    def _read (self, ckpt_path, key):
+        if self.metrics is not None:
+            self.metrics.inc("xva_checkpoint_cache_total", result="miss")
+        ckpt = torch.load(ckpt_path, map_location="cpu")
+        if self.weight_store is not None:
+            ckpt = self.weight_store.intern(ckpt)
+        ckpt_bytes = checkpoint_bytes(ckpt)
+        if ckpt_bytes>self.max_bytes:
+            return ckpt
+
+        with self.lock:
+            # Older versions of the same file won't be asked for again
+            for old_key in [old_key for old_key in self.entries.keys() if old_key[0]==key[0]]:
+                del self.entries[old_key]
+            if key not in self.entries.keys():
+                self.entries[key] = [ckpt, ckpt_bytes]
+                self.total_bytes = self._unique_bytes()
+            while self.total_bytes>self.max_bytes and len(self.entries):
+                self.entries.popitem(last=False)
+                self.total_bytes = self._unique_bytes()
+        return ckpt
+
+    # With interned weights, the cached checkpoints share tensors, which should only be counted once
+    def _unique_bytes (self):
+        if self.weight_store is None:
+            return sum([entry[1] for entry in self.entries.values()])
+        seen = set()
+        total = 0
+        def count (obj):
+            nonlocal total
+            if torch.is_tensor(obj):
+                if obj.data_ptr() not in seen:
+                    seen.add(obj.data_ptr())
+                    total += obj.numel() * obj.element_size()
+            elif isinstance(obj, dict):
+                for value in obj.values():
+                    count(value)
+        for ckpt, _ in self.entries.values():
+            count(ckpt)
+        return total
+
+    def report (self):
+        with self.lock:
+            return {
+                "max_mb": round(self.max_bytes/1024/1024, 1),
+                "cached_mb": round(self.total_bytes/1024/1024, 1),
+                "checkpoints": [key[0] for key in reversed(self.entries.keys())],
+            }
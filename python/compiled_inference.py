@@ -0,0 +1,121 @@
+import os
+import hashlib
+import traceback
+
+import torch
+
+# Bumped whenever the wrapped parts' inputs or outputs change, to invalidate the cached artifacts
+COMPILED_FORMAT = 1
+
+
+class CompiledInference(object):
+    """
+    TorchScript versions of a model's inference-only parts, traced on their first call and cached on disk. The
+    artifacts are keyed by the part's architecture (its parameters' names, shapes and dtypes, the device type, and the
+    torch version), not by the voice, so every voice of the same architecture re-uses them: the traced module's
+    parameters are re-bound to the live model's own tensors before each call, so no weights are copied, and voice
+    switches (which load into the live tensors in place) carry over.
+
+    torch.jit.trace is used rather than torch.jit.script, as scripting needs the Python source, which the PyInstaller
+    build doesn't ship (and server.py stubs torch.jit.script out for that reason). A trace records only one path through
+    the Python control flow, so each newly traced part is checked against the eager model on a shorter input; a part
+    that gives different results is left to run eagerly (and remembered, so it's not traced again).
+    """
+
+    def __init__(self, logger, cache_dir, device):
+        super(CompiledInference, self).__init__()
+
+        self.logger = logger
+        self.cache_dir = cache_dir
+        self.device = torch.device(device)
+        self.parts = {} # name -> [eager wrapper, traced module, or None to run eagerly]
+
+    # Run a part: make_wrapper returns an nn.Module wrapping the eager part, with a forward taking just tensors
+    def run (self, name, make_wrapper, *inputs):
+        if name not in self.parts.keys():
+            wrapper = make_wrapper()
+            self.parts[name] = [wrapper, self._compile(name, wrapper, inputs)]
+        wrapper, traced = self.parts[name]
+        if traced is None:
+            return wrapper(*inputs)
+        self._bind(wrapper, traced)
+        return traced(*inputs)
+
+
+    def _architecture_key (self, name, wrapper):
+        signature = [str(COMPILED_FORMAT), torch.__version__, self.device.type, name]
+        for key, tensor in list(wrapper.named_parameters()) + list(wrapper.named_buffers()):
+            signature.append(f'{key}:{tuple(tensor.shape)}:{tensor.dtype}')
+        return hashlib.sha1("\n".join(signature).encode("utf-8")).hexdigest()[:16]
+
+    def _compile (self, name, wrapper, inputs):
+        key = self._architecture_key(name, wrapper)
+        artifact_path = f'{self.cache_dir}/{name}_{key}.ts'
+        eager_marker = f'{self.cache_dir}/{name}_{key}.eager'
+        if os.path.exists(eager_marker):
+            return None
+
+        try:
+            if os.path.exists(artifact_path):
+                traced = torch.jit.load(artifact_path, map_location=self.device)
+                traced.eval()
+                return traced
+        except:
+            self.logger.info(f'[CompiledInference] Could not load {artifact_path}; tracing {name} again')
+            self.logger.info(traceback.format_exc())
+
+        try:
+            with torch.no_grad():
+                traced = torch.jit.trace(wrapper, tuple(inputs), check_trace=False)
+                traced.eval()
+                if not self._matches(wrapper, traced, self._shorter(inputs)):
+                    self.logger.info(f'[CompiledInference] The traced {name} doesn\'t generalize to other input lengths; running it eagerly')
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    open(eager_marker, "w").close()
+                    return None
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f'{artifact_path}.{os.getpid()}.tmp'
+            traced.save(tmp_path)
+            os.replace(tmp_path, artifact_path)
+            self.logger.info(f'[CompiledInference] Compiled {name}: {artifact_path}')
+            return traced
+        except:
+            self.logger.info(f'[CompiledInference] Failed to compile {name}; running it eagerly')
+            self.logger.info(traceback.format_exc())
+            return None
+
+    # The same inputs, cut down to about half of the first input's length (on the last axis), with any lengths clamped
+    def _shorter (self, inputs):
+        length = inputs[0].shape[-1]
+        new_length = max(1, length//2)
+        shorter = []
+        for tensor in inputs:
+            if tensor.dim()>=2 and tensor.shape[-1]==length:
+                tensor = tensor[..., :new_length].contiguous()
+            elif tensor.dim()==1 and not tensor.is_floating_point():
+                tensor = tensor.clamp(max=new_length)
+            shorter.append(tensor)
+        return shorter
+
+    def _matches (self, wrapper, traced, inputs):
+        self._bind(wrapper, traced)
+        # Same seed for both, for the parts which sample noise
+        torch.manual_seed(0)
+        expected = wrapper(*inputs)
+        torch.manual_seed(0)
+        actual = traced(*inputs)
+        expected = expected if isinstance(expected, (list, tuple)) else [expected]
+        actual = actual if isinstance(actual, (list, tuple)) else [actual]
+        if len(expected)!=len(actual):
+            return False
+        for expected_tensor, actual_tensor in zip(expected, actual):
+            if expected_tensor.shape!=actual_tensor.shape or not torch.allclose(expected_tensor, actual_tensor, rtol=1e-3, atol=1e-4):
+                return False
+        return True
+
+    # Point the traced module's parameters and buffers at the live model's tensors
+    def _bind (self, wrapper, traced):
+        live = dict(list(wrapper.named_parameters()) + list(wrapper.named_buffers()))
+        for key, tensor in list(traced.named_parameters()) + list(traced.named_buffers()):
+            if key in live.keys() and tensor.data_ptr()!=live[key].data_ptr():
+                tensor.data = live[key].data
@@ -1,3 +1,4 @@
+import torch
 from df.enhance import enhance, init_df, load_audio, save_audio
 
 class DeepFilter2Model(object):
@@ -26,6 +27,12 @@ class DeepFilter2Model(object):
         enhanced = enhance(self.model, self.models_manager.device, self.df_state, audio)
         save_audio(out_path, enhanced, self.df_state.sr())
 
+    # Clean up a mono float waveform already sampled at self.df_state.sr(), returning the float waveform
+    def cleanup_wav (self, wav):
+        audio = torch.from_numpy(wav).float().unsqueeze(0)
+        enhanced = enhance(self.model, self.models_manager.device, self.df_state, audio)
+        return enhanced.squeeze(0).cpu().detach().numpy()
+
     def set_device (self, device):
         self.device = device
         self.model = self.model.to(self.device)
@@ -291,7 +291,7 @@ class FastPitch1_1(object):
 
         return ""
 
-    def infer(self, plugin_manager, text, output, vocoder, speaker_i, pace=1.0, editor_data=None, old_sequence=None, globalAmplitudeModifier=None, base_lang=None, base_emb=None, useSR=False, useCleanup=False):
+    def infer(self, plugin_manager, text, out_path, vocoder, speaker_i, pace=1.0, editor_data=None, old_sequence=None, globalAmplitudeModifier=None, base_lang=None, base_emb=None, useSR=False, useCleanup=False):
 
         sigma_infer = 0.9
         stft_hop_length = 256
@@ -326,7 +326,7 @@ class FastPitch1_1(object):
                 for i, audio in enumerate(audios):
                     audio = audio[:mel_lens[i].item() * stft_hop_length]
                     audio = audio/torch.max(torch.abs(audio))
-                    write(output, sampling_rate, audio.cpu().numpy())
+                    write(out_path, sampling_rate, audio.cpu().numpy())
                 del audios
             else:
                 self.models_manager.load_model("hifigan", f'{"./resources/app" if self.PROD else "."}/python/hifigan/hifi.pt' if vocoder=="qnd" else self.ckpt_path.replace(".pt", ".hg.pt"))
@@ -341,26 +341,26 @@ class FastPitch1_1(object):
                     ffmpeg_path = f'{"./resources/app" if self.PROD else "."}/python/ffmpeg.exe'
 
                     if useSR:
-                        write(output.replace(".wav", "_preSR.wav"), sampling_rate, audio)
+                        write(out_path.replace(".wav", "_preSR.wav"), sampling_rate, audio)
                     else:
-                        write(output.replace(".wav", "_preCleanupPreFFmpeg.wav"), sampling_rate, audio)
-                        stream = ffmpeg.input(output.replace(".wav", "_preCleanupPreFFmpeg.wav"))
+                        write(out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"), sampling_rate, audio)
+                        stream = ffmpeg.input(out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"))
                         ffmpeg_options = {"ar": 48000}
-                        output_path = output.replace(".wav", "_preCleanup.wav")
+                        output_path = out_path.replace(".wav", "_preCleanup.wav")
                         stream = ffmpeg.output(stream, output_path, **ffmpeg_options)
                         out, err = (ffmpeg.run(stream, cmd=ffmpeg_path, capture_stdout=True, capture_stderr=True, overwrite_output=True))
-                        os.remove(output.replace(".wav", "_preCleanupPreFFmpeg.wav"))
+                        os.remove(out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"))
 
                 else:
-                    write(output.replace(".wav", "_preSR.wav") if useSR else output, sampling_rate, audio)
+                    write(out_path.replace(".wav", "_preSR.wav") if useSR else out_path, sampling_rate, audio)
 
                 if useSR:
                     self.models_manager.init_model("nuwave2")
-                    self.models_manager.models("nuwave2").sr_audio(output.replace(".wav", "_preSR.wav"), output.replace(".wav", "_preCleanup.wav") if useCleanup else output)
+                    self.models_manager.models("nuwave2").sr_audio(out_path.replace(".wav", "_preSR.wav"), out_path.replace(".wav", "_preCleanup.wav") if useCleanup else out_path)
 
                 if useCleanup:
                     self.models_manager.init_model("deepfilternet2")
-                    self.models_manager.models("deepfilternet2").cleanup_audio(output.replace(".wav", "_preCleanup.wav"), output)
+                    self.models_manager.models("deepfilternet2").cleanup_audio(out_path.replace(".wav", "_preCleanup.wav"), out_path)
 
                 del audio
 
@@ -0,0 +1,135 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Latency histogram buckets, in seconds
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+METRICS_HELP = {
+    "xva_requests_total": ["counter", "Number of HTTP requests handled, per path"],
+    "xva_request_errors_total": ["counter", "Number of HTTP requests which raised an exception or returned an error, per path"],
+    "xva_request_duration_seconds": ["histogram", "Time taken to handle HTTP requests, per path"],
+    "xva_requests_rejected_total": ["counter", "Number of HTTP requests turned away by admission control, per endpoint class"],
+    "xva_stage_duration_seconds": ["histogram", "Time taken by the inner stages of synthesis, per stage"],
+    "xva_checkpoint_cache_total": ["counter", "Voice checkpoint loads served from the in-memory cache (hit) or read from disk (miss)"],
+}
+
+# The server's routes, used as they are for the per-path labels. Any other path is counted as "other", so that
+# requests for arbitrary paths (or with query strings) can't create an unbounded number of time series
+KNOWN_ROUTES = [
+    "/batchOutputAudio", "/batch_job/cancel", "/batch_job/list", "/batch_job/status", "/batch_job/stream", "/batch_job/submit",
+    "/checkReady", "/computeEmbsAndDimReduction", "/customEvent", "/getAvailableVoices", "/getG2P", "/getWavV3StyleEmb",
+    "/health", "/loadModel", "/metrics", "/models/resident", "/move_recorded_file", "/normalizeAudio", "/outputAudio",
+    "/prefetchModels", "/ready", "/refreshPlugins", "/runSpeechToSpeech", "/setAvailableVoices", "/setDevice", "/setVocoder",
+    "/start_microphone_recording", "/stopServer", "/synthesize", "/synthesizeSimple", "/synthesize_batch", "/synthesize_stream",
+    "/updateARPABet",
+]
+
+def route_label (path):
+    return path if path in KNOWN_ROUTES else "other"
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        super(Histogram, self).__init__()
+        self.buckets = buckets
+        self.bucket_counts = [0 for _ in buckets]
+        self.count = 0
+        self.sum = 0.0
+
+    def observe (self, value):
+        self.count += 1
+        self.sum += value
+        for bi, bucket in enumerate(self.buckets):
+            if value<=bucket:
+                self.bucket_counts[bi] += 1
+                break
+
+
+class Metrics(object):
+    """
+    Request counters and latency histograms, exposed in the Prometheus text format by GET /metrics
+    """
+
+    def __init__(self, buckets=None):
+        super(Metrics, self).__init__()
+
+        self.buckets = buckets if buckets is not None else DEFAULT_BUCKETS
+        self.lock = threading.Lock()
+        self.counters = {} # name -> {labels tuple: value}
+        self.histograms = {} # name -> {labels tuple: Histogram}
+
+    def inc (self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if name not in self.counters.keys():
+                self.counters[name] = {}
+            self.counters[name][key] = self.counters[name][key]+value if key in self.counters[name].keys() else value
+
+    def observe (self, name, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if name not in self.histograms.keys():
+                self.histograms[name] = {}
+            if key not in self.histograms[name].keys():
+                self.histograms[name][key] = Histogram(self.buckets)
+            self.histograms[name][key].observe(seconds)
+
+    @contextmanager
+    def timer (self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter()-start, **labels)
+
+    # Time one of the inner stages of synthesis (text pre-processing, flow, waveform decoder, etc)
+    def stage (self, stage):
+        return self.timer("xva_stage_duration_seconds", stage=stage)
+
+
+    def render (self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters.keys()):
+                self._render_header(lines, name, "counter")
+                for key in sorted(self.counters[name].keys()):
+                    lines.append(f'{name}{self._format_labels(key)} {self.counters[name][key]}')
+
+            for name in sorted(self.histograms.keys()):
+                self._render_header(lines, name, "histogram")
+                for key in sorted(self.histograms[name].keys()):
+                    histogram = self.histograms[name][key]
+                    cumulative = 0
+                    for bucket, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                        cumulative += bucket_count
+                        lines.append(f'{name}_bucket{self._format_labels(key, le=str(bucket))} {cumulative}')
+                    lines.append(f'{name}_bucket{self._format_labels(key, le="+Inf")} {histogram.count}')
+                    lines.append(f'{name}_sum{self._format_labels(key)} {histogram.sum}')
+                    lines.append(f'{name}_count{self._format_labels(key)} {histogram.count}')
+        return "\n".join(lines)+"\n"
+
+    def _render_header (self, lines, name, metric_type):
+        if name in METRICS_HELP.keys():
+            metric_type, help_text = METRICS_HELP[name]
+            lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+    def _format_labels (self, key, le=None):
+        labels = list(key) + ([("le", le)] if le is not None else [])
+        if len(labels)==0:
+            return ""
+        labels = [f'{label}="{self._escape(value)}"' for label, value in labels]
+        return "{" + ",".join(labels) + "}"
+
+    def _escape (self, value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+@contextmanager
+def _no_timer ():
+    yield
+
+# For code which may be run without a Metrics instance attached (eg the model classes, outside of the server)
+def stage_timer (metrics, stage):
+    return metrics.stage(stage) if metrics is not None else _no_timer()
@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import hashlib
+import struct
+import argparse
+import traceback
+
+import numpy as np
+import torch
+
+# File layout: MAGIC, the header length (little-endian uint64), the JSON header, then the raw tensor data, each tensor
+# starting at a multiple of ALIGNMENT. The header lists every tensor's path in the checkpoint (nested dict keys),
+# dtype, shape, and offset in the file, plus any plain (JSON-able) values, eg the iteration count
+MAGIC = b"XVAMMAP1"
+ALIGNMENT = 64
+MMAP_EXTENSION = ".xvamm"
+
+DTYPES = {
+    torch.float32: "float32", torch.float16: "float16", torch.float64: "float64",
+    torch.int64: "int64", torch.int32: "int32", torch.int16: "int16", torch.int8: "int8",
+    torch.uint8: "uint8", torch.bool: "bool",
+}
+
+
+# voice.pt -> voice.xvamm, voice.hg.pt -> voice.hg.xvamm
+def mmap_checkpoint_path (ckpt_path):
+    return (ckpt_path[:-3] if ckpt_path.endswith(".pt") else ckpt_path) + MMAP_EXTENSION
+
+# The converted file is used if it's there, and no older than the .pt (if that's still around)
+def has_mmap_checkpoint (ckpt_path):
+    mmap_path = mmap_checkpoint_path(ckpt_path)
+    if not os.path.exists(mmap_path):
+        return False
+    return not os.path.exists(ckpt_path) or os.path.getmtime(mmap_path)>=os.path.getmtime(ckpt_path)
+
+
+# With skip_unsupported, values which aren't tensors and can't go in the JSON header (eg training hyper-parameter
+# objects) are left out, rather than failing the conversion. Pickled modules can never be represented
+def _flatten (obj, path, tensors, values, skip_unsupported=False):
+    if torch.is_tensor(obj):
+        tensors.append([path, obj])
+    elif isinstance(obj, torch.nn.Module):
+        raise ValueError(f'Checkpoint contains a pickled module at {"/".join(path)}')
+    elif isinstance(obj, dict):
+        for key in obj.keys():
+            if not isinstance(key, str):
+                if skip_unsupported:
+                    continue
+                raise ValueError(f'Unsupported checkpoint key at {path}: {repr(key)}')
+            _flatten(obj[key], path+[key], tensors, values, skip_unsupported)
+    else:
+        try:
+            json.dumps(obj)
+        except (TypeError, ValueError):
+            if skip_unsupported:
+                return
+            raise ValueError(f'Unsupported value in checkpoint at {"/".join(path)}: {type(obj).__name__}')
+        values.append([path, obj])
+
+
+def save_mmap_checkpoint (ckpt, out_path, skip_unsupported=False):
+    tensors, values = [], []
+    _flatten(ckpt, [], tensors, values, skip_unsupported)
+
+    header = {"tensors": [], "values": [{"path": path, "value": value} for path, value in values]}
+    offset = 0
+    for path, tensor in tensors:
+        if tensor.dtype not in DTYPES.keys():
+            raise ValueError(f'Unsupported tensor dtype at {"/".join(path)}: {tensor.dtype}')
+        nbytes = tensor.numel() * tensor.element_size()
+        header["tensors"].append({"path": path, "dtype": DTYPES[tensor.dtype], "shape": list(tensor.shape), "offset": offset, "nbytes": nbytes})
+        offset += nbytes + (-nbytes % ALIGNMENT)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = len(MAGIC) + 8 + len(header_bytes)
+    data_start += -data_start % ALIGNMENT
+
+    # Written to a temporary file and then moved into place, so that other processes never map a partial file
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for (path, tensor), entry in zip(tensors, header["tensors"]):
+            f.seek(data_start+entry["offset"])
+            f.write(tensor.detach().cpu().contiguous().numpy().tobytes())
+        f.truncate(data_start+offset)
+    os.replace(tmp_path, out_path)
+
+
+# Map the file, and build the checkpoint dict with tensors viewing straight into the mapping. The mapping is
+# copy-on-write: the pages are shared (through the page cache) by every process and instance mapping the same file,
+# until something writes to them
+def load_mmap_checkpoint (mmap_path):
+    with open(mmap_path, "rb") as f:
+        if f.read(len(MAGIC))!=MAGIC:
+            raise ValueError(f'Not a memory-mapped checkpoint: {mmap_path}')
+        header_length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = len(MAGIC) + 8 + header_length
+    data_start += -data_start % ALIGNMENT
+
+    ckpt = {}
+    def set_path (path, value):
+        node = ckpt
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = value
+
+    for entry in header["values"]:
+        set_path(entry["path"], entry["value"])
+    if len(header["tensors"]):
+        data = np.memmap(mmap_path, dtype=np.uint8, mode="c")
+        for entry in header["tensors"]:
+            start = data_start + entry["offset"]
+            array = data[start:start+entry["nbytes"]].view(np.dtype(entry["dtype"])).reshape(entry["shape"])
+            set_path(entry["path"], torch.from_numpy(array))
+    return ckpt
+
+
+# For checkpoints with no converted file next to them: a converted copy in a shared folder, made by whichever process
+# asks for it first (normally the server, before routing the voice to its workers). Returns the mapped file's path
+def ensure_shared_mmap_checkpoint (ckpt_path, shared_dir):
+    real_path = os.path.realpath(ckpt_path)
+    fname = os.path.basename(real_path)
+    fname = fname[:-3] if fname.endswith(".pt") else fname
+    mmap_path = f'{shared_dir}/{hashlib.sha1(real_path.encode("utf-8")).hexdigest()[:16]}_{fname}{MMAP_EXTENSION}'
+    if os.path.exists(mmap_path) and os.path.getmtime(mmap_path)>=os.path.getmtime(real_path):
+        return mmap_path
+
+    os.makedirs(shared_dir, exist_ok=True)
+    save_mmap_checkpoint(torch.load(real_path, map_location="cpu"), mmap_path, skip_unsupported=True)
+    return mmap_path
+
+
+def convert (ckpt_path, force=False):
+    out_path = mmap_checkpoint_path(ckpt_path)
+    if not force and has_mmap_checkpoint(ckpt_path):
+        print(f'Up to date: {out_path}')
+        return True
+    try:
+        ckpt = torch.load(ckpt_path, map_location="cpu")
+        save_mmap_checkpoint(ckpt, out_path)
+        print(f'Converted: {ckpt_path} -> {out_path}')
+        return True
+    except:
+        print(f'Failed: {ckpt_path}\n{traceback.format_exc()}')
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert .pt voice (and .hg.pt HiFi-GAN) checkpoints into memory-mappable .xvamm files, next to the originals")
+    parser.add_argument("paths", nargs="+", help="Checkpoint files, or folders to search for .pt files")
+    parser.add_argument("--force", action="store_true", help="Re-convert files which already have an up to date .xvamm")
+    args = parser.parse_args()
+
+    ckpt_paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                ckpt_paths += [os.path.join(root, fname) for fname in sorted(files) if fname.endswith(".pt")]
+        else:
+            ckpt_paths.append(path)
+
+    failed = [ckpt_path for ckpt_path in ckpt_paths if not convert(ckpt_path, force=args.force)]
+    print(f'{len(ckpt_paths)-len(failed)}/{len(ckpt_paths)} checkpoints converted')
+    sys.exit(1 if len(failed) else 0)
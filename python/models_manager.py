@@ -1,15 +1,135 @@
 import os
+import time
+import threading
+from contextlib import contextmanager
 
 import torch
 import traceback
 
+from python.checkpoint_cache import CheckpointCache
+from python.mmap_checkpoint import has_mmap_checkpoint, mmap_checkpoint_path, load_mmap_checkpoint, ensure_shared_mmap_checkpoint
+from python.weight_store import WeightStore, share_checkpoint_weights, unshare_weights
+from python.quantization import has_quantized_checkpoint
+
+VOICE_MODELS = ["fastpitch", "fastpitch1_1", "xvapitch"]
+# Voice models which can have extra replicas loaded, to serve requests for the same voice in parallel
+REPLICABLE_MODELS = VOICE_MODELS
+# Voice models with an int8 quantized CPU mode, which cache their quantized weights next to the checkpoint
+QUANTIZABLE_MODELS = ["xvapitch"]
+# Voice models which can run on ONNX Runtime, once exported (python/xvapitch/onnx_export.py)
+ONNX_MODELS = ["xvapitch"]
+
+
+@contextmanager
+def _no_lock ():
+    yield
+
+# Hold a model instance's lock for the duration of an inference call, so that a checkpoint can't be loaded into it mid-way.
+# The worker pool and replica set stand-ins don't have one, as they lock the real instances themselves
+def inference_lock (model):
+    infer_lock = getattr(model, "infer_lock", None)
+    return infer_lock if infer_lock is not None else _no_lock()
+
+# Hold one instance of a model (one of its replicas, if it has any) for as long as a streamed inference is being read,
+# as the streams run the model lazily, while the response is being sent
+@contextmanager
+def held_instance (model):
+    if isinstance(model, ModelReplicas):
+        with model._replica() as replica:
+            yield replica
+    else:
+        with inference_lock(model):
+            yield model
+
+
+class ModelReplicas(object):
+    """
+    Stands in for a loaded voice model object, spreading its inference calls over several replicas of it, each loaded
+    with the same checkpoint, so that requests for the one voice can run in parallel on different cores
+    """
+
+    def __init__(self, replicas):
+        super(ModelReplicas, self).__init__()
+        self.replicas = replicas
+        self.parallel_slots = len(replicas)
+        self.infer_lock = None
+        self.lock = threading.Condition()
+        self.busy = set()
+
+    # Anything else (editor helpers, G2P, etc) goes to the primary instance
+    def __getattr__ (self, name):
+        return getattr(self.__dict__["replicas"][0], name)
+
+    @contextmanager
+    def _replica (self):
+        with self.lock:
+            while len(self.busy)>=len(self.replicas):
+                self.lock.wait()
+            ri = [ri for ri in range(len(self.replicas)) if ri not in self.busy][0]
+            self.busy.add(ri)
+        try:
+            with self.replicas[ri].infer_lock:
+                yield self.replicas[ri]
+        finally:
+            with self.lock:
+                self.busy.remove(ri)
+                self.lock.notify_all()
+
+    def infer (self, plugin_manager, *args, **kwargs):
+        with self._replica() as model:
+            return model.infer(plugin_manager, *args, **kwargs)
+
+    def infer_coalesced (self, plugin_manager, requests):
+        with self._replica() as model:
+            return model.infer_coalesced(plugin_manager, requests)
+
+    def infer_batch (self, plugin_manager, linesBatch, *args, **kwargs):
+        with self._replica() as model:
+            return model.infer_batch(plugin_manager, linesBatch, *args, **kwargs)
+
+
 class ModelsManager(object):
+    """
+    Owns the model instances. The bank (model_key -> instance_index -> model) is read-mostly: it's replaced
+    copy-on-write under registry_lock when an instance is added, so readers never need to lock it. Each instance has
+    its own re-entrant infer_lock, held both while loading a checkpoint into it and while running inference on it.
+    With a ResidencyManager attached, instances can be unloaded to stay within a memory budget; the checkpoint they
+    had is remembered, and loaded back on their next models() lookup
+    """
 
-    def __init__(self, logger, PROD, device="cpu"):
+    def __init__(self, logger, PROD, device="cpu", metrics=None, num_replicas=1, checkpoint_cache_mb=0, weight_dedup=False, shared_weights_dir=None, cpu_int8=False, compiled_cache_dir=None, onnx_backend=False, decode_chunk_frames=0):
         super(ModelsManager, self).__init__()
 
         self.models_bank = {}
+        self.replicas_bank = {} # (model_key, instance_index) -> [extra instances, loaded with the same checkpoint]
+        self.registry_lock = threading.RLock()
+        self.loaded_ckpts = {} # (model_key, instance_index) -> [ckpt_path, load kwargs] of the last load_model
+        # Voice weights which are identical across checkpoints (fine-tuned from the same base model) are kept once
+        self.weight_store = WeightStore() if weight_dedup else None
+        # Recently used voice checkpoints, kept in RAM for quick voice switches
+        self.checkpoint_cache = CheckpointCache(checkpoint_cache_mb, metrics=metrics, weight_store=self.weight_store) if checkpoint_cache_mb>0 else None
+        # When set, every checkpoint is converted (once, by whichever process gets to it first) into a memory-mappable
+        # file in this folder, and mapped from there, so that all the processes on the host share the one copy
+        self.shared_weights_dir = shared_weights_dir
+        self.unmappable_ckpts = set()
+        # Checkpoints to read ahead of time, on a background thread, from look-ahead hints (eg the next voice in a batch)
+        self.prefetch_lock = threading.Condition()
+        self.prefetch_queue = []
+        self.prefetch_thread = None
+        # Run the quantizable voice models in int8, when on the CPU
+        self.cpu_int8 = cpu_int8
+        # When set, run the voice models' compilable parts as TorchScript, cached in this folder
+        self.compiled_cache_dir = compiled_cache_dir
+        # Run the voices which have an exported ONNX model on ONNX Runtime, when on the CPU. Can be set per voice (by
+        # checkpoint path) in voice_backends, to "onnx" or "torch"
+        self.onnx_backend = onnx_backend
+        self.voice_backends = {}
+        # Decode the waveforms of long lines in chunks of this many frames, to bound the decoder's memory use. 0 disables
+        self.decode_chunk_frames = decode_chunk_frames
+        self.residency = None
         self.logger = logger
+        self.metrics = metrics
+        self.num_replicas = max(1, num_replicas)
         self.PROD = PROD
         self.device_label = device
         self.device = torch.device(device)
@@ -17,109 +137,267 @@ class ModelsManager(object):
     def init_model (self, model_key, instance_index=0):
         model_key = model_key.lower()
         try:
-            if model_key in list(self.models_bank.keys()) and instance_index in self.models_bank[model_key].keys() and self.models_bank[model_key][instance_index].isReady:
+            if self._is_ready(model_key, instance_index):
                 return
-            self.logger.info(f'ModelsManager: Initializing model: {model_key}')
-
-            if model_key=="hifigan":
-                from python.hifigan.model import HiFi_GAN
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = HiFi_GAN(self.logger, self.PROD, self.device, self)
-
-            elif model_key=="big_waveglow":
-                from python.big_waveglow.model import BIG_WaveGlow
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = BIG_WaveGlow(self.logger, self.PROD, self.device, self)
-
-            elif model_key=="256_waveglow":
-                from python.waveglow.model import WaveGlow
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = WaveGlow(self.logger, self.PROD, self.device, self)
-
-            elif model_key=="fastpitch":
-                from python.fastpitch.model import FastPitch
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = FastPitch(self.logger, self.PROD, self.device, self)
-
-            elif model_key=="fastpitch1_1":
-                from python.fastpitch1_1.model import FastPitch1_1
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = FastPitch1_1(self.logger, self.PROD, self.device, self)
-
-            elif model_key=="xvapitch":
-                from python.xvapitch.model import xVAPitch
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = xVAPitch(self.logger, self.PROD, self.device, self)
-
-            elif model_key=="s2s_fastpitch1_1":
-                from python.fastpitch1_1.model import FastPitch1_1 as S2S_FastPitch1_1
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = S2S_FastPitch1_1(self.logger, self.PROD, self.device, self)
-
-            elif model_key=="wav2vec2":
-                from python.wav2vec2.model import Wav2Vec2
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = Wav2Vec2(self.logger, self.PROD, self.device, self)
-
-            elif model_key=="speaker_rep":
-                from python.xvapitch.speaker_rep.model import ResNetSpeakerEncoder
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = ResNetSpeakerEncoder(self.logger, self.PROD, self.device, self)
-
-            elif model_key=="nuwave2":
-                from python.nuwave2.model import Nuwave2Model
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = Nuwave2Model(self.logger, self.PROD, self.device, self)
-
-            elif model_key=="deepfilternet2":
-                from python.deepfilternet2.model import DeepFilter2Model
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = DeepFilter2Model(self.logger, self.PROD, self.device, self)
-
-            else:
-                raise(f'Model not recognized: {model_key}')
-
-            try:
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index].model = self.models_bank[model_key][instance_index].model.to(self.device)
-            except:
-                pass
-            try:
-                if model_key not in self.models_bank.keys():
-                    self.models_bank[model_key] = {}
-                self.models_bank[model_key][instance_index] = self.models_bank[model_key][instance_index].to(self.device)
-            except:
-                pass
+            with self.registry_lock:
+                # Another thread may have initialized it while this one was waiting
+                if self._is_ready(model_key, instance_index):
+                    return
+                self.logger.info(f'ModelsManager: Initializing model: {model_key}')
+                model = self._create_model(model_key)
+                self._register(model_key, instance_index, model)
+            if self.residency is not None:
+                self.residency.loaded(model_key, instance_index)
         except:
             self.logger.info(traceback.format_exc())
 
+    def _is_ready (self, model_key, instance_index):
+        models_bank = self.models_bank
+        return model_key in models_bank.keys() and instance_index in models_bank[model_key].keys() and models_bank[model_key][instance_index].isReady
+
+    def _create_model (self, model_key):
+        if model_key=="hifigan":
+            from python.hifigan.model import HiFi_GAN
+            model = HiFi_GAN(self.logger, self.PROD, self.device, self)
+
+        elif model_key=="big_waveglow":
+            from python.big_waveglow.model import BIG_WaveGlow
+            model = BIG_WaveGlow(self.logger, self.PROD, self.device, self)
+
+        elif model_key=="256_waveglow":
+            from python.waveglow.model import WaveGlow
+            model = WaveGlow(self.logger, self.PROD, self.device, self)
+
+        elif model_key=="fastpitch":
+            from python.fastpitch.model import FastPitch
+            model = FastPitch(self.logger, self.PROD, self.device, self)
+
+        elif model_key=="fastpitch1_1":
+            from python.fastpitch1_1.model import FastPitch1_1
+            model = FastPitch1_1(self.logger, self.PROD, self.device, self)
+
+        elif model_key=="xvapitch":
+            from python.xvapitch.model import xVAPitch
+            model = xVAPitch(self.logger, self.PROD, self.device, self)
+
+        elif model_key=="s2s_fastpitch1_1":
+            from python.fastpitch1_1.model import FastPitch1_1 as S2S_FastPitch1_1
+            model = S2S_FastPitch1_1(self.logger, self.PROD, self.device, self)
+
+        elif model_key=="wav2vec2":
+            from python.wav2vec2.model import Wav2Vec2
+            model = Wav2Vec2(self.logger, self.PROD, self.device, self)
+
+        elif model_key=="speaker_rep":
+            from python.xvapitch.speaker_rep.model import ResNetSpeakerEncoder
+            model = ResNetSpeakerEncoder(self.logger, self.PROD, self.device, self)
+
+        elif model_key=="nuwave2":
+            from python.nuwave2.model import Nuwave2Model
+            model = Nuwave2Model(self.logger, self.PROD, self.device, self)
+
+        elif model_key=="deepfilternet2":
+            from python.deepfilternet2.model import DeepFilter2Model
+            model = DeepFilter2Model(self.logger, self.PROD, self.device, self)
+
+        else:
+            raise(f'Model not recognized: {model_key}')
+
+        try:
+            model.model = model.model.to(self.device)
+        except:
+            pass
+        try:
+            model = model.to(self.device)
+        except:
+            pass
+        model.infer_lock = threading.RLock()
+        return model
+
+    # The bank is only ever replaced, never mutated in place, so that other threads can keep reading it without locking
+    def _register (self, model_key, instance_index, model):
+        models_bank = dict(self.models_bank)
+        models_bank[model_key] = dict(models_bank[model_key]) if model_key in models_bank.keys() else {}
+        models_bank[model_key][instance_index] = model
+        self.models_bank = models_bank
+
     def load_model (self, model_key, ckpt_path, instance_index=0, **kwargs):
 
         if model_key not in self.models_bank.keys() or instance_index not in self.models_bank[model_key].keys():
             self.init_model(model_key, instance_index)
 
-        if not os.path.exists(ckpt_path):
+        if not os.path.exists(ckpt_path) and not has_mmap_checkpoint(ckpt_path):
             return "ENOENT"
 
-        if self.models_bank[model_key][instance_index].ckpt_path != ckpt_path:
-            self.logger.info(f'ModelsManager: Loading model checkpoint: {model_key}, {ckpt_path}')
-            ckpt = torch.load(ckpt_path, map_location="cpu")
+        instances = [self.models_bank[model_key][instance_index]]
+        if model_key in REPLICABLE_MODELS and self.num_replicas>1:
+            instances += self._get_replicas(model_key, instance_index)
+        # The voices already loaded may just need switching to another backend (eg on a per voice backend change)
+        for model in instances:
+            if model.ckpt_path == ckpt_path and hasattr(model, "init_backend"):
+                with model.infer_lock:
+                    model.init_backend()
+        instances = [model for model in instances if model.ckpt_path != ckpt_path]
+
+        ckpt = None
+        # The model loads its cached quantized weights itself, so the fp32 checkpoint isn't needed
+        use_quantized = model_key in QUANTIZABLE_MODELS and self.cpu_int8 and self.device.type=="cpu" and has_quantized_checkpoint(ckpt_path)
+        mmap_path = self._mmap_path(ckpt_path) if len(instances) and not use_quantized else None
+        for model in instances:
+            # Read the file before taking the lock, so that in-flight inference isn't held up by the disk
+            if use_quantized:
+                self.logger.info(f'ModelsManager: Loading quantized model checkpoint: {model_key}, {ckpt_path}')
+            elif mmap_path is not None:
+                # A mapping of its own for each instance, as loading another voice into one later writes into its pages
+                self.logger.info(f'ModelsManager: Mapping model checkpoint: {model_key}, {mmap_path}')
+                ckpt = load_mmap_checkpoint(mmap_path)
+            elif ckpt is None:
+                self.logger.info(f'ModelsManager: Loading model checkpoint: {model_key}, {ckpt_path}')
+                if self.checkpoint_cache is not None and model_key in VOICE_MODELS:
+                    ckpt = self.checkpoint_cache.load(ckpt_path)
+                else:
+                    ckpt = torch.load(ckpt_path, map_location="cpu")
+                    if self.weight_store is not None and model_key in VOICE_MODELS:
+                        ckpt = self.weight_store.intern(ckpt)
+            with model.infer_lock:
+                if model.ckpt_path == ckpt_path:
+                    continue
+                # The weights are about to be overwritten in place, so any shared with other instances need copying out first
+                unshare_weights(model)
+                try:
+                    model.load_checkpoint(ckpt_path, ckpt, **kwargs)
+                except:
+                    model.load_state_dict(ckpt_path, ckpt, **kwargs)
+                if ckpt is not None and self.device.type=="cpu" and (mmap_path is not None or (self.weight_store is not None and model_key in VOICE_MODELS)):
+                    share_checkpoint_weights(model, ckpt)
+
+        self.loaded_ckpts[(model_key, instance_index)] = [ckpt_path, kwargs]
+        if len(instances) and self.residency is not None:
+            self.residency.loaded(model_key, instance_index)
+
+    # "onnx" or "torch": the backend to run a voice's checkpoint with
+    def voice_backend (self, model_key, ckpt_path):
+        backend = self.voice_backends[ckpt_path] if ckpt_path in self.voice_backends.keys() else ("onnx" if self.onnx_backend else "torch")
+        if backend!="onnx" or model_key not in ONNX_MODELS or self.device.type!="cpu":
+            return "torch"
+        # Only imported when asked for, as onnxruntime is an optional dependency
+        from python.xvapitch.onnx_backend import onnx_available, has_onnx_model
+        return "onnx" if onnx_available() and has_onnx_model(ckpt_path) else "torch"
+
+    # The memory-mappable version of a checkpoint, if there is (or, with a shared weights folder, can be made) one
+    def _mmap_path (self, ckpt_path):
+        # Converted with mmap_checkpoint.py
+        if has_mmap_checkpoint(ckpt_path):
+            return mmap_checkpoint_path(ckpt_path)
+        if self.shared_weights_dir is None or ckpt_path in self.unmappable_ckpts or not os.path.exists(ckpt_path):
+            return None
+        try:
+            return ensure_shared_mmap_checkpoint(ckpt_path, self.shared_weights_dir)
+        except:
+            self.logger.info(f'ModelsManager: Can\'t share the weights of {ckpt_path}; loading it privately')
+            self.logger.info(traceback.format_exc())
+            self.unmappable_ckpts.add(ckpt_path)
+            return None
+
+    # Start reading a checkpoint which is about to be needed, while the current one is still busy: into the checkpoint
+    # cache, or for memory-mapped checkpoints, into the OS' page cache (converting it first, in a shared weights folder).
+    # With page_cache_only (when the voices are loaded by inference workers, not this process), only the latter is done
+    def prefetch (self, model_key, ckpt_path, page_cache_only=False):
+        model_key = model_key.lower().replace(".", "_").replace(" ", "")
+        use_cache = self.checkpoint_cache is not None and not page_cache_only
+        if not use_cache and self.shared_weights_dir is None and not has_mmap_checkpoint(ckpt_path):
+            return
+        with self.prefetch_lock:
+            if [model_key, ckpt_path, use_cache] in self.prefetch_queue:
+                return
+            self.prefetch_queue.append([model_key, ckpt_path, use_cache])
+            if self.prefetch_thread is None:
+                self.prefetch_thread = threading.Thread(target=self._prefetch_worker, name="checkpoint prefetch", daemon=True)
+                self.prefetch_thread.start()
+            self.prefetch_lock.notify_all()
+
+    def _prefetch_worker (self):
+        while True:
+            with self.prefetch_lock:
+                while not len(self.prefetch_queue):
+                    self.prefetch_lock.wait()
+                model_key, ckpt_path, use_cache = self.prefetch_queue[0]
             try:
-                self.models_bank[model_key][instance_index].load_checkpoint(ckpt_path, ckpt, **kwargs)
+                # Nothing to do if an instance already has it loaded
+                models_bank = self.models_bank
+                loaded = model_key in models_bank.keys() and any([model.ckpt_path==ckpt_path for model in models_bank[model_key].values()])
+                if not loaded and (os.path.exists(ckpt_path) or has_mmap_checkpoint(ckpt_path)):
+                    start = time.time()
+                    mmap_path = self._mmap_path(ckpt_path)
+                    if mmap_path is not None:
+                        with open(mmap_path, "rb") as f:
+                            buffer = bytearray(16*1024*1024)
+                            while f.readinto(buffer):
+                                pass
+                    elif use_cache and model_key in VOICE_MODELS:
+                        self.checkpoint_cache.load(ckpt_path)
+                    self.logger.info(f'ModelsManager: Prefetched {model_key} checkpoint in {time.time()-start:.2f}s: {ckpt_path}')
             except:
-                self.models_bank[model_key][instance_index].load_state_dict(ckpt_path, ckpt, **kwargs)
+                self.logger.info(traceback.format_exc())
+            with self.prefetch_lock:
+                self.prefetch_queue.pop(0)
+
+    # For the models which load their own fixed checkpoint (eg nuwave2): read it through the same memory-mapped path
+    # as load_model(), when there is one. Returns the checkpoint, and whether it's mapped
+    def read_checkpoint (self, ckpt_path):
+        mmap_path = self._mmap_path(ckpt_path)
+        if mmap_path is not None:
+            return load_mmap_checkpoint(mmap_path), True
+        return torch.load(ckpt_path, map_location="cpu"), False
+
+    # Drop an instance (and its replicas) from the bank, unless it's in use. Returns whether it was unloaded
+    def unload_model (self, model_key, instance_index=0):
+        with self.registry_lock:
+            models_bank = self.models_bank
+            if model_key not in models_bank.keys() or instance_index not in models_bank[model_key].keys():
+                return False
+            instances = [models_bank[model_key][instance_index]]
+            if (model_key, instance_index) in self.replicas_bank.keys():
+                instances += self.replicas_bank[(model_key, instance_index)]
+
+            locked = []
+            try:
+                for model in instances:
+                    if not model.infer_lock.acquire(blocking=False):
+                        return False
+                    locked.append(model)
+
+                models_bank = dict(models_bank)
+                models_bank[model_key] = dict(models_bank[model_key])
+                del models_bank[model_key][instance_index]
+                if not len(models_bank[model_key]):
+                    del models_bank[model_key]
+                self.models_bank = models_bank
+                if (model_key, instance_index) in self.replicas_bank.keys():
+                    self.replicas_bank = dict(self.replicas_bank)
+                    del self.replicas_bank[(model_key, instance_index)]
+                return True
+            finally:
+                for model in locked:
+                    model.infer_lock.release()
+
+    def _get_replicas (self, model_key, instance_index):
+        with self.registry_lock:
+            replicas = self.replicas_bank[(model_key, instance_index)] if (model_key, instance_index) in self.replicas_bank.keys() else []
+            if len(replicas)<self.num_replicas-1:
+                self.logger.info(f'ModelsManager: Initializing {self.num_replicas-1-len(replicas)} replicas of: {model_key}')
+                replicas = replicas + [self._create_model(model_key) for _ in range(self.num_replicas-1-len(replicas))]
+                self.replicas_bank = dict(self.replicas_bank)
+                self.replicas_bank[(model_key, instance_index)] = replicas
+            return replicas
+
+    # The model to run inference with: the instance itself, or if it has replicas, a stand-in spreading the calls over them
+    def inference_model (self, key, instance_index=0):
+        model = self.models(key, instance_index=instance_index)
+        key = (key.lower(), instance_index)
+        replicas = self.replicas_bank[key] if key in self.replicas_bank.keys() else []
+        replicas = [replica for replica in replicas if replica.ckpt_path==model.ckpt_path]
+        return ModelReplicas([model]+replicas) if len(replicas) else model
 
     def set_device (self, device, instance_index=0):
         if device=="gpu":
@@ -129,10 +407,29 @@ class ModelsManager(object):
         self.device_label = device
         self.device = torch.device(device)
         self.logger.info(f'ModelsManager: Changing device to: {device}')
-        for model_key in list(self.models_bank.keys()):
-            self.models_bank[model_key][instance_index].set_device(self.device)
+        models_bank = self.models_bank
+        for model_key in list(models_bank.keys()):
+            if instance_index not in models_bank[model_key].keys():
+                continue
+            instances = [models_bank[model_key][instance_index]]
+            if (model_key, instance_index) in self.replicas_bank.keys():
+                instances += self.replicas_bank[(model_key, instance_index)]
+            for model in instances:
+                with model.infer_lock:
+                    model.set_device(self.device)
 
     def models (self, key, instance_index=0):
-        if key.lower() not in self.models_bank.keys() or instance_index not in self.models_bank[key.lower()].keys():
+        models_bank = self.models_bank
+        if key.lower() not in models_bank.keys() or instance_index not in models_bank[key.lower()].keys():
             self.init_model(key.lower(), instance_index=instance_index)
-        return self.models_bank[key.lower()][instance_index]
+            # Unloaded by the residency manager; load back the checkpoint it had
+            if (key.lower(), instance_index) in self.loaded_ckpts.keys():
+                ckpt_path, kwargs = self.loaded_ckpts[(key.lower(), instance_index)]
+                self.logger.info(f'ModelsManager: Reloading unloaded model: {key.lower()}, {ckpt_path}')
+                self.load_model(key.lower(), ckpt_path, instance_index=instance_index, **kwargs)
+                if hasattr(self.models_bank[key.lower()][instance_index], "init_arpabet_dicts"):
+                    self.models_bank[key.lower()][instance_index].init_arpabet_dicts()
+            models_bank = self.models_bank
+        if self.residency is not None:
+            self.residency.touch(key.lower(), instance_index)
+        return models_bank[key.lower()][instance_index]
@@ -23,6 +23,12 @@ except ModuleNotFoundError:
             from nuwave2.nuwave2_model import NuWave2 as model
         except ModuleNotFoundError:
             from nuwave2_model import NuWave2 as model
+
+try:
+    from python.weight_store import share_checkpoint_weights
+except ModuleNotFoundError:
+    from resources.app.python.weight_store import share_checkpoint_weights
+
 class Diffusion(nn.Module):
     def __init__(self, hparams):
         super().__init__()
@@ -219,8 +225,10 @@ class Nuwave2Model(object):
 
         self.model = NuWave2(self.hparams)
         self.model.eval()
-        ckpt = torch.load(f'{self.path}/python/nuwave2/nuwave2_02_16_13_epoch=629.ckpt', map_location='cpu')
+        ckpt, is_mapped = models_manager.read_checkpoint(f'{self.path}/python/nuwave2/nuwave2_02_16_13_epoch=629.ckpt')
         self.model.load_state_dict(ckpt['state_dict'])
+        if is_mapped:
+            share_checkpoint_weights(self, ckpt)
 
         self.sr = 22050
 
@@ -238,7 +246,14 @@ class Nuwave2Model(object):
     def sr_audio (self, in_path, out_path):
 
         wav, _ = librosa.load(in_path, sr=self.sr, mono=True)
-        wav /= np.max(np.abs(wav))
+        wav_recon, sr = self.sr_wav(wav)
+        scipy.io.wavfile.write(out_path, sr, wav_recon)
+
+
+    # Super-resolve a float waveform sampled at self.sr, returning the 48kHz float waveform and its sample rate
+    def sr_wav (self, wav):
+
+        wav = wav / np.max(np.abs(wav))
 
         # upsample to the original sampling rate
         wav_l = resample_poly(wav, self.hparams.audio.sampling_rate, self.sr)
@@ -255,7 +270,7 @@ class Nuwave2Model(object):
         wav_recon, wav_list = self.model.inference(wav_l, band, self.steps, self.noise_schedule)
 
         wav_recon = torch.clamp(wav_recon, min=-1, max=1 - torch.finfo(torch.float16).eps)
-        scipy.io.wavfile.write(out_path, self.hparams.audio.sampling_rate, wav_recon[0].detach().cpu().numpy())
+        return wav_recon[0].detach().cpu().numpy(), self.hparams.audio.sampling_rate
 
 
 
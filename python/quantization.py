@@ -0,0 +1,177 @@
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# Saved next to the voice's checkpoint. Not a .pt, so that the voice folders' .pt scans (eg mmap_checkpoint.py) skip it
+QUANTIZED_EXTENSION = ".int8.pth"
+QUANTIZED_FORMAT = 1
+
+
+class QuantizedConv1d(nn.Module):
+    """
+    Int8 stand-in for an nn.Conv1d, for CPU inference. torch's dynamic quantization only covers nn.Linear, so the conv
+    is run as a dynamically quantized Linear: the kernel's taps are stacked into one (k*out, in) weight matrix, applied
+    to every time step of the input in a single int8 matmul, and the taps' outputs are then shifted (by the dilation)
+    and summed. The weights are quantized per output channel, and the activations on the fly, per call.
+    """
+
+    def __init__(self, conv):
+        super(QuantizedConv1d, self).__init__()
+
+        self.in_channels = conv.in_channels
+        self.out_channels = conv.out_channels
+        self.kernel_size = conv.kernel_size[0]
+        self.stride = conv.stride[0]
+        self.padding = conv.padding[0]
+        self.dilation = conv.dilation[0]
+
+        linear = nn.Linear(self.in_channels, self.kernel_size*self.out_channels, bias=False)
+        # (out, in, k) -> (k*out, in)
+        linear.weight.data = conv.weight.detach().float().cpu().permute(2, 0, 1).reshape(-1, self.in_channels).contiguous()
+        linear.qconfig = getattr(torch.quantization, "per_channel_dynamic_qconfig", torch.quantization.default_dynamic_qconfig)
+        self.linear = torch.nn.quantized.dynamic.Linear.from_float(linear)
+        # Added after the taps are summed, so kept in fp32
+        self.register_buffer("bias", conv.bias.detach().float().cpu().clone() if conv.bias is not None else None)
+
+    # For the code reading the device (or the weights) off the conv
+    @property
+    def weight (self):
+        return self.linear.weight().dequantize().reshape(self.kernel_size, self.out_channels, self.in_channels).permute(1, 2, 0)
+
+    def forward (self, x):
+        x = x.float()
+        if self.padding:
+            x = F.pad(x, (self.padding, self.padding))
+        # (B, T, k, out)
+        taps = self.linear(x.transpose(1, 2).contiguous()).reshape(x.shape[0], x.shape[2], self.kernel_size, self.out_channels)
+        length = (x.shape[2] - self.dilation*(self.kernel_size-1) - 1)//self.stride + 1
+
+        out = None
+        for tap in range(self.kernel_size):
+            start = tap*self.dilation
+            shifted = taps[:, start:start+(length-1)*self.stride+1:self.stride, tap]
+            out = shifted if out is None else out+shifted
+        if self.bias is not None:
+            out = out+self.bias
+        return out.transpose(1, 2).contiguous()
+
+
+# Narrower layers are left in fp32: on them (eg the HiFi-GAN's last, audio rate, upsampling stages) the per-call
+# activation quantization and the taps' shift-and-sum cost more than the int8 matmul saves
+MIN_QUANTIZED_CHANNELS = 192
+
+def _quantizable (conv, min_channels):
+    return type(conv)==nn.Conv1d and conv.groups==1 and conv.padding_mode=="zeros" and isinstance(conv.padding, tuple) \
+        and min(conv.in_channels, conv.out_channels)>=min_channels
+
+# Swap every plain Conv1d under the given sub-modules for a QuantizedConv1d (folding in any weight norm first).
+# Returns the number of layers quantized
+def quantize_conv1d_layers (model, submodules, min_channels=MIN_QUANTIZED_CHANNELS):
+    quantized = 0
+    for submodule_name in submodules:
+        submodule = getattr(model, submodule_name, None)
+        if submodule is None:
+            continue
+        for parent in list(submodule.modules()):
+            for name, child in list(parent.named_children()):
+                if not _quantizable(child, min_channels):
+                    continue
+                if hasattr(child, "weight_g"):
+                    torch.nn.utils.remove_weight_norm(child)
+                setattr(parent, name, QuantizedConv1d(child))
+                quantized += 1
+    return quantized
+
+
+# voice.pt -> voice.int8.pth
+def quantized_checkpoint_path (ckpt_path):
+    return (ckpt_path[:-3] if ckpt_path.endswith(".pt") else ckpt_path) + QUANTIZED_EXTENSION
+
+# The cached quantized weights are used if they're no older than the checkpoint they were made from
+def has_quantized_checkpoint (ckpt_path):
+    quantized_path = quantized_checkpoint_path(ckpt_path)
+    if not os.path.exists(quantized_path):
+        return False
+    sources = [path for path in [ckpt_path, (ckpt_path[:-3] if ckpt_path.endswith(".pt") else ckpt_path)+".xvamm"] if os.path.exists(path)]
+    return all([os.path.getmtime(quantized_path)>=os.path.getmtime(path) for path in sources])
+
+def save_quantized_checkpoint (model, ckpt_path):
+    quantized_path = quantized_checkpoint_path(ckpt_path)
+    tmp_path = f'{quantized_path}.{os.getpid()}.tmp'
+    torch.save({"format": QUANTIZED_FORMAT, "model": model.state_dict()}, tmp_path)
+    os.replace(tmp_path, quantized_path)
+
+def load_quantized_checkpoint (ckpt_path):
+    ckpt = torch.load(quantized_checkpoint_path(ckpt_path), map_location="cpu")
+    if not isinstance(ckpt, dict) or ckpt.get("format")!=QUANTIZED_FORMAT:
+        raise ValueError(f'Unsupported quantized checkpoint: {quantized_checkpoint_path(ckpt_path)}')
+    return ckpt["model"]
+
+
+# Signal to noise ratio (dB) of a test waveform against the reference, and the mean absolute difference of their
+# log-magnitude spectrograms. The quantized model can predict slightly different durations, so only the overlap is compared
+def compare_waveforms (reference, test, n_fft=1024, hop_length=256):
+    reference = torch.as_tensor(reference).float().reshape(-1)
+    test = torch.as_tensor(test).float().reshape(-1)
+    length = min(len(reference), len(test))
+    reference, test = reference[:length], test[:length]
+
+    snr = 10*torch.log10(reference.pow(2).sum() / (reference-test).pow(2).sum().clamp(min=1e-10))
+    window = torch.hann_window(n_fft)
+    spec_ref = torch.stft(reference, n_fft, hop_length=hop_length, window=window, return_complex=True).abs()
+    spec_test = torch.stft(test, n_fft, hop_length=hop_length, window=window, return_complex=True).abs()
+    log_spec_distance = (torch.log(spec_ref.clamp(min=1e-5)) - torch.log(spec_test.clamp(min=1e-5))).abs().mean()
+    return {"snr_db": float(snr), "log_spectral_distance": float(log_spec_distance), "length_ratio": len(test)/max(1, len(reference))}
+
+
+# Quality (and speed) check of the int8 mode, on a voice: synthesizes the same lines with the fp32 and the quantized
+# model (with the same noise), and reports how far apart the outputs are
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare a voice's int8 quantized CPU output against fp32")
+    parser.add_argument("ckpt", help="xVAPitch voice checkpoint (.pt)")
+    parser.add_argument("--lang", default="en")
+    parser.add_argument("--runs", type=int, default=3, help="Timed runs per line, per model")
+    parser.add_argument("--text", action="append", help="Line(s) to synthesize")
+    args = parser.parse_args()
+
+    sys.path.append(".")
+    import json
+    import logging
+    from python.models_manager import ModelsManager
+
+    logger = logging.getLogger("quantization")
+    logger.addHandler(logging.StreamHandler())
+    texts = args.text or ["The quick brown fox jumps over the lazy dog.", "Hello there. This is a test of the quantized voice, with a somewhat longer sentence."]
+    base_emb = [0.0]*512
+    if os.path.exists(args.ckpt.replace(".pt", ".json")):
+        with open(args.ckpt.replace(".pt", ".json"), encoding="utf8") as f:
+            base_emb = json.load(f)["games"][0]["base_speaker_emb"]
+
+    results = {}
+    for label, cpu_int8 in [["fp32", False], ["int8", True]]:
+        models_manager = ModelsManager(logger, False, device="cpu", cpu_int8=cpu_int8)
+        models_manager.load_model("xvapitch", args.ckpt, base_lang=args.lang)
+        model = models_manager.models("xvapitch")
+        results[label] = []
+        for text in texts:
+            seconds = []
+            for _ in range(max(1, args.runs)):
+                torch.manual_seed(0)
+                start = time.time()
+                with torch.no_grad():
+                    out = model.infer_tts_lines(None, [{"text": text, "base_lang": args.lang, "base_emb": base_emb, "pace": 1.0, "pitch_amp": None}])
+                seconds.append(time.time()-start)
+            if isinstance(out, str) or isinstance(out[0], str):
+                print(f'{label} failed: {out if isinstance(out, str) else out[0]}')
+                sys.exit(1)
+            results[label].append([out[0]["wav"], min(seconds)])
+
+    for text, (wav_fp32, seconds_fp32), (wav_int8, seconds_int8) in zip(texts, results["fp32"], results["int8"]):
+        stats = compare_waveforms(wav_fp32, wav_int8)
+        print(f'{text}\n    SNR: {stats["snr_db"]:.1f}dB, log-spectral distance: {stats["log_spectral_distance"]:.3f}, length ratio: {stats["length_ratio"]:.3f}')
+        print(f'    fp32: {seconds_fp32:.3f}s, int8: {seconds_int8:.3f}s ({seconds_fp32/max(seconds_int8, 1e-6):.2f}x)')
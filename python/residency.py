@@ -0,0 +1,167 @@
+import gc
+import time
+import threading
+import traceback
+
+import torch
+
+
+# Bytes held by a model object's torch parameters and buffers. The model classes either are an nn.Module themselves
+# (speaker_rep), or keep theirs in .model (plus a few extra tensors, eg the xVAPitch emotion embeddings)
+def model_size_bytes (model):
+    modules = [module for module in [model, getattr(model, "model", None)] if isinstance(module, torch.nn.Module)]
+    seen = set()
+    total = 0
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class ResidencyManager(object):
+    """
+    Keeps the models loaded by the ModelsManager within a RAM budget. Every models() lookup marks the instance as
+    used; when the resident models (replicas included) add up to more than the budget, or when one has been idle for
+    longer than the TTL, the least recently used ones are unloaded. The ModelsManager remembers which checkpoint an
+    unloaded instance had, and loads it back transparently on its next models() lookup.
+
+    The unloading is done on its own thread, so that an instance whose infer_lock is held by a request (which could
+    be the very thread that triggered the check) is never mistaken for an idle one.
+    """
+
+    def __init__(self, logger, models_manager, budget_mb=0, idle_ttl_s=0, check_interval_s=30):
+        super(ResidencyManager, self).__init__()
+
+        self.logger = logger
+        self.models_manager = models_manager
+        self.budget_bytes = int(budget_mb*1024*1024)
+        self.idle_ttl_s = idle_ttl_s
+        self.check_interval_s = check_interval_s
+
+        self.lock = threading.Lock()
+        self.last_used = {} # (model_key, instance_index) -> time
+        self.sizes = {} # (model_key, instance_index) -> [model object, bytes], measured once per loaded object
+        self.evictions = 0
+        self.wake = threading.Event()
+        self.reaper = None
+
+    def start (self):
+        if (self.budget_bytes or self.idle_ttl_s>0) and self.reaper is None:
+            self.reaper = threading.Thread(target=self._reap, name="model residency", daemon=True)
+            self.reaper.start()
+
+    def touch (self, model_key, instance_index):
+        self.last_used[(model_key, instance_index)] = time.time()
+
+    # A model was just created, or had a checkpoint loaded into it
+    def loaded (self, model_key, instance_index):
+        key = (model_key, instance_index)
+        with self.lock:
+            if key in self.sizes.keys():
+                del self.sizes[key]
+        self.touch(model_key, instance_index)
+        if self.budget_bytes:
+            self.wake.set()
+
+
+    def _size (self, key, model):
+        with self.lock:
+            if key in self.sizes.keys() and self.sizes[key][0] is model:
+                return self.sizes[key][1]
+        size = model_size_bytes(model)
+        with self.lock:
+            self.sizes[key] = [model, size]
+        return size
+
+    # (model_key, instance_index) -> total bytes of the instance and its replicas
+    def resident (self):
+        models_bank = self.models_manager.models_bank
+        replicas_bank = self.models_manager.replicas_bank
+        resident = {}
+        for model_key in models_bank.keys():
+            for instance_index in models_bank[model_key].keys():
+                key = (model_key, instance_index)
+                replicas = replicas_bank[key] if key in replicas_bank.keys() else []
+                resident[key] = self._size(key, models_bank[model_key][instance_index]) + sum([model_size_bytes(replica) for replica in replicas])
+        return resident
+
+    def report (self):
+        resident = self.resident()
+        models_bank = self.models_manager.models_bank
+        now = time.time()
+        models = []
+        for key in sorted(resident.keys(), key=lambda key: -resident[key]):
+            model_key, instance_index = key
+            replicas = self.models_manager.replicas_bank[key] if key in self.models_manager.replicas_bank.keys() else []
+            models.append({
+                "model_key": model_key,
+                "instance_index": instance_index,
+                "ckpt_path": getattr(models_bank[model_key][instance_index], "ckpt_path", None),
+                "replicas": len(replicas),
+                "size_mb": round(resident[key]/1024/1024, 1),
+                "idle_s": round(now-self.last_used[key], 1) if key in self.last_used.keys() else None,
+            })
+        return {
+            "budget_mb": round(self.budget_bytes/1024/1024, 1) if self.budget_bytes else None,
+            "idle_ttl_s": self.idle_ttl_s or None,
+            "resident_mb": round(sum(resident.values())/1024/1024, 1),
+            "evictions": self.evictions,
+            "models": models,
+            "checkpoint_cache": self.models_manager.checkpoint_cache.report() if self.models_manager.checkpoint_cache is not None else None,
+            "weight_store": self.models_manager.weight_store.report() if self.models_manager.weight_store is not None else None,
+        }
+
+
+    # Unload least recently used models until the resident ones fit in the budget
+    def enforce_budget (self, keep=None):
+        if not self.budget_bytes:
+            return
+        resident = self.resident()
+        total = sum(resident.values())
+        if total<=self.budget_bytes:
+            return
+        last_used = dict(self.last_used)
+        for key in sorted([key for key in resident.keys() if key!=keep], key=lambda key: last_used[key] if key in last_used.keys() else 0):
+            if total<=self.budget_bytes:
+                break
+            if self._evict(key, f'over the {self.budget_bytes/1024/1024:.0f}MB budget ({total/1024/1024:.0f}MB resident)'):
+                total -= resident[key]
+        if total>self.budget_bytes:
+            self.logger.info(f'[Residency] Still over budget after unloading the idle models: {total/1024/1024:.0f}MB resident')
+
+    def _reap (self):
+        while True:
+            self.wake.wait(self.check_interval_s)
+            self.wake.clear()
+            try:
+                if self.idle_ttl_s>0:
+                    now = time.time()
+                    for key in list(self.resident().keys()):
+                        last_used = self.last_used[key] if key in self.last_used.keys() else None
+                        if last_used is not None and now-last_used>self.idle_ttl_s:
+                            self._evict(key, f'idle for {now-last_used:.0f}s')
+                # The most recently used instance is kept, as that's normally the one which was just loaded
+                last_used = dict(self.last_used)
+                most_recent = sorted(last_used.keys(), key=lambda key: last_used[key])[-1] if len(last_used) else None
+                self.enforce_budget(keep=most_recent)
+            except:
+                self.logger.info(traceback.format_exc())
+
+    def _evict (self, key, reason):
+        if not self.models_manager.unload_model(key[0], key[1]):
+            return False
+        with self.lock:
+            if key in self.sizes.keys():
+                del self.sizes[key]
+        if key in self.last_used.keys():
+            del self.last_used[key]
+        self.evictions += 1
+        self.logger.info(f'[Residency] Unloaded {key[0]} (instance {key[1]}): {reason}')
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return True
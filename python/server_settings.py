@@ -0,0 +1,94 @@
+import os
+import json
+import traceback
+
+# Server-side tuning knobs. These can be overridden by a server_settings.json file next to the executable
+DEFAULT_SERVER_SETTINGS = {
+    # Concurrent /synthesize requests for the same loaded voice are collected for up to this long, and run
+    # together as one batched forward pass. 0 disables coalescing
+    "synth_coalesce_window_ms": 20,
+    # Stop collecting early once this many requests, or this many characters of text have been queued up
+    "synth_coalesce_max_batch": 8,
+    "synth_coalesce_token_budget": 1500,
+    # Run inference in this many worker processes, each with their own loaded models, with the HTTP server just
+    # routing the requests to them. 0 keeps everything in the server process. The torch CPU threads are split
+    # between the workers, unless worker_threads is set
+    "worker_processes": 0,
+    "worker_threads": 0,
+    # With worker processes: convert each checkpoint once into a memory-mappable file in this folder (default: in the
+    # system temp folder), which the server and all the workers then map, sharing one copy of the weights. "" = off
+    "shared_weights_dir": "default",
+    # Per class of endpoint: how many requests can run at once, and how many more can wait for a slot. Past that,
+    # requests are turned away with a 503 and a Retry-After header
+    "admission_limits": {
+        "inference": {"concurrency": 8, "queue": 32},
+        "audio_post": {"concurrency": 4, "queue": 64},
+        "metadata": {"concurrency": 16, "queue": 128},
+    },
+    # Initialize xVAPitch (and its English text pre-processor) during start-up, in parallel with the plugins, rather
+    # than on the first voice load
+    "startup_init_xvapitch": True,
+    # Extra copies of the loaded voice to keep in memory, so that requests for it can run in parallel. 1 = no replicas
+    "voice_replicas": 1,
+    # JSON manifest of the voices (and languages) and auxiliary models to load and warm up with a dummy inference
+    # at start-up. GET /ready only reports ready once they're all warm. See python/warmup.py for the format
+    "warmup_manifest": "./warmup_manifest.json",
+    # Keep up to this many MB of recently used voice checkpoints in RAM, so that switching back to a voice doesn't
+    # read it from disk again. 0 disables the cache
+    "checkpoint_cache_mb": 1024,
+    # Keep the voice weights which are byte-identical across checkpoints (eg layers left frozen during fine-tuning)
+    # in memory only once, shared by the cached checkpoints and the loaded voices
+    "weight_dedup": True,
+    # Run xVAPitch with int8 quantized weights when on the CPU, for faster inference at a small cost in fidelity. The
+    # quantized weights are cached next to each voice's checkpoint (voice.int8.pth). Check a voice's output quality
+    # against fp32 with: python python/quantization.py path/to/voice.pt
+    "cpu_int8_quantization": False,
+    # Run xVAPitch's flow and waveform decoder as traced TorchScript, rather than eagerly, layer by layer. The traces are
+    # made on first use, and cached in compiled_cache_dir (default: in the system temp folder) per model architecture,
+    # so later starts, and other voices, re-use them
+    "compiled_inference": False,
+    "compiled_cache_dir": "default",
+    # Run the xVAPitch voices on ONNX Runtime when on the CPU, for those which have been exported next to their
+    # checkpoint (voice.onnx/), with: python python/xvapitch/onnx_export.py path/to/voices. Needs onnxruntime installed.
+    # /loadModel can also pick the backend per voice, with "backend": "onnx" or "torch"
+    "onnx_backend": False,
+    # Decode the audio of long lines this many frames (~86 per second) at a time, cross-fading the chunks, so that the
+    # waveform decoder's peak memory use doesn't grow with the line's length. 0 decodes every line in one go
+    "decode_chunk_frames": 1024,
+    # Frames (~86 per second) of audio decoded and sent at a time by /synthesize_stream. Smaller chunks get the first
+    # audio out sooner, at the cost of more overlap decoded between them
+    "stream_chunk_frames": 64,
+    # Long-form mode, for requests with "long_form": true (or a dict overriding some of these): xVAPitch prompts longer
+    # than max_chars are split at sentence (or else clause) ends, synthesized batch_size segments at a time, and joined
+    # with a pause after each, cross-faded over crossfade_ms
+    "long_form": {"max_chars": 200, "batch_size": 8, "sentence_pause_ms": 250, "clause_pause_ms": 100, "crossfade_ms": 10},
+    # Unload the least recently used models (voices, vocoders, and the auxiliary models) once the loaded ones add up
+    # to more than this many MB, or once one has gone unused for this many seconds. They're loaded back on their next
+    # use. 0 disables either
+    "model_memory_budget_mb": 0,
+    "model_idle_ttl_s": 0,
+    # Number of lines per model batch, when running the jobs submitted through /batch_job/submit
+    "batch_job_batch_size": 16,
+    # Re-order the lines of each batch job by voice (then vocoder, language...), so that each voice is only loaded
+    # once per job, and the lines are run in full batches. A manifest can opt out with "reorder": false
+    "batch_job_voice_affinity": True,
+}
+
+
+def load_server_settings (logger=None, settings_path="./server_settings.json"):
+    settings = dict(DEFAULT_SERVER_SETTINGS)
+
+    if os.path.exists(settings_path):
+        try:
+            with open(settings_path, encoding="utf8") as f:
+                user_settings = json.load(f)
+            for key in user_settings.keys():
+                if key not in settings.keys() and logger is not None:
+                    logger.info(f'Unrecognized server setting: {key}')
+                settings[key] = user_settings[key]
+        except:
+            if logger is not None:
+                logger.info(f'Failed to read the server settings file: {settings_path}')
+                logger.info(traceback.format_exc())
+
+    return settings
@@ -0,0 +1,204 @@
+import os
+import sys
+import time
+import builtins
+import threading
+import traceback
+
+
+# Picks how to read the process' resident memory once, up-front, so that no imports happen while profiling the imports
+def _make_rss_reader ():
+    try:
+        import psutil
+        process = psutil.Process(os.getpid())
+        return lambda: process.memory_info().rss
+    except ImportError:
+        pass
+
+    if os.path.exists("/proc/self/statm"):
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        def read_statm ():
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * page_size
+        return read_statm
+
+    if sys.platform=="win32":
+        import ctypes
+        from ctypes import wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD), ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t), ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+        def read_working_set ():
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+            return counters.WorkingSetSize
+        return read_working_set
+
+    return lambda: None
+
+_rss_reader = None
+
+def get_rss_bytes ():
+    global _rss_reader
+    try:
+        if _rss_reader is None:
+            _rss_reader = _make_rss_reader()
+        return _rss_reader()
+    except:
+        return None
+
+
+class StartupTask(object):
+    def __init__(self, name, fn):
+        super(StartupTask, self).__init__()
+        self.name = name
+        self.fn = fn
+        self.value = None
+        self.error = None
+        self.thread = None
+
+    def result (self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class StartupProfiler(object):
+    """
+    Records the server start-up timeline: each initialisation step, and (when enabled) each newly imported module,
+    with its wall time, the thread it ran on, and the change in the process' RSS. The steps can be run concurrently
+    with run_async(). RSS deltas are process-wide, so they overlap for steps which ran at the same time.
+    """
+
+    def __init__(self, enabled=False, min_import_ms=5):
+        super(StartupProfiler, self).__init__()
+
+        self.enabled = enabled
+        self.min_import_ms = min_import_ms
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+        self.steps = [] # [name, thread name, start offset, duration, rss delta]
+        self.imports = [] # [module, depth, thread name, start offset, duration, rss delta]
+        self.import_depth = threading.local()
+        self.original_import = None
+
+        if self.enabled:
+            get_rss_bytes()
+            self._install_import_hook()
+
+
+    def _install_import_hook (self):
+        self.original_import = builtins.__import__
+        original_import = self.original_import
+
+        def profiled_import (name, globals=None, locals=None, fromlist=(), level=0):
+            if level==0 and name in sys.modules:
+                return original_import(name, globals, locals, fromlist, level)
+
+            depth = getattr(self.import_depth, "depth", 0)
+            self.import_depth.depth = depth + 1
+            start = time.perf_counter()
+            rss = get_rss_bytes()
+            try:
+                return original_import(name, globals, locals, fromlist, level)
+            finally:
+                self.import_depth.depth = depth
+                duration = time.perf_counter() - start
+                if duration*1000 >= self.min_import_ms:
+                    rss_after = get_rss_bytes()
+                    with self.lock:
+                        self.imports.append([self._module_label(name, globals, fromlist, level), depth, threading.current_thread().name, start-self.start_time, duration, \
+                            (rss_after-rss) if rss is not None and rss_after is not None else None])
+
+        builtins.__import__ = profiled_import
+
+    def _module_label (self, name, globals, fromlist, level):
+        if level==0:
+            return name
+        package = globals.get("__package__", "") if globals is not None else ""
+        if name:
+            return f'{package}.{name}'
+        return f'{package} ({", ".join(fromlist or [])})'
+
+    def _uninstall_import_hook (self):
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+
+    # Time a step of the start-up. Usable as "with startup_profiler.step(name):"
+    def step (self, name):
+        return _ProfiledStep(self, name)
+
+    def _record_step (self, name, start, rss):
+        duration = time.perf_counter() - start
+        rss_after = get_rss_bytes()
+        with self.lock:
+            self.steps.append([name, threading.current_thread().name, start-self.start_time, duration, \
+                (rss_after-rss) if rss is not None and rss_after is not None else None])
+
+    # Run a step on its own thread, for the initialisation of the independent parts of the server
+    def run_async (self, name, fn):
+        task = StartupTask(name, fn)
+        def run ():
+            with self.step(name):
+                try:
+                    task.value = fn()
+                except Exception as e:
+                    task.error = e
+        task.thread = threading.Thread(target=run, name=f'startup: {name}', daemon=True)
+        task.thread.start()
+        return task
+
+
+    def elapsed (self):
+        return time.perf_counter() - self.start_time
+
+    def write_report (self, report_path, logger=None):
+        self._uninstall_import_hook()
+        if not self.enabled:
+            return
+
+        def format_rss (rss):
+            return "" if rss is None else f'{"+" if rss>=0 else "-"}{abs(rss)/1024/1024:.1f} MB'
+
+        rss = get_rss_bytes()
+        lines = [f'Start-up took {self.elapsed():.2f}s. RSS now: {"?" if rss is None else f"{rss/1024/1024:.1f} MB"}', "", "==== Steps", ""]
+        lines.append(f'{"start (s)":>10} {"time (s)":>10} {"RSS delta":>12}  step [thread]')
+        with self.lock:
+            for name, thread_name, start, duration, rss in sorted(self.steps, key=lambda step: step[2]):
+                lines.append(f'{start:>10.3f} {duration:>10.3f} {format_rss(rss):>12}  {name} [{thread_name}]')
+
+            lines += ["", f'==== Imports (>= {self.min_import_ms}ms, times include nested imports)', ""]
+            lines.append(f'{"start (s)":>10} {"time (s)":>10} {"RSS delta":>12}  module [thread]')
+            for name, depth, thread_name, start, duration, rss in sorted(self.imports, key=lambda imp: imp[3]):
+                lines.append(f'{start:>10.3f} {duration:>10.3f} {format_rss(rss):>12}  {"  "*depth}{name} [{thread_name}]')
+
+        try:
+            with open(report_path, "w+", encoding="utf8") as f:
+                f.write("\n".join(lines)+"\n")
+            if logger is not None:
+                logger.info(f'Start-up profile written to: {report_path}')
+        except:
+            if logger is not None:
+                logger.info(traceback.format_exc())
+
+
+class _ProfiledStep(object):
+    def __init__(self, profiler, name):
+        super(_ProfiledStep, self).__init__()
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__ (self):
+        self.start = time.perf_counter()
+        self.rss = get_rss_bytes()
+        return self
+
+    def __exit__ (self, exc_type, exc_value, exc_traceback):
+        self.profiler._record_step(self.name, self.start, self.rss)
+        return False
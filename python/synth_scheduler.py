@@ -0,0 +1,156 @@
+import time
+import threading
+import traceback
+
+from python.models_manager import inference_lock
+
+
+class CoalescedRequest(object):
+    def __init__(self, infer_kwargs):
+        super(CoalescedRequest, self).__init__()
+
+        self.infer_kwargs = infer_kwargs
+        self.num_tokens = len(infer_kwargs["text"])
+        self.response = None
+        self.error = None
+        self.is_done = False
+        self.is_leader = False
+        self.event = threading.Event()
+
+
+class SynthScheduler(object):
+    """
+    Collects concurrent /synthesize requests for the same model instance over a short window, and runs them as one
+    padded batch through the model's infer_coalesced(). The first request to arrive for an instance becomes the
+    "leader", waits for the window (or the batch/token budget) and runs the batch, and then hands each of the other
+    callers their own response. Requests which can't be batched (editor values, partial re-generation, etc) are run
+    straight through infer(), as before.
+    """
+
+    def __init__(self, logger, window_ms=20, max_batch=8, token_budget=1500):
+        super(SynthScheduler, self).__init__()
+
+        self.logger = logger
+        self.window = window_ms/1000
+        self.max_batch = max(1, max_batch)
+        self.token_budget = token_budget
+
+        self.lock = threading.Condition()
+        self.pending = {} # (model_key, instance_index) -> [CoalescedRequest]
+        self.run_locks = {} # (model_key, instance_index) -> [parallel slots, threading.BoundedSemaphore]
+
+
+    def can_coalesce (self, model, plugin_manager, infer_kwargs):
+        if self.window<=0 or not hasattr(model, "infer_coalesced"):
+            return False
+        # The mid synth-line plugin data is per-line, so these need the un-batched path
+        if plugin_manager is not None and len(plugin_manager.plugins["synth-line"]["mid"]):
+            return False
+        if infer_kwargs["old_sequence"] is not None or not isinstance(infer_kwargs["base_emb"], str):
+            return False
+        # Already split up and batched by the model itself
+        if "long_form" in infer_kwargs.keys() and infer_kwargs["long_form"]:
+            return False
+
+        editor_data = infer_kwargs["editor_data"]
+        if editor_data is not None:
+            pitch, duration, editorStyles = editor_data[0], editor_data[1], editor_data[-1]
+            if (pitch is not None and len(pitch)) or (duration is not None and len(duration)) or editorStyles:
+                return False
+        return True
+
+
+    def infer (self, key, model, plugin_manager, infer_kwargs):
+
+        if not self.can_coalesce(model, plugin_manager, infer_kwargs):
+            with inference_lock(model):
+                return model.infer(plugin_manager, **infer_kwargs)
+
+        request = CoalescedRequest(infer_kwargs)
+        with self.lock:
+            if key not in self.pending.keys():
+                self.pending[key] = []
+            self.pending[key].append(request)
+            request.is_leader = len(self.pending[key])==1
+            self.lock.notify_all()
+
+        if request.is_leader:
+            self._lead(key, model, plugin_manager, wait_window=True)
+        else:
+            request.event.wait()
+            if not request.is_done:
+                # Promoted to leader for the requests left over from a full batch. These have already waited
+                self._lead(key, model, plugin_manager, wait_window=False)
+
+        if request.error is not None:
+            raise request.error
+        return request.response
+
+
+    def _lead (self, key, model, plugin_manager, wait_window=True):
+
+        # Give concurrent requests a short window to join the batch
+        deadline = time.time() + self.window
+        with self.lock:
+            while wait_window:
+                queue = self.pending[key]
+                remaining = deadline - time.time()
+                if remaining<=0 or len(queue)>=self.max_batch or sum([req.num_tokens for req in queue])>=self.token_budget:
+                    break
+                self.lock.wait(remaining)
+
+            # Voice replicas and worker pools can run several batches at once
+            parallel_slots = getattr(model, "parallel_slots", 1)
+            if key not in self.run_locks.keys() or self.run_locks[key][0]!=parallel_slots:
+                self.run_locks[key] = [parallel_slots, threading.BoundedSemaphore(parallel_slots)]
+            run_lock = self.run_locks[key][1]
+
+        # Only one batch runs at a time per model instance. Requests arriving in the meantime keep joining the queue
+        with run_lock:
+            with self.lock:
+                queue = self.pending[key]
+                batch = [queue.pop(0)]
+                num_tokens = batch[0].num_tokens
+                while len(queue) and len(batch)<self.max_batch and num_tokens+queue[0].num_tokens<=self.token_budget:
+                    num_tokens += queue[0].num_tokens
+                    batch.append(queue.pop(0))
+
+                if len(queue):
+                    queue[0].is_leader = True
+                    queue[0].event.set()
+                else:
+                    del self.pending[key]
+
+            self._run_batch(model, plugin_manager, batch)
+
+
+    def _run_batch (self, model, plugin_manager, batch):
+        with inference_lock(model):
+            self._run_batch_locked(model, plugin_manager, batch)
+
+    def _run_batch_locked (self, model, plugin_manager, batch):
+        try:
+            if len(batch)==1:
+                try:
+                    batch[0].response = model.infer(plugin_manager, **batch[0].infer_kwargs)
+                except Exception as e:
+                    batch[0].error = e
+            else:
+                self.logger.info(f'[SynthScheduler] Coalescing {len(batch)} /synthesize requests')
+                try:
+                    responses = model.infer_coalesced(plugin_manager, [req.infer_kwargs for req in batch])
+                    for req, response in zip(batch, responses):
+                        req.response = response
+                except:
+                    # Fall back to running them one by one, so each caller gets its own response or error
+                    self.logger.info(traceback.format_exc())
+                    self.logger.info("[SynthScheduler] Coalesced batch failed; running the requests individually")
+                    for req in batch:
+                        try:
+                            req.response = model.infer(plugin_manager, **req.infer_kwargs)
+                        except Exception as e:
+                            req.error = e
+        finally:
+            for req in batch:
+                req.is_done = True
+                req.event.set()
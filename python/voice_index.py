@@ -0,0 +1,105 @@
+import os
+import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class VoiceIndex(object):
+    """
+    In-memory index of the installed voices' metadata, for /getAvailableVoices, keyed by each voice JSON's path and
+    mtime. Each game directory is only re-listed (for voices added or removed) when its own mtime changes, while the
+    JSONs already indexed are stat'ed on every call, and parsed again if their mtime has changed (eg edited in place).
+    The first build parses all the JSONs in parallel, with a thread pool.
+    """
+
+    def __init__(self, logger, workers=8):
+        super(VoiceIndex, self).__init__()
+
+        self.logger = logger
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.dirs = {} # dir path -> {"mtime": float, "files": {fname: (mtime, entry)}}
+
+
+    def get_voices (self, modelsPaths):
+
+        with self.lock:
+            to_parse = [] # [the dir's files dict, dir path, fname, file mtime]
+            num_listed = 0
+            for gameId in modelsPaths.keys():
+                dir_path = modelsPaths[gameId]
+                try:
+                    dir_mtime = os.stat(dir_path).st_mtime
+                except OSError:
+                    dir_mtime = None
+                # Voices added or removed change the directory's mtime; JSONs edited in place only change their own
+                if dir_path not in self.dirs.keys() or self.dirs[dir_path]["mtime"]!=dir_mtime:
+                    self._list_dir(dir_path, dir_mtime, to_parse)
+                    num_listed += 1
+                else:
+                    self._check_files(dir_path, to_parse)
+
+            if len(to_parse):
+                self.logger.info(f'VoiceIndex: Parsing {len(to_parse)} voice JSONs ({num_listed} directories re-listed)')
+                with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(to_parse)))) as pool:
+                    entries = list(pool.map(self._read_voice_json, [f'{dir_path}/{fname}' for _, dir_path, fname, _ in to_parse]))
+                for [files, _, fname, file_mtime], entry in zip(to_parse, entries):
+                    files[fname] = (file_mtime, entry)
+
+            models = {}
+            for gameId in modelsPaths.keys():
+                files = self.dirs[modelsPaths[gameId]]["files"]
+                models[gameId] = [files[fname][1] for fname in sorted(files.keys()) if files[fname][1] is not None]
+        return models
+
+
+    # List a (new or changed) directory's voice JSONs, keeping the entries of those whose mtime hasn't changed
+    def _list_dir (self, dir_path, dir_mtime, to_parse):
+        old_files = self.dirs[dir_path]["files"] if dir_path in self.dirs.keys() else {}
+        files = {}
+        if dir_mtime is not None:
+            for dir_entry in os.scandir(dir_path):
+                if not dir_entry.name.endswith(".json"):
+                    continue
+                try:
+                    file_mtime = dir_entry.stat().st_mtime
+                except OSError:
+                    continue
+                if dir_entry.name in old_files.keys() and old_files[dir_entry.name][0]==file_mtime:
+                    files[dir_entry.name] = old_files[dir_entry.name]
+                else:
+                    to_parse.append([files, dir_path, dir_entry.name, file_mtime])
+        self.dirs[dir_path] = {"mtime": dir_mtime, "files": files}
+
+    # Re-stat the already indexed JSONs of an unchanged directory, for the ones edited in place
+    def _check_files (self, dir_path, to_parse):
+        files = self.dirs[dir_path]["files"]
+        for fname in list(files.keys()):
+            try:
+                file_mtime = os.stat(f'{dir_path}/{fname}').st_mtime
+            except OSError:
+                del files[fname]
+                continue
+            if files[fname][0]!=file_mtime:
+                to_parse.append([files, dir_path, fname, file_mtime])
+
+
+    def _read_voice_json (self, json_path):
+        try:
+            with open(json_path, "r") as f:
+                metadata = json.loads(f.read())
+
+            return {
+                "modelType": metadata["modelType"],
+                "author": metadata["author"] if "author" in metadata else "",
+                "emb_size": metadata["emb_size"] if "emb_size" in metadata else 1,
+                "voiceId": metadata["games"][0]["voiceId"],
+                "voiceName": metadata["games"][0]["voiceName"],
+                "gender": metadata["games"][0]["gender"] if "gender" in metadata["games"][0] else "other",
+                "emb_i": metadata["games"][0]["emb_i"] if "emb_i" in metadata["games"][0] else 0
+            }
+        except:
+            self.logger.info(f'VoiceIndex: Failed to read {json_path}')
+            self.logger.info(traceback.format_exc())
+            return None
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import traceback
+
+import numpy as np
+import scipy.io.wavfile
+import torch
+
+from python.models_manager import REPLICABLE_MODELS
+
+DEFAULT_WARMUP_TEXT = "The quick brown fox jumps over the lazy dog."
+
+
+class WarmupItem(object):
+    def __init__(self, name):
+        super(WarmupItem, self).__init__()
+        self.name = name
+        self.status = "pending" # pending, running, ready, failed
+        self.seconds = None
+        self.error = None
+
+    def to_dict (self):
+        return {"name": self.name, "status": self.status, "seconds": self.seconds, "error": self.error}
+
+
+class WarmupManager(object):
+    """
+    Loads the voices and auxiliary models listed in the warm-up manifest at start-up, and runs a short dummy inference
+    through each, so that the first real request doesn't pay for the checkpoint load, the lazily built text
+    pre-processors and dictionaries, or the first-run kernel set-up. GET /ready reports 200 only once this has finished.
+
+    The manifest is a JSON file:
+    {
+        "text": "Optional line to synthesize",
+        "voices": [{"modelType": "xVAPitch", "model": "path/to/voice (no .pt)", "base_lang": "en", "languages": ["en", "de"],
+                    "model_speakers": null, "instance_index": 0, "vocoder": "qnd"}],
+        "models": ["nuwave2", "deepfilternet2", "speaker_rep"]
+    }
+    """
+
+    def __init__(self, logger, PROD, models_manager, plugin_manager, manifest_path=None, worker_pool=None):
+        super(WarmupManager, self).__init__()
+
+        self.logger = logger
+        self.PROD = PROD
+        self.models_manager = models_manager
+        self.plugin_manager = plugin_manager
+        self.worker_pool = worker_pool
+        self.manifest_path = manifest_path
+        self.manifest = None
+
+        self.lock = threading.Lock()
+        self.items = []
+        self.finished = False
+        self.started = None
+        self.seconds = None
+        self.thread = None
+
+        if manifest_path and os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, encoding="utf8") as f:
+                    self.manifest = json.load(f)
+            except:
+                self.logger.info(f'[Warmup] Failed to read the warm-up manifest: {manifest_path}')
+                self.logger.info(traceback.format_exc())
+                failed = WarmupItem("manifest")
+                failed.status = "failed"
+                failed.error = traceback.format_exc()
+                self.items.append(failed)
+
+        if self.manifest is not None:
+            for voice in self.manifest["voices"] if "voices" in self.manifest else []:
+                for lang in self._voice_languages(voice):
+                    self.items.append(WarmupItem(f'{voice["modelType"]}:{os.path.basename(voice["model"])}:{lang}'))
+            for model_key in self.manifest["models"] if "models" in self.manifest else []:
+                self.items.append(WarmupItem(model_key))
+
+
+    def start (self):
+        self.started = time.time()
+        if self.manifest is None:
+            self._finish()
+            return
+        self.thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+        self.thread.start()
+
+    def is_ready (self):
+        with self.lock:
+            return self.finished and all([item.status=="ready" for item in self.items])
+
+    def status (self):
+        with self.lock:
+            return {
+                "status": ("ready" if all([item.status=="ready" for item in self.items]) else "failed") if self.finished else "warming",
+                "manifest": self.manifest_path if self.manifest is not None else None,
+                "seconds": self.seconds if self.finished else (time.time()-self.started if self.started is not None else 0),
+                "items": [item.to_dict() for item in self.items],
+            }
+
+
+    def _finish (self):
+        with self.lock:
+            self.finished = True
+            self.seconds = time.time()-self.started
+        failed = len([item for item in self.items if item.status=="failed"])
+        self.logger.info(f'[Warmup] Finished in {self.seconds:.2f}s. {len(self.items)-failed}/{len(self.items)} items warm')
+
+    def _run (self):
+        text = self.manifest["text"] if "text" in self.manifest else DEFAULT_WARMUP_TEXT
+        item_i = 0
+        for voice in self.manifest["voices"] if "voices" in self.manifest else []:
+            for lang in self._voice_languages(voice):
+                self._run_item(self.items[item_i], self._warm_voice, voice, lang, text, first=lang==self._voice_languages(voice)[0])
+                item_i += 1
+        for model_key in self.manifest["models"] if "models" in self.manifest else []:
+            self._run_item(self.items[item_i], self._warm_aux_model, model_key)
+            item_i += 1
+        self._finish()
+
+    def _run_item (self, item, fn, *args, **kwargs):
+        item.status = "running"
+        start = time.time()
+        try:
+            with torch.no_grad():
+                fn(*args, **kwargs)
+            item.status = "ready"
+        except:
+            self.logger.info(f'[Warmup] Failed to warm up {item.name}')
+            self.logger.info(traceback.format_exc())
+            item.error = traceback.format_exc()
+            item.status = "failed"
+        item.seconds = time.time()-start
+        self.logger.info(f'[Warmup] {item.name}: {item.status} ({item.seconds:.2f}s)')
+
+
+    def _voice_languages (self, voice):
+        if "languages" in voice and len(voice["languages"]):
+            return voice["languages"]
+        return [voice["base_lang"] if "base_lang" in voice and voice["base_lang"] else "en"]
+
+    def _warm_voice (self, voice, lang, text, first=True):
+        model_key = voice["modelType"].lower().replace(".", "_").replace(" ", "")
+        instance_index = voice["instance_index"] if "instance_index" in voice else 0
+        n_speakers = voice["model_speakers"] if "model_speakers" in voice else None
+        base_lang = voice["base_lang"] if "base_lang" in voice else None
+        ckpt_path = voice["model"]+".pt"
+
+        # With the worker pool, the voices are only loaded in the workers
+        if first and self.worker_pool is None:
+            load_response = self.models_manager.load_model(model_key, ckpt_path, instance_index=instance_index, n_speakers=n_speakers, base_lang=base_lang)
+            if load_response=="ENOENT":
+                raise FileNotFoundError(ckpt_path)
+            if model_key=="fastpitch1_1" or model_key=="xvapitch":
+                self.models_manager.models_bank[model_key][instance_index].init_arpabet_dicts()
+
+        # Same arguments as a /synthesize request with no editor values
+        infer_kwargs = {"text": text, "vocoder": voice["vocoder"] if "vocoder" in voice else "qnd", "speaker_i": None, "pace": 1.0, \
+            "editor_data": [None, None, None, None, None, None, None, None], "base_lang": lang, "base_emb": "", "useSR": False, "useCleanup": False}
+
+        # Every copy of the voice that requests may land on: the instance, its replicas, or each inference worker
+        instances = []
+        if self.worker_pool is None:
+            instances = [self.models_manager.models_bank[model_key][instance_index]]
+            if model_key in REPLICABLE_MODELS and (model_key, instance_index) in self.models_manager.replicas_bank.keys():
+                instances += [replica for replica in self.models_manager.replicas_bank[(model_key, instance_index)] if replica.ckpt_path==ckpt_path]
+        for model in instances:
+            with model.infer_lock:
+                self._dummy_infer(lambda out_path: model.infer(self.plugin_manager, out_path=out_path, **infer_kwargs))
+
+        if self.worker_pool is not None:
+            from python.worker_pool import make_voice_spec
+            voice_spec = make_voice_spec(model_key, ckpt_path, n_speakers=n_speakers, base_lang=base_lang)
+            for worker in self.worker_pool.workers:
+                self._dummy_infer(lambda out_path: self.worker_pool.call(voice_spec, "infer", {"vocoder": infer_kwargs["vocoder"], \
+                    "infer_kwargs": dict(infer_kwargs, out_path=out_path)}, worker=worker))
+
+    def _dummy_infer (self, infer_fn):
+        out_path = f'{tempfile.gettempdir()}/xva_warmup_{threading.get_ident()}.wav'
+        try:
+            response = infer_fn(out_path)
+            if isinstance(response, str) and response.startswith("ERR"):
+                raise RuntimeError(response)
+        finally:
+            if os.path.exists(out_path):
+                os.remove(out_path)
+
+
+    def _warm_aux_model (self, model_key):
+        model_key = model_key.lower()
+        self.models_manager.init_model(model_key)
+        app_path = "./resources/app" if self.PROD else "."
+
+        # One second of a quiet tone, as the dummy input
+        sr = 22050
+        wav = (0.1*np.sin(2*np.pi*220*np.arange(sr)/sr)).astype(np.float32)
+
+        if model_key=="nuwave2":
+            model = self.models_manager.models("nuwave2")
+            with model.infer_lock:
+                model.sr_wav(wav)
+
+        elif model_key=="deepfilternet2":
+            model = self.models_manager.models("deepfilternet2")
+            with model.infer_lock:
+                model.cleanup_wav(np.interp(np.arange(model.df_state.sr())*sr/model.df_state.sr(), np.arange(sr), wav).astype(np.float32))
+
+        elif model_key=="speaker_rep":
+            if self.models_manager.load_model("speaker_rep", f'{app_path}/python/xvapitch/speaker_rep/speaker_rep.pt')=="ENOENT":
+                raise FileNotFoundError("speaker_rep.pt")
+            model = self.models_manager.models("speaker_rep")
+            wav_path = f'{tempfile.gettempdir()}/xva_warmup_speaker_rep.wav'
+            scipy.io.wavfile.write(wav_path, sr, (wav*32767).astype(np.int16))
+            try:
+                with model.infer_lock:
+                    model.compute_embedding(wav_path)
+            finally:
+                os.remove(wav_path)
+
+        else:
+            raise ValueError(f'No warm-up defined for model: {model_key}')
@@ -0,0 +1,88 @@
+import hashlib
+import threading
+import weakref
+
+import torch
+
+
+class WeightStore(object):
+    """
+    Content-addressed pool of checkpoint tensors. Most voices are fine-tuned from the same base model, and tensors
+    which came through the fine-tuning unchanged (frozen layers, the text encoder, sometimes the whole decoder) are
+    byte-identical across them. intern() hashes each tensor of a freshly loaded checkpoint and swaps it for the copy
+    already in memory, if there is one. Entries are only weakly held: a tensor is dropped from the pool once no cached
+    checkpoint or model references it any more.
+    """
+
+    def __init__(self):
+        super(WeightStore, self).__init__()
+        self.lock = threading.Lock()
+        self.tensors = weakref.WeakValueDictionary() # (dtype, shape, digest) -> tensor
+        self.interned_bytes = 0 # Bytes saved by interning, since start-up
+
+    def _key (self, tensor):
+        tensor = tensor.detach().cpu().contiguous()
+        digest = hashlib.blake2b(tensor.numpy().reshape(-1).view("uint8") if tensor.numel() else b"", digest_size=16).hexdigest()
+        return (str(tensor.dtype), tuple(tensor.shape), digest)
+
+    def intern (self, ckpt):
+        if torch.is_tensor(ckpt):
+            if ckpt.device.type!="cpu" or ckpt.dtype==torch.bfloat16:
+                return ckpt
+            key = self._key(ckpt)
+            with self.lock:
+                pooled = self.tensors.get(key)
+                if pooled is not None:
+                    self.interned_bytes += ckpt.numel() * ckpt.element_size()
+                    return pooled
+                self.tensors[key] = ckpt
+                return ckpt
+        # In place, to keep the state dicts' own attributes (their _metadata)
+        if isinstance(ckpt, dict):
+            for key in list(ckpt.keys()):
+                ckpt[key] = self.intern(ckpt[key])
+        return ckpt
+
+    def report (self):
+        with self.lock:
+            tensors = list(self.tensors.values())
+        return {
+            "pooled_tensors": len(tensors),
+            "pooled_mb": round(sum([tensor.numel() * tensor.element_size() for tensor in tensors])/1024/1024, 1),
+            "deduplicated_mb": round(self.interned_bytes/1024/1024, 1),
+        }
+
+
+# load_state_dict() copies the weights into the model's own tensors. On the CPU, point the model's parameters and
+# buffers at the checkpoint's tensors instead (memory-mapped, or interned in the WeightStore), so that the copies are
+# freed, and the weights are shared with everything else using the same tensors. Returns the number of tensors shared
+def share_checkpoint_weights (model, ckpt):
+    module = model if isinstance(model, torch.nn.Module) else getattr(model, "model", None)
+    if not isinstance(module, torch.nn.Module):
+        return 0
+
+    mapped = {}
+    def collect (obj):
+        for key in obj.keys():
+            if torch.is_tensor(obj[key]):
+                mapped[key[len("module."):] if key.startswith("module.") else key] = obj[key]
+            elif isinstance(obj[key], dict):
+                collect(obj[key])
+    collect(ckpt)
+
+    shared = 0
+    for name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+        if name in mapped.keys() and tensor.device.type=="cpu" and tensor.dtype==mapped[name].dtype and tensor.shape==mapped[name].shape:
+            tensor.data = mapped[name]
+            shared += 1
+    model.shares_weights = shared>0
+    return shared
+
+# Give a model private copies of any weights it shares, before another checkpoint gets loaded (in place) into it
+def unshare_weights (model):
+    if not getattr(model, "shares_weights", False):
+        return
+    module = model if isinstance(model, torch.nn.Module) else getattr(model, "model", None)
+    for _, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+        tensor.data = tensor.data.clone()
+    model.shares_weights = False
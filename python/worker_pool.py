@@ -0,0 +1,288 @@
+import os
+import time
+import logging
+import threading
+import traceback
+import multiprocessing
+from logging.handlers import RotatingFileHandler
+
+
+class WorkerError(Exception):
+    pass
+
+
+def make_voice_spec (model_key, ckpt_path, n_speakers=None, base_lang=None, backend=None):
+    return {"model_key": model_key.lower().replace(".", "_").replace(" ", ""), "ckpt_path": ckpt_path, "n_speakers": n_speakers, "base_lang": base_lang, "backend": backend}
+
+
+# ======================== Worker process side
+
+def _setup_worker_logger (worker_index, log_path):
+    logger = logging.getLogger(f'serverLog_worker{worker_index}')
+    logger.setLevel(logging.DEBUG)
+    fh = RotatingFileHandler(log_path, maxBytes=2*1024*1024, backupCount=2)
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    logger.addHandler(fh)
+
+    # Same interface as the main server logger, which the plugins expect
+    logger.orig_info = logger.info
+    def prefixed_log (msg):
+        logger.info(f'{logger.logging_prefix}{msg}')
+    def set_logger_prefix (prefix=""):
+        if len(prefix):
+            logger.logging_prefix = f'[{prefix}]: '
+            logger.log = prefixed_log
+        else:
+            logger.log = logger.orig_info
+    logger.set_logger_prefix = set_logger_prefix
+    logger.set_logger_prefix("")
+    return logger
+
+
+def _worker_main (worker_index, conn, PROD, APP_VERSION, CPU_ONLY, num_threads, log_path, checkpoint_cache_mb=0, weight_dedup=False, shared_weights_dir=None, cpu_int8=False, compiled_cache_dir=None, onnx_backend=False, decode_chunk_frames=0):
+    logger = _setup_worker_logger(worker_index, log_path)
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass
+
+        from python.models_manager import ModelsManager
+        from python.plugins_manager import PluginManager
+        models_manager = ModelsManager(logger, PROD, device="cpu", checkpoint_cache_mb=checkpoint_cache_mb, weight_dedup=weight_dedup, \
+            shared_weights_dir=shared_weights_dir, cpu_int8=cpu_int8, compiled_cache_dir=compiled_cache_dir, onnx_backend=onnx_backend, \
+            decode_chunk_frames=decode_chunk_frames)
+        plugin_manager = PluginManager(APP_VERSION, PROD, CPU_ONLY, logger)
+        logger.info(f'Worker {worker_index} ready, with {num_threads} torch threads')
+        conn.send(["ready", None])
+    except:
+        logger.info(traceback.format_exc())
+        conn.send(["error", traceback.format_exc()])
+        return
+
+    while True:
+        try:
+            method, voice, kwargs = conn.recv()
+        except (EOFError, OSError):
+            break
+        if method=="stop":
+            break
+        try:
+            with torch.no_grad():
+                result = _worker_handle(logger, models_manager, plugin_manager, method, voice, kwargs)
+            conn.send(["ok", result])
+        except:
+            logger.info(traceback.format_exc())
+            conn.send(["error", traceback.format_exc()])
+
+
+def _worker_handle (logger, models_manager, plugin_manager, method, voice, kwargs):
+
+    if method=="refresh_arpabet_dicts":
+        for model_key in ["fastpitch1_1", "xvapitch"]:
+            if model_key in models_manager.models_bank.keys():
+                models_manager.models_bank[model_key][0].refresh_arpabet_dicts()
+        return ""
+
+    if "vocoder_path" in kwargs:
+        models_manager.load_model(kwargs["vocoder"], kwargs["vocoder_path"])
+    if "backend" in voice and voice["backend"] is not None:
+        models_manager.voice_backends[voice["ckpt_path"]] = voice["backend"]
+    load_response = models_manager.load_model(voice["model_key"], voice["ckpt_path"], n_speakers=voice["n_speakers"], base_lang=voice["base_lang"])
+    if voice["model_key"] in ["fastpitch1_1", "xvapitch"]:
+        models_manager.models_bank[voice["model_key"]][0].init_arpabet_dicts()
+    if method=="load":
+        return load_response
+
+    if "pluginsContext" in kwargs:
+        plugin_manager.set_context(kwargs["pluginsContext"])
+    model = models_manager.models(voice["model_key"])
+
+    if method=="infer":
+        return model.infer(plugin_manager, **kwargs["infer_kwargs"])
+    if method=="infer_coalesced":
+        return model.infer_coalesced(plugin_manager, kwargs["requests"])
+    if method=="infer_batch":
+        return model.infer_batch(plugin_manager, kwargs["linesBatch"], outputJSON=kwargs["outputJSON"], vocoder=kwargs["vocoder"], \
+            speaker_i=kwargs["speaker_i"], useSR=kwargs["useSR"], useCleanup=kwargs["useCleanup"])
+    raise WorkerError(f'Unknown worker method: {method}')
+
+
+# ======================== Server (router) side
+
+class WorkerHandle(object):
+    def __init__(self, worker_index):
+        super(WorkerHandle, self).__init__()
+        self.worker_index = worker_index
+        self.process = None
+        self.conn = None
+        self.is_ready = False
+        self.busy = False
+        self.voices = {} # model_key -> ckpt_path loaded in the worker
+        self.last_used = 0
+
+
+class WorkerPool(object):
+    """
+    N inference worker processes, each with its own ModelsManager (and plugins), so that inference isn't bottlenecked
+    by the one server interpreter. Requests are routed to a worker which already has their voice loaded if one is
+    free, otherwise to an idle worker, which then loads the voice. The torch CPU threads are split between the workers.
+    With a shared_weights_dir, the workers map the checkpoints converted there by the server (see ModelsManager), so
+    a voice's weights are in memory once, however many workers have it loaded.
+    """
+
+    def __init__(self, logger, PROD, APP_VERSION, CPU_ONLY, num_workers, threads_per_worker=0, log_dir=".", checkpoint_cache_mb=0, weight_dedup=False, shared_weights_dir=None, cpu_int8=False, compiled_cache_dir=None, onnx_backend=False, decode_chunk_frames=0):
+        super(WorkerPool, self).__init__()
+
+        self.logger = logger
+        self.PROD = PROD
+        self.APP_VERSION = APP_VERSION
+        self.CPU_ONLY = CPU_ONLY
+        self.num_threads = threads_per_worker if threads_per_worker>0 else max(1, (os.cpu_count() or 1)//num_workers)
+        self.log_dir = log_dir
+        self.checkpoint_cache_mb = checkpoint_cache_mb
+        self.weight_dedup = weight_dedup
+        self.shared_weights_dir = shared_weights_dir
+        self.cpu_int8 = cpu_int8
+        self.compiled_cache_dir = compiled_cache_dir
+        self.onnx_backend = onnx_backend
+        self.decode_chunk_frames = decode_chunk_frames
+
+        self.mp_context = multiprocessing.get_context("spawn")
+        self.lock = threading.Condition()
+        self.workers = [WorkerHandle(wi) for wi in range(num_workers)]
+
+    def start (self):
+        for worker in self.workers:
+            self._spawn(worker)
+        self.logger.info(f'[WorkerPool] Started {len(self.workers)} workers, with {self.num_threads} torch threads each')
+
+    def stop (self):
+        for worker in self.workers:
+            try:
+                worker.conn.send(["stop", None, None])
+            except:
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    def _spawn (self, worker):
+        conn, child_conn = self.mp_context.Pipe()
+        log_path = f'{self.log_dir}/server_worker{worker.worker_index}.log'
+        worker.process = self.mp_context.Process(target=_worker_main, args=(worker.worker_index, child_conn, self.PROD, self.APP_VERSION, self.CPU_ONLY, self.num_threads, log_path, self.checkpoint_cache_mb, self.weight_dedup, self.shared_weights_dir, self.cpu_int8, self.compiled_cache_dir, self.onnx_backend, self.decode_chunk_frames), daemon=True)
+        worker.process.start()
+        worker.conn = conn
+        worker.is_ready = False
+        worker.voices = {}
+
+
+    def call (self, voice, method, kwargs, worker=None):
+        worker = self._acquire(voice, worker)
+        try:
+            if not worker.is_ready:
+                status, result = worker.conn.recv()
+                if status=="error":
+                    raise WorkerError(f'Worker {worker.worker_index} failed to start:\n{result}')
+                worker.is_ready = True
+
+            worker.conn.send([method, voice, kwargs])
+            status, result = worker.conn.recv()
+        except (EOFError, OSError):
+            self.logger.info(f'[WorkerPool] Worker {worker.worker_index} died. Restarting it')
+            self.logger.info(traceback.format_exc())
+            self._spawn(worker)
+            self._release(worker, None)
+            raise WorkerError(f'Worker {worker.worker_index} died while running {method}')
+        except:
+            self._release(worker, None)
+            raise
+
+        self._release(worker, voice if status=="ok" else None)
+        if status=="error":
+            raise WorkerError(result)
+        return result
+
+    # Run something on every worker, eg refreshing the ARPAbet dictionaries
+    def broadcast (self, method, kwargs):
+        for worker in self.workers:
+            self.call(None, method, kwargs, worker=worker)
+
+
+    def _acquire (self, voice, worker=None):
+        with self.lock:
+            while True:
+                if worker is not None:
+                    if not worker.busy:
+                        break
+                else:
+                    worker = self._pick_worker(voice)
+                    if worker is not None:
+                        break
+                self.lock.wait()
+            worker.busy = True
+            worker.last_used = time.time()
+            return worker
+
+    def _pick_worker (self, voice):
+        idle = [worker for worker in self.workers if not worker.busy]
+        if not len(idle):
+            return None
+        if voice is None:
+            return idle[0]
+
+        # Voice affinity first, then a worker with no voice of this type yet, and then the least recently used one
+        model_key, ckpt_path = voice["model_key"], voice["ckpt_path"]
+        affine = [worker for worker in idle if model_key in worker.voices.keys() and worker.voices[model_key]==ckpt_path]
+        if len(affine):
+            return affine[0]
+        empty = [worker for worker in idle if model_key not in worker.voices.keys()]
+        if len(empty):
+            return empty[0]
+        return sorted(idle, key=lambda worker: worker.last_used)[0]
+
+    def _release (self, worker, voice):
+        with self.lock:
+            if voice is not None:
+                worker.voices[voice["model_key"]] = voice["ckpt_path"]
+            worker.busy = False
+            self.lock.notify_all()
+
+
+class WorkerVoice(object):
+    """
+    Stands in for a loaded voice model object (as returned by ModelsManager.models()), running its inference on the
+    worker pool. The plugin_manager argument is kept for the same signatures; the workers run their own plugins,
+    with the context of the request forwarded to them
+    """
+
+    def __init__(self, worker_pool, voice, vocoder_path=None):
+        super(WorkerVoice, self).__init__()
+        self.worker_pool = worker_pool
+        self.voice = voice
+        self.vocoder_path = vocoder_path
+        self.parallel_slots = len(worker_pool.workers)
+
+    def _kwargs (self, plugin_manager, **kwargs):
+        if plugin_manager is not None and hasattr(plugin_manager, "context"):
+            kwargs["pluginsContext"] = plugin_manager.context
+        if self.vocoder_path is not None:
+            kwargs["vocoder_path"] = self.vocoder_path
+        return kwargs
+
+    def load (self):
+        return self.worker_pool.call(self.voice, "load", {})
+
+    def infer (self, plugin_manager, **infer_kwargs):
+        return self.worker_pool.call(self.voice, "infer", self._kwargs(plugin_manager, vocoder=infer_kwargs["vocoder"], infer_kwargs=infer_kwargs))
+
+    def infer_coalesced (self, plugin_manager, requests):
+        return self.worker_pool.call(self.voice, "infer_coalesced", self._kwargs(plugin_manager, vocoder=requests[0]["vocoder"], requests=requests))
+
+    def infer_batch (self, plugin_manager, linesBatch, outputJSON, vocoder, speaker_i, useSR=False, useCleanup=False):
+        return self.worker_pool.call(self.voice, "infer_batch", self._kwargs(plugin_manager, vocoder=vocoder, linesBatch=linesBatch, \
+            outputJSON=outputJSON, speaker_i=speaker_i, useSR=useSR, useCleanup=useCleanup))
@@ -0,0 +1,122 @@
+import re
+
+import numpy as np
+
+# Words ending in a full stop which don't end the sentence
+ABBREVIATIONS = ["mr", "mrs", "ms", "dr", "st", "jr", "sr", "vs", "prof", "e.g", "i.e"]
+SENTENCE_ENDS = ".!?"
+CLAUSE_ENDS = ",;:"
+# Carried over into the end of a sentence or clause: the rest of "?!" or "...", closing quotes and brackets
+_TRAILING_CHARS = ".!?\"')"
+
+
+# The points at which the text can be split: [index just past the boundary, "sentence" or "clause", the \lang[..][
+# markup still open there]. Nothing inside an {ARPAbet} block counts as punctuation
+def _split_points (text):
+    points = []
+    langs = []
+    in_arpabet = False
+    i = 0
+    while i<len(text):
+        if not in_arpabet and text.startswith("\\lang[", i) and text.find("][", i)!=-1:
+            end = text.find("][", i)
+            langs.append(text[i+len("\\lang["):end])
+            i = end+2
+            continue
+
+        char = text[i]
+        if char=="{":
+            in_arpabet = True
+        elif char=="}":
+            in_arpabet = False
+        elif char=="]" and not in_arpabet and len(langs):
+            langs.pop()
+        elif not in_arpabet and char in SENTENCE_ENDS+CLAUSE_ENDS:
+            j = i+1
+            while j<len(text) and (text[j] in _TRAILING_CHARS or (text[j]=="]" and len(langs))):
+                if text[j]=="]":
+                    langs.pop()
+                j += 1
+            word = re.split(r'[\s\[\]{}"(]', text[:i])[-1].lower()
+            is_abbreviation = text[i:j]=="." and word in ABBREVIATIONS
+            if (j==len(text) or text[j].isspace()) and not is_abbreviation:
+                kind = "sentence" if any([c in SENTENCE_ENDS for c in text[i:j]]) else "clause"
+                points.append([j, kind, list(langs)])
+            i = j
+            continue
+        i += 1
+    return points
+
+
+# Split a long prompt into segments of up to about max_chars, at sentence ends where possible, and at clause ends
+# (commas, semicolons, colons) within sentences that are too long on their own. Sentences are packed together up to
+# max_chars. Any \lang[..][ markup open across a split is closed at the end of the segment, and re-opened at the start
+# of the next one, so each segment is a valid prompt by itself. Returns a list of [segment text, the kind of break
+# after it: "sentence", "clause", or "end" for the last one]
+def split_long_text (text, max_chars=200):
+    text = text.strip()
+    pieces = [] # [start, end, kind, langs open at the start, langs open at the end]
+    start = 0
+    langs = []
+    for end, kind, end_langs in _split_points(text):
+        if end<len(text):
+            pieces.append([start, end, kind, langs, end_langs])
+            start = end
+            langs = end_langs
+    pieces.append([start, len(text), "end", langs, []])
+
+    # Sentences short enough to be packed whole, or else their clauses
+    units = []
+    sentence = []
+    for piece in pieces:
+        sentence.append(piece)
+        if piece[2]!="clause":
+            if sentence[-1][1]-sentence[0][0]<=max_chars or len(sentence)==1:
+                units.append([sentence[0][0], sentence[-1][1], sentence[-1][2], sentence[0][3], sentence[-1][4]])
+            else:
+                units += sentence
+            sentence = []
+
+    segments = []
+    current = None
+    for unit in units:
+        if current is not None and unit[1]-current[0]<=max_chars:
+            current = [current[0], unit[1], unit[2], current[3], unit[4]]
+            continue
+        if current is not None:
+            segments.append(current)
+        current = unit
+    segments.append(current)
+
+    out = []
+    for start, end, kind, start_langs, end_langs in segments:
+        segment = text[start:end].strip()
+        # Nothing to say (eg just closing markup); the break is kept on the segment before
+        if not re.search(r'\w', segment):
+            if len(out):
+                out[-1][1] = kind
+            continue
+        segment = "".join([f'\\lang[{lang}][' for lang in start_langs]) + segment + "]"*len(end_langs)
+        out.append([segment, kind])
+    return out
+
+
+# Join the segments' waveforms, with pauses[i] samples of silence after segment i (one fewer pause than segments).
+# The segments are faded in and out over crossfade samples at the joins, and overlapped where there's no pause
+def join_segments (wavs, pauses, crossfade=0):
+    joined = np.asarray(wavs[0], dtype=np.float32)
+    for wav, pause in zip(wavs[1:], pauses):
+        wav = np.asarray(wav, dtype=np.float32)
+        fade = min(crossfade, len(joined), len(wav))
+        if fade>0:
+            ramp = np.linspace(0, 1, fade, dtype=np.float32)
+            joined = joined.copy()
+            joined[-fade:] *= ramp[::-1]
+            wav = wav.copy()
+            wav[:fade] *= ramp
+        if pause>0:
+            joined = np.concatenate([joined, np.zeros(pause, dtype=np.float32), wav])
+        else:
+            overlap = joined[len(joined)-fade:] + wav[:fade]
+            joined = np.concatenate([joined[:len(joined)-fade], overlap, wav[fade:]])
+    return joined
@@ -1,6 +1,8 @@
 import os
 import re
 import json
+import time
+import traceback
 import codecs
 import ffmpeg
 import argparse
@@ -34,6 +36,25 @@ except ModuleNotFoundError:
             from text import ALL_SYMBOLS, get_text_preprocessor, lang_names
             from xvapitch_model import xVAPitch as xVAPitchModel
 
+try:
+    from python.metrics import stage_timer
+    from python.quantization import quantize_conv1d_layers, has_quantized_checkpoint, save_quantized_checkpoint, load_quantized_checkpoint
+    from python.compiled_inference import CompiledInference
+    from python.xvapitch.onnx_backend import OnnxVoice, onnx_model_dir
+    from python.xvapitch.long_form import split_long_text, join_segments
+except ModuleNotFoundError:
+    from resources.app.python.metrics import stage_timer
+    from resources.app.python.quantization import quantize_conv1d_layers, has_quantized_checkpoint, save_quantized_checkpoint, load_quantized_checkpoint
+    from resources.app.python.compiled_inference import CompiledInference
+    from resources.app.python.xvapitch.onnx_backend import OnnxVoice, onnx_model_dir
+    from resources.app.python.xvapitch.long_form import split_long_text, join_segments
+
+# The conv-heavy parts run in int8 in the CPU quantized mode: the text encoder's attention and FFN layers, the WN
+# layers of the flow and posterior encoder, and the HiFi-GAN decoder's convs (its resblocks included)
+QUANTIZED_SUBMODULES = ["text_encoder", "flow", "posterior_encoder", "waveform_decoder"]
+# Largest gain (over a 1.0 peak) applied to streamed audio, whose level is set from its first chunk
+STREAM_MAX_GAIN = 4
+
 
 class xVAPitch(object):
     def __init__(self, logger, PROD, device, models_manager):
@@ -44,6 +65,10 @@ class xVAPitch(object):
         self.models_manager = models_manager
         self.device = device
         self.ckpt_path = None
+        self.load_kwargs = {}
+        # Int8 quantized inference, when running on the CPU
+        self.quantize_int8 = getattr(models_manager, "cpu_int8", False)
+        self.quantized = False
 
         self.arpabet_dict = {}
 
@@ -65,11 +90,6 @@ class xVAPitch(object):
 
         self.base_lang = "en"
         self.init_model()
-        self.model.pitch_emb_values = self.pitch_emb_values.to(self.models_manager.device)
-        self.model.angry_emb_values = self.angry_emb_values.to(self.models_manager.device)
-        self.model.happy_emb_values = self.happy_emb_values.to(self.models_manager.device)
-        self.model.sad_emb_values = self.sad_emb_values.to(self.models_manager.device)
-        self.model.surprise_emb_values = self.surprise_emb_values.to(self.models_manager.device)
         self.isReady = True
 
 
@@ -88,11 +108,59 @@ class xVAPitch(object):
         self.model = xVAPitchModel(args).to(self.device)
         self.model.eval()
         self.model.device = self.device
+        self.model.metrics = self.models_manager.metrics
+        self.model.decode_chunk_frames = getattr(self.models_manager, "decode_chunk_frames", 0)
+        self.model.pitch_emb_values = self.pitch_emb_values.to(self.models_manager.device)
+        self.model.angry_emb_values = self.angry_emb_values.to(self.models_manager.device)
+        self.model.happy_emb_values = self.happy_emb_values.to(self.models_manager.device)
+        self.model.sad_emb_values = self.sad_emb_values.to(self.models_manager.device)
+        self.model.surprise_emb_values = self.surprise_emb_values.to(self.models_manager.device)
+        self.quantized = False
+        self._init_compiled()
+
+    # Traced TorchScript versions of the flow and waveform decoder, cached on disk per architecture (not with the
+    # int8 layers, which are already running as packed int8 kernels)
+    def _init_compiled (self):
+        compiled_cache_dir = getattr(self.models_manager, "compiled_cache_dir", None)
+        self.model.compiled = CompiledInference(self.logger, compiled_cache_dir, self.device) if compiled_cache_dir and not self.quantized else None
+
+    # ONNX Runtime sessions for the voice's exported text encoder (with the duration predictor), flow and decoder, when
+    # the ModelsManager picks that backend for it. They take over from the torch modules (and the compiled or int8 ones)
+    # for TTS; the torch weights are still loaded, for the rest (eg speech-to-speech)
+    def init_backend (self):
+        use_onnx = self.ckpt_path is not None and torch.device(self.device).type=="cpu" \
+            and hasattr(self.models_manager, "voice_backend") and self.models_manager.voice_backend("xvapitch", self.ckpt_path)=="onnx"
+        onnx_dir = onnx_model_dir(self.ckpt_path) if use_onnx else None
+        if self.model.onnx is not None and self.model.onnx.onnx_dir==onnx_dir:
+            return
+        self.model.onnx = None
+        if use_onnx:
+            try:
+                self.model.onnx = OnnxVoice(self.logger, onnx_dir, num_threads=torch.get_num_threads())
+                self.logger.info(f'Running {self.ckpt_path} on ONNX Runtime: {onnx_dir}')
+            except:
+                self.logger.info(f'Could not load the ONNX model of {self.ckpt_path}; running it in torch')
+                self.logger.info(traceback.format_exc())
 
     def load_state_dict (self, ckpt_path, ckpt, n_speakers=1, base_lang="en"):
 
         self.logger.info(f'load_state_dict base_lang: {base_lang}')
 
+        # The quantized layers can't take fp32 weights, so start again from a fresh fp32 model
+        if self.quantized:
+            self.init_model()
+        quantize = self.quantize_int8 and torch.device(self.device).type=="cpu"
+        # Quantized weights cached next to the checkpoint, from a previous load (the ModelsManager then skips reading the fp32 checkpoint)
+        quantized_ckpt = None
+        if quantize and has_quantized_checkpoint(ckpt_path):
+            try:
+                quantized_ckpt = load_quantized_checkpoint(ckpt_path)
+            except:
+                self.logger.info(traceback.format_exc())
+        if ckpt is None and quantized_ckpt is None:
+            ckpt = self.models_manager.read_checkpoint(ckpt_path)[0]
+        self.load_kwargs = {"n_speakers": n_speakers, "base_lang": base_lang}
+
         if base_lang not in self.lang_tp.keys():
             self.lang_tp[base_lang] = get_text_preprocessor(base_lang, self.base_dir, logger=self.logger)
 
@@ -105,6 +173,8 @@ class xVAPitch(object):
                 self.base_emb = data["games"][0]["base_speaker_emb"]
 
 
+        if quantized_ckpt is not None:
+            ckpt = quantized_ckpt
         if 'model' in ckpt:
             ckpt = ckpt['model']
 
@@ -114,9 +184,27 @@ class xVAPitch(object):
             num_languages = 50
             self.model.emb_l = nn.Embedding(num_languages, self.model.embedded_language_dim).to(self.models_manager.device)
 
-        self.model.load_state_dict(ckpt, strict=False)
-        self.model = self.model.float()
+        if quantized_ckpt is not None:
+            quantize_conv1d_layers(self.model, QUANTIZED_SUBMODULES)
+            self.model.load_state_dict(ckpt, strict=False)
+            self.quantized = True
+            self._init_compiled()
+        else:
+            self.model.load_state_dict(ckpt, strict=False)
+            self.model = self.model.float()
+            if quantize:
+                start = time.time()
+                num_layers = quantize_conv1d_layers(self.model, QUANTIZED_SUBMODULES)
+                self.quantized = True
+                self._init_compiled()
+                self.logger.info(f'Quantized {num_layers} layers to int8 in {time.time()-start:.2f}s')
+                try:
+                    save_quantized_checkpoint(self.model, ckpt_path)
+                except:
+                    self.logger.info(f'Could not cache the quantized weights of {ckpt_path}')
+                    self.logger.info(traceback.format_exc())
         self.model.eval()
+        self.init_backend()
 
 
     def init_arpabet_dicts (self):
@@ -175,41 +263,15 @@ class xVAPitch(object):
         wav = wav.squeeze().cpu().detach().numpy()
 
         wav_norm = wav * (32767 / max(0.01, np.max(np.abs(wav))))
-        if useCleanup:
-            ffmpeg_path = 'ffmpeg' if platform.system() == 'Linux' else f'{"./resources/app" if self.PROD else "."}/python/ffmpeg.exe'
-
-            if useSR:
-                scipy.io.wavfile.write(audio_out_path.replace(".wav", "_preSR.wav"), 22050, wav_norm.astype(np.int16))
-            else:
-                scipy.io.wavfile.write(audio_out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"), 22050, wav_norm.astype(np.int16))
-                stream = ffmpeg.input(audio_out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"))
-                ffmpeg_options = {"ar": 48000}
-                output_path = audio_out_path.replace(".wav", "_preCleanup.wav")
-                stream = ffmpeg.output(stream, output_path, **ffmpeg_options)
-                out, err = (ffmpeg.run(stream, cmd=ffmpeg_path, capture_stdout=True, capture_stderr=True, overwrite_output=True))
-                os.remove(audio_out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"))
-        else:
-            scipy.io.wavfile.write(audio_out_path.replace(".wav", "_preSR.wav") if useSR else audio_out_path, 22050, wav_norm.astype(np.int16))
-
-        if useSR:
-            self.models_manager.init_model("nuwave2")
-            self.models_manager.models("nuwave2").sr_audio(audio_out_path.replace(".wav", "_preSR.wav"), audio_out_path.replace(".wav", "_preCleanup.wav") if useCleanup else audio_out_path)
-
-        if useCleanup:
-            self.models_manager.init_model("deepfilternet2")
-            self.models_manager.models("deepfilternet2").cleanup_audio(audio_out_path.replace(".wav", "_preCleanup.wav"), audio_out_path)
+        self._save_output(wav_norm, audio_out_path, useSR=useSR, useCleanup=useCleanup)
 
         return
 
 
 
     def infer_batch(self, plugin_manager, linesBatch, outputJSON, vocoder, speaker_i, old_sequence=None, useSR=False, useCleanup=False):
-        print(f'Inferring batch of {len(linesBatch)} lines')
+        self.logger.info(f'Inferring batch of {len(linesBatch)} lines')
 
-        text_sequences = []
-        cleaned_text_sequences = []
-        lang_embs = []
-        speaker_embs = []
         # [sequence, pitch, duration, pace, tempFileLocation, outPath, outFolder, pitch_amp, base_lang, base_emb, vc_content, vc_style]
         vc_input = []
         tts_input = []
@@ -253,31 +315,7 @@ class xVAPitch(object):
                 wav = wav.squeeze().cpu().detach().numpy()
                 wav_norm = wav * (32767 / max(0.01, np.max(np.abs(wav))))
 
-                if useCleanup:
-                    ffmpeg_path = 'ffmpeg' if platform.system() == 'Linux' else f'{"./resources/app" if self.PROD else "."}/python/ffmpeg.exe'
-
-                    if useSR:
-                        scipy.io.wavfile.write(tts_input[ri][4].replace(".wav", "_preSR.wav"), 22050, wav_norm.astype(np.int16))
-                    else:
-                        scipy.io.wavfile.write(tts_input[ri][4].replace(".wav", "_preCleanupPreFFmpeg.wav"), 22050, wav_norm.astype(np.int16))
-                        stream = ffmpeg.input(tts_input[ri][4].replace(".wav", "_preCleanupPreFFmpeg.wav"))
-                        ffmpeg_options = {"ar": 48000}
-                        output_path = tts_input[ri][4].replace(".wav", "_preCleanup.wav")
-                        stream = ffmpeg.output(stream, output_path, **ffmpeg_options)
-                        out, err = (ffmpeg.run(stream, cmd=ffmpeg_path, capture_stdout=True, capture_stderr=True, overwrite_output=True))
-                        os.remove(tts_input[ri][4].replace(".wav", "_preCleanupPreFFmpeg.wav"))
-                else:
-                    scipy.io.wavfile.write(vc_input[ri][4].replace(".wav", "_preSR.wav") if useSR else vc_input[ri][4], 22050, wav_norm.astype(np.int16))
-
-                if useSR:
-                    self.models_manager.init_model("nuwave2")
-                    self.models_manager.models("nuwave2").sr_audio(vc_input[ri][4].replace(".wav", "_preSR.wav"), vc_input[ri][4].replace(".wav", "_preCleanup.wav") if useCleanup else vc_input[ri][4])
-                    os.remove(vc_input[ri][4].replace(".wav", "_preSR.wav"))
-
-                if useCleanup:
-                    self.models_manager.init_model("deepfilternet2")
-                    self.models_manager.models("deepfilternet2").cleanup_audio(vc_input[ri][4].replace(".wav", "_preCleanup.wav"), vc_input[ri][4])
-                    os.remove(vc_input[ri][4].replace(".wav", "_preCleanup.wav"))
+                self._save_output(wav_norm, vc_input[ri][4], useSR=useSR, useCleanup=useCleanup, remove_intermediate=True)
 
 
 
@@ -285,161 +323,308 @@ class xVAPitch(object):
         # ======= Handle TTS
         # ==================
         if len(tts_input):
-            lang_embs_sizes = []
+            lines = []
             for ri,record in enumerate(tts_input):
-
-                # Pre-process text
                 text = record[0].replace("/lang", "\\lang")
-                base_lang = record[-4]
-
                 self.logger.info(f'[infer_batch] text: {text}')
-                sequenceSplitByLanguage = self.preprocess_prompt_language(text, base_lang)
+                lines.append({
+                    "text": text,
+                    "base_lang": record[-4],
+                    "base_emb": record[-3],
+                    "pace": record[3],
+                    "pitch_amp": record[7],
+                })
 
-                # Make sure all languages' text processors are initialized
-                for subSequence in sequenceSplitByLanguage:
-                    langCode = list(subSequence.keys())[0]
-                    if langCode not in self.lang_tp.keys():
-                        self.lang_tp[langCode] = get_text_preprocessor(langCode, self.base_dir, logger=self.logger)
+            # Could pass indexes (and get them returned) to the tts inference fn
+            # Do the same to the vc infer fn
+            # Then marge them into their place in an output array?
 
-                try:
-                    pad_symb = len(ALL_SYMBOLS)-2
-                    all_sequence = []
-                    all_cleaned_text = []
-                    all_text = []
-                    all_lang_ids = []
-
-                    # Collapse same-language words into phrases, so that heteronyms can still be detected
-                    sequenceSplitByLanguage_grouped = []
-                    last_lang_group = None
-                    group = ""
-                    for ssi, subSequence in enumerate(sequenceSplitByLanguage):
-                        if list(subSequence.keys())[0]!=last_lang_group:
-                            if last_lang_group is not None:
-                                sequenceSplitByLanguage_grouped.append({last_lang_group: group})
-                                group = ""
-                            last_lang_group = list(subSequence.keys())[0]
-                        group += subSequence[last_lang_group]
-                    if len(group):
-                        sequenceSplitByLanguage_grouped.append({last_lang_group: group})
+            out = self.infer_tts_lines(plugin_manager, lines)
+            if isinstance(out, str):
+                return out
+            for line_out in out:
+                if isinstance(line_out, str):
+                    return line_out
 
+            for i,line_out in enumerate(out):
+                wav = line_out["wav"]
+                wav_norm = wav * (32767 / max(0.01, np.max(np.abs(wav))))
+                self._save_output(wav_norm, tts_input[i][4], useSR=useSR, useCleanup=useCleanup, remove_intermediate=True)
 
-                    for ssi, subSequence in enumerate(sequenceSplitByLanguage_grouped):
-                        langCode = list(subSequence.keys())[0]
-                        subSeq = subSequence[langCode]
-                        sequence, cleaned_text = self.lang_tp[langCode].text_to_sequence(subSeq)
+            if outputJSON:
+                for ri, record in enumerate(tts_input):
+                    # tts_input: sequence, pitch, duration, pace, tempFileLocation, outPath, outFolder
+                    output_fname = tts_input[ri][5].replace(".wav", ".json")
 
-                        if ssi<len(sequenceSplitByLanguage_grouped)-1:
-                            sequence = sequence + [pad_symb]
+                    containing_folder = "/".join(output_fname.split("/")[:-1])
+                    os.makedirs(containing_folder, exist_ok=True)
 
-                        all_sequence.append(sequence)
-                        all_cleaned_text += ("|"+cleaned_text) if len(all_cleaned_text) else cleaned_text
-                        if ssi<len(sequenceSplitByLanguage_grouped)-1:
-                            all_cleaned_text = all_cleaned_text + ["|<PAD>"]
-                        all_text.append(torch.LongTensor(sequence))
+                    with open(output_fname, "w+") as f:
+                        data = {}
+                        data["modelType"] = "xVAPitch"
+                        data["inputSequence"] = str(tts_input[ri][0])
+                        data["pacing"] = float(tts_input[ri][3])
+                        data["letters"] = [char.replace("{", "").replace("}", "") for char in list(out[ri]["cleaned_text"].split("|"))]
+                        data["currentVoice"] = self.ckpt_path.split("/")[-1].replace(".pt", "")
+                        data["resetEnergy"] = [float(1) for val in list(out[ri]["pitch_pred"])]
+                        data["resetPitch"] = [float(val) for val in list(out[ri]["pitch_pred"])]
+                        data["resetDurs"] = [float(val) for val in list(out[ri]["dur_pred"])]
+                        data["ampFlatCounter"] = 0
+                        data["pitchNew"] = data["resetPitch"]
+                        data["energyNew"] = data["resetEnergy"]
+                        data["dursNew"] = data["resetDurs"]
 
-                        language_id = self.language_id_mapping[langCode]
-                        all_lang_ids += [language_id for _ in range(len(sequence))]
+                        f.write(json.dumps(data, indent=4))
 
-                except ValueError as e:
-                    self.logger.info("====")
-                    self.logger.info(str(e))
-                    self.logger.info("====--")
-                    if "not in list" in str(e):
-                        symbol_not_in_list = str(e).split("is not in list")[0].split("ValueError:")[-1].replace("'", "").strip()
-                        return f'ERR: ARPABET_NOT_IN_LIST: {symbol_not_in_list}'
 
-                all_cleaned_text = "".join(all_cleaned_text)
-                text = torch.cat(all_text, dim=0)
 
+        return ""
 
-                cleaned_text_sequences.append(all_cleaned_text)
-                text = torch.LongTensor(text)
-                text_sequences.append(text)
 
-                lang_ids = torch.tensor(all_lang_ids).to(self.models_manager.device)
-                lang_embs.append(lang_ids)
-                lang_embs_sizes.append(lang_ids.shape[0])
+    # Run a batch of plain TTS lines (no editor data) through the model as a single padded forward pass.
+    # Each line is a dict with text, base_lang, base_emb (list of floats), pace and pitch_amp (can be None)
+    # Returns either an error string for the whole batch, or a list with, per line, the error string of its
+    # text pre-processing, or a dict with the float wav and its (unpadded) editor values
+    def infer_tts_lines (self, plugin_manager, lines):
 
-                speaker_embs.append(torch.tensor(tts_input[ri][-3]).unsqueeze(-1))
+        text_sequences = []
+        cleaned_text_sequences = []
+        lang_embs = []
+        speaker_embs = []
+        paces = []
+        pitch_amps = []
+        results = [None for _ in lines]
+        batch_indexes = []
 
-            lang_embs = pad_sequence(lang_embs, batch_first=True).to(self.models_manager.device)
+        for li,line in enumerate(lines):
+            out = self._text_to_sequence(line["text"], line["base_lang"])
+            if isinstance(out, str):
+                results[li] = out
+                continue
+            text, cleaned_text, lang_ids = out
+
+            batch_indexes.append(li)
+            text_sequences.append(torch.LongTensor(text))
+            cleaned_text_sequences.append(cleaned_text)
+            lang_embs.append(torch.tensor(lang_ids).to(self.models_manager.device))
+            speaker_embs.append(torch.tensor(line["base_emb"]).unsqueeze(-1))
+            paces.append(line["pace"])
+            pitch_amps.append(line["pitch_amp"] if "pitch_amp" in line else None)
+
+        if len(batch_indexes)==0:
+            return results
+
+        text_lengths = [sequence.shape[0] for sequence in text_sequences]
+        lang_embs = pad_sequence(lang_embs, batch_first=True).to(self.models_manager.device)
+        text_sequences = pad_sequence(text_sequences, batch_first=True).to(self.models_manager.device)
+        speaker_embs = pad_sequence(speaker_embs, batch_first=True).to(self.models_manager.device)
+
+        pace = torch.tensor(paces).unsqueeze(1).to(self.device)
+        pitch_amp = None if None in pitch_amps else torch.tensor(pitch_amps).unsqueeze(1).to(self.device)
+
+        out = self.model.infer_advanced(self.logger, plugin_manager, [cleaned_text_sequences], text_sequences, lang_embs=lang_embs, speaker_embs=speaker_embs, pace=pace, old_sequence=None, pitch_amp=pitch_amp)
+        if isinstance(out, str):
+            return out
+
+        output_wav, dur_pred, pitch_pred, energy_pred, _, _, _, _ = out
+        for bi,li in enumerate(batch_indexes):
+            results[li] = {
+                "wav": output_wav[bi].squeeze().cpu().detach().numpy(),
+                "dur_pred": dur_pred[bi][0][:text_lengths[bi]].cpu().detach().numpy(),
+                "pitch_pred": pitch_pred[bi][0][:text_lengths[bi]].cpu().detach().numpy(),
+                "cleaned_text": cleaned_text_sequences[bi],
+            }
+        return results
+
+
+    # Synthesize several concurrent /synthesize requests for this voice in one forward pass. Each request is a dict
+    # of the infer() kwargs. Only plain, fresh synthesis requests (no editor values, no partial re-generation) can be
+    # coalesced like this. Returns the infer() response for each request, in order (including the in-memory audio,
+    # for requests with return_audio)
+    def infer_coalesced (self, plugin_manager, requests):
+
+        lines = []
+        for request in requests:
+            base_emb = request["base_emb"]
+            lines.append({
+                "text": request["text"],
+                "base_lang": request["base_lang"],
+                "base_emb": [float(val) for val in base_emb.split(",")] if "," in base_emb else self.base_emb,
+                "pace": request["pace"],
+                "pitch_amp": None,
+            })
 
-            text_sequences = pad_sequence(text_sequences, batch_first=True).to(self.models_manager.device)
-            speaker_embs = pad_sequence(speaker_embs, batch_first=True).to(self.models_manager.device)
+        with torch.no_grad():
+            out = self.infer_tts_lines(plugin_manager, lines)
+        if isinstance(out, str):
+            return [f'ERR:{out}' for _ in requests]
+
+        responses = []
+        for request, line_out in zip(requests, out):
+            if isinstance(line_out, str):
+                responses.append(line_out)
+                continue
+
+            wav = line_out["wav"]
+            wav_norm = wav * (32767 / max(0.01, np.max(np.abs(wav))))
+            return_audio = "return_audio" in request.keys() and request["return_audio"]
+            if return_audio:
+                audio = self._output_in_memory(wav_norm, useSR=request["useSR"], useCleanup=request["useCleanup"])
+            else:
+                self._save_output(wav_norm, request["out_path"], useSR=request["useSR"], useCleanup=request["useCleanup"])
 
+            num_symbols = line_out["dur_pred"].shape[0]
+            flat_vals = np.zeros((num_symbols), dtype=np.float32)
+            editorStyles = request["editor_data"][-1] if request["editor_data"] is not None else None
+            response = self._editor_values_response(line_out["pitch_pred"], line_out["dur_pred"], np.ones((num_symbols), dtype=np.float32), \
+                flat_vals, flat_vals, flat_vals, flat_vals, editorStyles, line_out["cleaned_text"], -1, -1)
+            responses.append((response, audio[0], audio[1]) if return_audio else response)
+        return responses
 
-            pace = torch.tensor([record[3] for record in tts_input]).unsqueeze(1).to(self.device)
-            pitch_amp = torch.tensor([record[7] for record in tts_input]).unsqueeze(1).to(self.device)
 
+    def _text_to_sequence (self, text, base_lang):
+        with stage_timer(self.models_manager.metrics, "text_preprocessing"):
+            return self._text_to_sequence_inner(text, base_lang)
 
-            # Could pass indexes (and get them returned) to the tts inference fn
-            # Do the same to the vc infer fn
-            # Then marge them into their place in an output array?
+    def _text_to_sequence_inner (self, text, base_lang):
 
-            out = self.model.infer_advanced(self.logger, plugin_manager, [cleaned_text_sequences], text_sequences, lang_embs=lang_embs, speaker_embs=speaker_embs, pace=pace, old_sequence=None, pitch_amp=pitch_amp)
-            if isinstance(out, str):
-                return out
+        sequenceSplitByLanguage = self.preprocess_prompt_language(text, base_lang)
+
+        # Make sure all languages' text processors are initialized
+        for subSequence in sequenceSplitByLanguage:
+            langCode = list(subSequence.keys())[0]
+            if langCode not in self.lang_tp.keys():
+                self.lang_tp[langCode] = get_text_preprocessor(langCode, self.base_dir, logger=self.logger)
+
+        try:
+            pad_symb = len(ALL_SYMBOLS)-2
+            all_sequence = []
+            all_cleaned_text = []
+            all_text = []
+            all_lang_ids = []
+
+            # Collapse same-language words into phrases, so that heteronyms can still be detected
+            sequenceSplitByLanguage_grouped = []
+            last_lang_group = None
+            group = ""
+            for ssi, subSequence in enumerate(sequenceSplitByLanguage):
+                if list(subSequence.keys())[0]!=last_lang_group:
+                    if last_lang_group is not None:
+                        sequenceSplitByLanguage_grouped.append({last_lang_group: group})
+                        group = ""
+                    last_lang_group = list(subSequence.keys())[0]
+                group += subSequence[last_lang_group]
+            if len(group):
+                sequenceSplitByLanguage_grouped.append({last_lang_group: group})
+
+
+            for ssi, subSequence in enumerate(sequenceSplitByLanguage_grouped):
+                langCode = list(subSequence.keys())[0]
+                subSeq = subSequence[langCode]
+                sequence, cleaned_text = self.lang_tp[langCode].text_to_sequence(subSeq)
+
+                if ssi<len(sequenceSplitByLanguage_grouped)-1:
+                    sequence = sequence + [pad_symb]
+
+                all_sequence.append(sequence)
+                all_cleaned_text += ("|"+cleaned_text) if len(all_cleaned_text) else cleaned_text
+                if ssi<len(sequenceSplitByLanguage_grouped)-1:
+                    all_cleaned_text = all_cleaned_text + ["|<PAD>"]
+                all_text.append(torch.LongTensor(sequence))
+
+                language_id = self.language_id_mapping[langCode]
+                all_lang_ids += [language_id for _ in range(len(sequence))]
+
+        except ValueError as e:
+            self.logger.info("====")
+            self.logger.info(str(e))
+            self.logger.info("====--")
+            if "not in list" in str(e):
+                symbol_not_in_list = str(e).split("is not in list")[0].split("ValueError:")[-1].replace("'", "").strip()
+                return f'ERR: ARPABET_NOT_IN_LIST: {symbol_not_in_list}'
+
+        all_cleaned_text = "".join(all_cleaned_text)
+        text = torch.cat(all_text, dim=0)
+
+        return text, all_cleaned_text, all_lang_ids
+
+
+    # Write the normalized wav to out_path, running it through super-resolution and/or cleanup first, if needed
+    def _save_output (self, wav_norm, out_path, useSR=False, useCleanup=False, remove_intermediate=False):
+        metrics = self.models_manager.metrics
+
+        if useCleanup:
+            ffmpeg_path = 'ffmpeg' if platform.system() == 'Linux' else f'{"./resources/app" if self.PROD else "."}/python/ffmpeg.exe'
+
+            if useSR:
+                with stage_timer(metrics, "wav_write"):
+                    scipy.io.wavfile.write(out_path.replace(".wav", "_preSR.wav"), 22050, wav_norm.astype(np.int16))
             else:
-                output_wav, dur_pred, pitch_pred, energy_pred, _, _, _, _ = out
-
-                for i,wav in enumerate(output_wav):
-                    wav = wav.squeeze().cpu().detach().numpy()
-                    wav_norm = wav * (32767 / max(0.01, np.max(np.abs(wav))))
-                    if useCleanup:
-                        ffmpeg_path = 'ffmpeg' if platform.system() == 'Linux' else f'{"./resources/app" if self.PROD else "."}/python/ffmpeg.exe'
-
-                        if useSR:
-                            scipy.io.wavfile.write(tts_input[i][4].replace(".wav", "_preSR.wav"), 22050, wav_norm.astype(np.int16))
-                        else:
-                            scipy.io.wavfile.write(tts_input[i][4].replace(".wav", "_preCleanupPreFFmpeg.wav"), 22050, wav_norm.astype(np.int16))
-                            stream = ffmpeg.input(tts_input[i][4].replace(".wav", "_preCleanupPreFFmpeg.wav"))
-                            ffmpeg_options = {"ar": 48000}
-                            output_path = tts_input[i][4].replace(".wav", "_preCleanup.wav")
-                            stream = ffmpeg.output(stream, output_path, **ffmpeg_options)
-                            out, err = (ffmpeg.run(stream, cmd=ffmpeg_path, capture_stdout=True, capture_stderr=True, overwrite_output=True))
-                            os.remove(tts_input[i][4].replace(".wav", "_preCleanupPreFFmpeg.wav"))
-                    else:
-                        scipy.io.wavfile.write(tts_input[i][4].replace(".wav", "_preSR.wav") if useSR else tts_input[i][4], 22050, wav_norm.astype(np.int16))
-
-                    if useSR:
-                        self.models_manager.init_model("nuwave2")
-                        self.models_manager.models("nuwave2").sr_audio(tts_input[i][4].replace(".wav", "_preSR.wav"), tts_input[i][4].replace(".wav", "_preCleanup.wav") if useCleanup else tts_input[i][4])
-                        os.remove(tts_input[i][4].replace(".wav", "_preSR.wav"))
-
-                    if useCleanup:
-                        self.models_manager.init_model("deepfilternet2")
-                        self.models_manager.models("deepfilternet2").cleanup_audio(tts_input[i][4].replace(".wav", "_preCleanup.wav"), tts_input[i][4])
-                        os.remove(tts_input[i][4].replace(".wav", "_preCleanup.wav"))
-
-                if outputJSON:
-                    for ri, record in enumerate(tts_input):
-                        # tts_input: sequence, pitch, duration, pace, tempFileLocation, outPath, outFolder
-                        output_fname = tts_input[ri][5].replace(".wav", ".json")
-
-                        containing_folder = "/".join(output_fname.split("/")[:-1])
-                        os.makedirs(containing_folder, exist_ok=True)
-
-                        with open(output_fname, "w+") as f:
-                            data = {}
-                            data["modelType"] = "xVAPitch"
-                            data["inputSequence"] = str(tts_input[ri][0])
-                            data["pacing"] = float(tts_input[ri][3])
-                            data["letters"] = [char.replace("{", "").replace("}", "") for char in list(cleaned_text_sequences[ri].split("|"))]
-                            data["currentVoice"] = self.ckpt_path.split("/")[-1].replace(".pt", "")
-                            # data["resetEnergy"] = [float(val) for val in list(energy_pred[ri].cpu().detach().numpy())]
-                            data["resetEnergy"] = [float(1) for val in list(pitch_pred[ri][0].cpu().detach().numpy())]
-                            data["resetPitch"] = [float(val) for val in list(pitch_pred[ri][0].cpu().detach().numpy())]
-                            data["resetDurs"] = [float(val) for val in list(dur_pred[ri][0].cpu().detach().numpy())]
-                            data["ampFlatCounter"] = 0
-                            data["pitchNew"] = data["resetPitch"]
-                            data["energyNew"] = data["resetEnergy"]
-                            data["dursNew"] = data["resetDurs"]
-
-                            f.write(json.dumps(data, indent=4))
+                with stage_timer(metrics, "wav_write"):
+                    scipy.io.wavfile.write(out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"), 22050, wav_norm.astype(np.int16))
+                stream = ffmpeg.input(out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"))
+                ffmpeg_options = {"ar": 48000}
+                output_path = out_path.replace(".wav", "_preCleanup.wav")
+                stream = ffmpeg.output(stream, output_path, **ffmpeg_options)
+                out, err = (ffmpeg.run(stream, cmd=ffmpeg_path, capture_stdout=True, capture_stderr=True, overwrite_output=True))
+                os.remove(out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"))
+        else:
+            with stage_timer(metrics, "wav_write"):
+                scipy.io.wavfile.write(out_path.replace(".wav", "_preSR.wav") if useSR else out_path, 22050, wav_norm.astype(np.int16))
 
+        if useSR:
+            self.models_manager.init_model("nuwave2")
+            with stage_timer(metrics, "nuwave2_sr"):
+                self.models_manager.models("nuwave2").sr_audio(out_path.replace(".wav", "_preSR.wav"), out_path.replace(".wav", "_preCleanup.wav") if useCleanup else out_path)
+            if remove_intermediate:
+                os.remove(out_path.replace(".wav", "_preSR.wav"))
 
+        if useCleanup:
+            self.models_manager.init_model("deepfilternet2")
+            with stage_timer(metrics, "deepfilternet2_cleanup"):
+                self.models_manager.models("deepfilternet2").cleanup_audio(out_path.replace(".wav", "_preCleanup.wav"), out_path)
+            if remove_intermediate:
+                os.remove(out_path.replace(".wav", "_preCleanup.wav"))
 
-        return ""
+
+    # Same as _save_output, but without touching the filesystem. Returns the final int16 waveform and its sample rate
+    def _output_in_memory (self, wav_norm, useSR=False, useCleanup=False):
+
+        wav = wav_norm.astype(np.int16)
+        sr = 22050
+        if not useSR and not useCleanup:
+            return wav, sr
+
+        wav = wav.astype(np.float32) / 32768
+        if useSR:
+            self.models_manager.init_model("nuwave2")
+            with stage_timer(self.models_manager.metrics, "nuwave2_sr"):
+                wav, sr = self.models_manager.models("nuwave2").sr_wav(wav)
+
+        if useCleanup:
+            self.models_manager.init_model("deepfilternet2")
+            cleanup_model = self.models_manager.models("deepfilternet2")
+            if sr!=cleanup_model.df_state.sr():
+                wav = librosa.resample(wav, orig_sr=sr, target_sr=cleanup_model.df_state.sr())
+                sr = cleanup_model.df_state.sr()
+            with stage_timer(self.models_manager.metrics, "deepfilternet2_cleanup"):
+                wav = cleanup_model.cleanup_wav(wav)
+
+        wav = np.clip(wav, -1, 1) * 32767
+        return wav.astype(np.int16), sr
+
+
+    # The text response of infer(), parsed by the app into the editor values
+    def _editor_values_response (self, pitch, durations, energy, em_angry, em_happy, em_sad, em_surprise, editorStyles, all_cleaned_text, start_index, end_index):
+        editor_values_text = ",".join([str(v) for v in pitch]) + "\n" + \
+                             ",".join([str(v) for v in durations]) + "\n" + \
+                             ",".join([str(v) for v in energy]) + "\n" + \
+                             ",".join([str(v) for v in em_angry]) + "\n" + \
+                             ",".join([str(v) for v in em_happy]) + "\n" + \
+                             ",".join([str(v) for v in em_sad]) + "\n" + \
+                             ",".join([str(v) for v in em_surprise]) + "\n" + \
+                             json.dumps(editorStyles)
+        return editor_values_text +"\n"+all_cleaned_text +"\n"+ f'{start_index}\n{end_index}'
 
 
 
@@ -602,66 +787,21 @@ class xVAPitch(object):
         return returnString
 
 
-    def infer(self, plugin_manager, text, out_path, vocoder, speaker_i, pace=1.0, editor_data=None, old_sequence=None, globalAmplitudeModifier=None, base_lang="en", base_emb=None, useSR=False, useCleanup=False):
-
-        sequenceSplitByLanguage = self.preprocess_prompt_language(text, base_lang)
-
-        # Make sure all languages' text processors are initialized
-        for subSequence in sequenceSplitByLanguage:
-            langCode = list(subSequence.keys())[0]
-            if langCode not in self.lang_tp.keys():
-                self.lang_tp[langCode] = get_text_preprocessor(langCode, self.base_dir, logger=self.logger)
-
-        try:
-            pad_symb = len(ALL_SYMBOLS)-2
-            all_sequence = []
-            all_cleaned_text = []
-            all_text = []
-            all_lang_ids = []
-
-            # Collapse same-language words into phrases, so that heteronyms can still be detected
-            sequenceSplitByLanguage_grouped = []
-            last_lang_group = None
-            group = ""
-            for ssi, subSequence in enumerate(sequenceSplitByLanguage):
-                if list(subSequence.keys())[0]!=last_lang_group:
-                    if last_lang_group is not None:
-                        sequenceSplitByLanguage_grouped.append({last_lang_group: group})
-                        group = ""
-                    last_lang_group = list(subSequence.keys())[0]
-                group += subSequence[last_lang_group]
-            if len(group):
-                sequenceSplitByLanguage_grouped.append({last_lang_group: group})
-
-
-            for ssi, subSequence in enumerate(sequenceSplitByLanguage_grouped):
-                langCode = list(subSequence.keys())[0]
-                subSeq = subSequence[langCode]
-                sequence, cleaned_text = self.lang_tp[langCode].text_to_sequence(subSeq)
-
-                if ssi<len(sequenceSplitByLanguage_grouped)-1:
-                    sequence = sequence + [pad_symb]
-
-                all_sequence.append(sequence)
-                all_cleaned_text += ("|"+cleaned_text) if len(all_cleaned_text) else cleaned_text
-                if ssi<len(sequenceSplitByLanguage_grouped)-1:
-                    all_cleaned_text = all_cleaned_text + ["|<PAD>"]
-                all_text.append(torch.LongTensor(sequence))
-
-                language_id = self.language_id_mapping[langCode]
-                all_lang_ids += [language_id for _ in range(len(sequence))]
+    def infer(self, plugin_manager, text, out_path, vocoder, speaker_i, pace=1.0, editor_data=None, old_sequence=None, globalAmplitudeModifier=None, base_lang="en", base_emb=None, useSR=False, useCleanup=False, return_audio=False, long_form=None):
 
-        except ValueError as e:
-            self.logger.info("====")
-            self.logger.info(str(e))
-            self.logger.info("====--")
-            if "not in list" in str(e):
-                symbol_not_in_list = str(e).split("is not in list")[0].split("ValueError:")[-1].replace("'", "").strip()
-                return f'ERR: ARPABET_NOT_IN_LIST: {symbol_not_in_list}'
+        # Long prompts are split into sentences (or clauses), synthesized as a batch, and joined back up. Only for fresh
+        # synthesis: lines re-generated with the editor's values go through in one sequence, as those values are for it
+        has_editor_values = editor_data is not None and ((editor_data[0] is not None and len(editor_data[0])) or (editor_data[1] is not None and len(editor_data[1])) or editor_data[-1])
+        if long_form and not has_editor_values and old_sequence is None:
+            segments = split_long_text(text, long_form["max_chars"])
+            if len(segments)>1:
+                return self._infer_long_form(plugin_manager, segments, out_path, pace, base_lang, base_emb, long_form, useSR=useSR, useCleanup=useCleanup, return_audio=return_audio)
 
-        all_cleaned_text = "".join(all_cleaned_text)
+        out = self._text_to_sequence(text, base_lang)
+        if isinstance(out, str):
+            return out
+        text, all_cleaned_text, all_lang_ids = out
 
-        text = torch.cat(all_text, dim=0)
         text = pad_sequence([text], batch_first=True).to(self.models_manager.device)
 
         with torch.no_grad():
@@ -675,28 +815,9 @@ class xVAPitch(object):
             lang_ids = torch.tensor(all_lang_ids).to(self.models_manager.device)
 
             num_embs = text.shape[1]
-            base_emb = [float(val) for val in base_emb.split(",")] if "," in base_emb else self.base_emb
-            speaker_embs = [torch.tensor(base_emb).unsqueeze(dim=0)[0].unsqueeze(-1)]
-            speaker_embs = torch.stack(speaker_embs, dim=0).to(self.models_manager.device)#.unsqueeze(-1)
-            speaker_embs = speaker_embs.repeat(1,1,num_embs)
-
-            # Do interpolations of speaker style embeddings
             if editor_data is not None:
                 editorStyles = editor_data[-1]
-                if editorStyles is not None:
-                    style_keys = list(editorStyles.keys())
-                    for style_key in style_keys:
-                        emb = editorStyles[style_key]["embedding"]
-                        sliders_vals = editorStyles[style_key]["sliders"]
-
-                        style_embs = [torch.tensor(emb).unsqueeze(dim=0)[0].unsqueeze(-1)]
-                        style_embs = torch.stack(style_embs, dim=0).to(self.models_manager.device)#.unsqueeze(-1)
-                        style_embs = style_embs.repeat(1,1,num_embs)
-                        sliders_vals = torch.tensor(sliders_vals).to(self.models_manager.device)
-                        speaker_embs = speaker_embs*(1-sliders_vals) + sliders_vals*style_embs
-
-
-            speaker_embs = speaker_embs.float()
+            speaker_embs = self._line_speaker_embs(base_emb, num_embs, editor_data)
 
 
 
@@ -717,32 +838,120 @@ class xVAPitch(object):
                 wav_norm = wav * (32767 / max(0.01, np.max(np.abs(wav))))
                 if wav_mult is not None:
                     wav_norm = wav_norm * wav_mult
-                if useCleanup:
-                    ffmpeg_path = 'ffmpeg' if platform.system() == 'Linux' else f'{"./resources/app" if self.PROD else "."}/python/ffmpeg.exe'
-
-                    if useSR:
-                        scipy.io.wavfile.write(out_path.replace(".wav", "_preSR.wav"), 22050, wav_norm.astype(np.int16))
-                    else:
-                        scipy.io.wavfile.write(out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"), 22050, wav_norm.astype(np.int16))
-                        stream = ffmpeg.input(out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"))
-                        ffmpeg_options = {"ar": 48000}
-                        output_path = out_path.replace(".wav", "_preCleanup.wav")
-                        stream = ffmpeg.output(stream, output_path, **ffmpeg_options)
-                        out, err = (ffmpeg.run(stream, cmd=ffmpeg_path, capture_stdout=True, capture_stderr=True, overwrite_output=True))
-                        os.remove(out_path.replace(".wav", "_preCleanupPreFFmpeg.wav"))
-
+                if return_audio:
+                    audio = self._output_in_memory(wav_norm, useSR=useSR, useCleanup=useCleanup)
                 else:
-                    scipy.io.wavfile.write(out_path.replace(".wav", "_preSR.wav") if useSR else out_path, 22050, wav_norm.astype(np.int16))
+                    self._save_output(wav_norm, out_path, useSR=useSR, useCleanup=useCleanup)
 
-                if useSR:
-                    self.models_manager.init_model("nuwave2")
-                    self.models_manager.models("nuwave2").sr_audio(out_path.replace(".wav", "_preSR.wav"), out_path.replace(".wav", "_preCleanup.wav") if useCleanup else out_path)
 
-                if useCleanup:
-                    self.models_manager.init_model("deepfilternet2")
-                    self.models_manager.models("deepfilternet2").cleanup_audio(out_path.replace(".wav", "_preCleanup.wav"), out_path)
 
+        [pitch, durations, energy, em_angry, em_happy, em_sad, em_surprise] = [
+            pitch_pred.squeeze().cpu().detach().numpy(),
+            dur_pred.squeeze().cpu().detach().numpy(),
+            energy_pred.cpu().detach().numpy() if energy_pred is not None else [],
+            em_angry_pred.squeeze().cpu().detach().numpy() if em_angry_pred is not None else [],
+            em_happy_pred.squeeze().cpu().detach().numpy() if em_happy_pred is not None else [],
+            em_sad_pred.squeeze().cpu().detach().numpy() if em_sad_pred is not None else [],
+            em_surprise_pred.squeeze().cpu().detach().numpy() if em_surprise_pred is not None else [],
+        ]
+        response = self._editor_values_response(pitch, durations, energy, em_angry, em_happy, em_sad, em_surprise, editorStyles, all_cleaned_text, start_index, end_index)
+
+        del pitch_pred, dur_pred, energy_pred, em_angry, em_happy, em_sad, em_surprise, text
+        if return_audio:
+            return response, audio[0], audio[1]
+        return response
+
+    # Synthesize the segments of a long prompt (from split_long_text) in batches of long_form["batch_size"], through
+    # the same padded forward pass as the batch mode, and join them with long_form["sentence_pause_ms"] or
+    # ["clause_pause_ms"] of silence between them, cross-faded over ["crossfade_ms"]. The whole line is normalized
+    # together, so the segments keep their relative levels. The editor values returned are the segments', one after
+    # the other, with flat energy and emotions, as for the coalesced requests. They don't match the audio exactly: the
+    # pauses and cross-fades aren't in the durations. Re-generating the line with them (once edited) doesn't go through
+    # here, but runs the whole line as one sequence (see infer()), with no pauses
+    def _infer_long_form (self, plugin_manager, segments, out_path, pace, base_lang, base_emb, long_form, useSR=False, useCleanup=False, return_audio=False):
+        sr = 22050
+        base_emb = [float(val) for val in base_emb.split(",")] if base_emb is not None and "," in base_emb else self.base_emb
+        lines = [{"text": segment, "base_lang": base_lang, "base_emb": base_emb, "pace": pace if pace is not None else 1.0, "pitch_amp": None} for segment, _ in segments]
+        self.logger.info(f'[long form] {len(lines)} segments')
+
+        lines_out = []
+        batch_size = max(1, long_form["batch_size"])
+        with torch.no_grad():
+            for bi in range(0, len(lines), batch_size):
+                out = self.infer_tts_lines(plugin_manager, lines[bi:bi+batch_size])
+                if isinstance(out, str):
+                    return f'ERR:{out}'
+                for line_out in out:
+                    if isinstance(line_out, str):
+                        return line_out
+                lines_out += out
+
+        pauses = [int(sr*long_form["sentence_pause_ms" if kind=="sentence" else "clause_pause_ms"]/1000) for _, kind in segments[:-1]]
+        wav = join_segments([line_out["wav"] for line_out in lines_out], pauses, crossfade=int(sr*long_form["crossfade_ms"]/1000))
+        wav_norm = wav * (32767 / max(0.01, np.max(np.abs(wav))))
+        if return_audio:
+            audio = self._output_in_memory(wav_norm, useSR=useSR, useCleanup=useCleanup)
+        else:
+            self._save_output(wav_norm, out_path, useSR=useSR, useCleanup=useCleanup)
+
+        pitch = np.concatenate([line_out["pitch_pred"] for line_out in lines_out])
+        durations = np.concatenate([line_out["dur_pred"] for line_out in lines_out])
+        all_cleaned_text = "|".join([line_out["cleaned_text"] for line_out in lines_out])
+        flat_vals = np.zeros((durations.shape[0]), dtype=np.float32)
+        response = self._editor_values_response(pitch, durations, np.ones((durations.shape[0]), dtype=np.float32), \
+            flat_vals, flat_vals, flat_vals, flat_vals, None, all_cleaned_text, -1, -1)
+        if return_audio:
+            return response, audio[0], audio[1]
+        return response
+
+    # The speaker embedding of a line, one column per symbol, with the editor's style sliders (if any) mixed in
+    def _line_speaker_embs (self, base_emb, num_embs, editor_data=None):
+        base_emb = [float(val) for val in base_emb.split(",")] if base_emb is not None and "," in base_emb else self.base_emb
+        speaker_embs = [torch.tensor(base_emb).unsqueeze(dim=0)[0].unsqueeze(-1)]
+        speaker_embs = torch.stack(speaker_embs, dim=0).to(self.models_manager.device)#.unsqueeze(-1)
+        speaker_embs = speaker_embs.repeat(1,1,num_embs)
+
+        # Do interpolations of speaker style embeddings
+        if editor_data is not None:
+            editorStyles = editor_data[-1]
+            if editorStyles is not None:
+                style_keys = list(editorStyles.keys())
+                for style_key in style_keys:
+                    emb = editorStyles[style_key]["embedding"]
+                    sliders_vals = editorStyles[style_key]["sliders"]
+
+                    style_embs = [torch.tensor(emb).unsqueeze(dim=0)[0].unsqueeze(-1)]
+                    style_embs = torch.stack(style_embs, dim=0).to(self.models_manager.device)#.unsqueeze(-1)
+                    style_embs = style_embs.repeat(1,1,num_embs)
+                    sliders_vals = torch.tensor(sliders_vals).to(self.models_manager.device)
+                    speaker_embs = speaker_embs*(1-sliders_vals) + sliders_vals*style_embs
+
+        return speaker_embs.float()
+
+
+    # Streamed synthesis of a line: the text encoder and duration predictor are run straight away, and the flow and
+    # waveform decoder a chunk of chunk_frames at a time, as the returned generator of int16 PCM bytes is read. The
+    # audio isn't saved, nor run through the super-resolution or cleanup models. As the line's peak level isn't known
+    # up front, the gain is set from the first chunk's (with at most STREAM_MAX_GAIN times the full line gain of a
+    # 1.0 peak), and any louder later samples are clipped. Returns the editor values, the generator, and the sample rate
+    def infer_stream (self, plugin_manager, text, pace=1.0, editor_data=None, base_lang="en", base_emb=None, chunk_frames=64):
+
+        out = self._text_to_sequence(text, base_lang)
+        if isinstance(out, str):
+            return out
+        text, all_cleaned_text, all_lang_ids = out
+        text = pad_sequence([text], batch_first=True).to(self.models_manager.device)
+        lang_ids = torch.tensor(all_lang_ids).to(self.models_manager.device)
+        editorStyles = editor_data[-1] if editor_data is not None else None
+        speaker_embs = self._line_speaker_embs(base_emb, text.shape[1], editor_data)
 
+        with torch.no_grad():
+            out = self.model.infer_advanced(self.logger, plugin_manager, [all_cleaned_text], text, lang_embs=lang_ids, speaker_embs=speaker_embs, pace=pace, \
+                editor_data=editor_data, old_sequence=None, stream_chunk_frames=chunk_frames)
+        if isinstance(out, str):
+            return f'ERR:{out}'
+        wav_chunks, dur_pred, pitch_pred, energy_pred, em_pred, start_index, end_index, wav_mult = out
+        [em_angry_pred, em_happy_pred, em_sad_pred, em_surprise_pred] = em_pred
 
         [pitch, durations, energy, em_angry, em_happy, em_sad, em_surprise] = [
             pitch_pred.squeeze().cpu().detach().numpy(),
@@ -753,22 +962,34 @@ class xVAPitch(object):
             em_sad_pred.squeeze().cpu().detach().numpy() if em_sad_pred is not None else [],
             em_surprise_pred.squeeze().cpu().detach().numpy() if em_surprise_pred is not None else [],
         ]
-        editor_values_text = ",".join([str(v) for v in pitch]) + "\n" + \
-                             ",".join([str(v) for v in durations]) + "\n" + \
-                             ",".join([str(v) for v in energy]) + "\n" + \
-                             ",".join([str(v) for v in em_angry]) + "\n" + \
-                             ",".join([str(v) for v in em_happy]) + "\n" + \
-                             ",".join([str(v) for v in em_sad]) + "\n" + \
-                             ",".join([str(v) for v in em_surprise]) + "\n" + \
-                             json.dumps(editorStyles)
-
-        del pitch_pred, dur_pred, energy_pred, em_angry, em_happy, em_sad, em_surprise, text, sequence
-        return editor_values_text +"\n"+all_cleaned_text +"\n"+ f'{start_index}\n{end_index}'
+        response = self._editor_values_response(pitch, durations, energy, em_angry, em_happy, em_sad, em_surprise, editorStyles, all_cleaned_text, start_index, end_index)
+
+        def pcm_chunks ():
+            gain = None
+            offset = 0
+            with torch.no_grad():
+                for wav in wav_chunks:
+                    wav = wav.squeeze().cpu().detach().numpy().reshape(-1)
+                    if gain is None:
+                        gain = 32767 / max(1/STREAM_MAX_GAIN, np.max(np.abs(wav)) if len(wav) else 0)
+                    wav_norm = wav * gain
+                    if wav_mult is not None:
+                        wav_norm = wav_norm * wav_mult[offset:offset+len(wav_norm)]
+                    offset += len(wav_norm)
+                    yield np.clip(wav_norm, -32768, 32767).astype(np.int16).tobytes()
+        return response, pcm_chunks(), 22050
 
     def set_device (self, device):
         self.device = device
+        # The quantized layers are CPU only: switch back to the fp32 weights on the GPU, and to int8 when back on the CPU
+        if self.ckpt_path is not None and self.quantized!=(self.quantize_int8 and torch.device(device).type=="cpu"):
+            self.init_model()
+            self.load_state_dict(self.ckpt_path, None, **self.load_kwargs)
+            return
         self.model = self.model.to(device)
         self.model.pitch_emb_values = self.model.pitch_emb_values.to(device)
         self.model.device = device
+        self._init_compiled()
+        self.init_backend()
 
 
@@ -0,0 +1,86 @@
+import os
+import json
+
+import numpy as np
+import torch
+
+# The exported parts of a voice (see onnx_export.py), each an .onnx file in a folder next to the checkpoint
+ONNX_EXTENSION = ".onnx"
+ONNX_PARTS = ["encoder", "flow_reverse", "waveform_decoder"]
+ONNX_FORMAT = 1
+
+# The text encoder's relative attention pads or slices its positional embeddings depending on the input length, and
+# the exported graph keeps the branch taken for lengths above the attention window (4) + 1. Shorter inputs are padded
+# up to this length; the padding is masked out by x_lengths, so the outputs for the real symbols are unchanged
+MIN_ENCODER_LENGTH = 6
+
+
+# voice.pt -> voice.onnx/
+def onnx_model_dir (ckpt_path):
+    return (ckpt_path[:-3] if ckpt_path.endswith(".pt") else ckpt_path) + ONNX_EXTENSION
+
+# The exported model is used if it's complete, and no older than the checkpoint it was exported from
+def has_onnx_model (ckpt_path):
+    onnx_dir = onnx_model_dir(ckpt_path)
+    meta_path = f'{onnx_dir}/meta.json'
+    if not os.path.exists(meta_path) or not all([os.path.exists(f'{onnx_dir}/{part}.onnx') for part in ONNX_PARTS]):
+        return False
+    try:
+        with open(meta_path, encoding="utf8") as f:
+            if json.load(f)["format"]!=ONNX_FORMAT:
+                return False
+    except:
+        return False
+    return not os.path.exists(ckpt_path) or os.path.getmtime(meta_path)>=os.path.getmtime(ckpt_path)
+
+# ONNX Runtime is optional: without it (or without an exported model next to the voice), voices run in torch
+def onnx_available ():
+    try:
+        import onnxruntime
+        return True
+    except ImportError:
+        return False
+
+
+class OnnxVoice(object):
+    """
+    ONNX Runtime sessions for one voice's exported parts: the text encoder together with the stochastic duration
+    predictor, the reverse flow, and the HiFi-GAN waveform decoder. xVAPitch.infer_using_vals runs these in place of
+    the torch modules, keeping everything in between (the duration rounding, the alignment path, the plugins' editing
+    of the values) in Python. The inputs and outputs are torch tensors, as for the modules they stand in for.
+    """
+
+    def __init__(self, logger, onnx_dir, num_threads=0):
+        super(OnnxVoice, self).__init__()
+        import onnxruntime
+
+        self.logger = logger
+        self.onnx_dir = onnx_dir
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.sessions = {}
+        for part in ONNX_PARTS:
+            self.sessions[part] = onnxruntime.InferenceSession(f'{onnx_dir}/{part}.onnx', options, providers=["CPUExecutionProvider"])
+
+    def run (self, part, *inputs):
+        session = self.sessions[part]
+        feeds = {}
+        for session_input, tensor in zip(session.get_inputs(), inputs):
+            feeds[session_input.name] = tensor.detach().cpu().numpy() if torch.is_tensor(tensor) else np.asarray(tensor)
+        outputs = [torch.from_numpy(output) for output in session.run(None, feeds)]
+        return outputs[0] if len(outputs)==1 else outputs
+
+    # Returns x_mask, m_p, logs_p, and the (log) durations
+    def encode (self, input_symbols, x_lengths, lang_emb_full, speaker_embs, noise_scale_dp):
+        length = input_symbols.shape[1]
+        if length<MIN_ENCODER_LENGTH:
+            input_symbols = torch.nn.functional.pad(input_symbols, (0, MIN_ENCODER_LENGTH-length))
+            lang_emb_full = torch.nn.functional.pad(lang_emb_full, (0, 0, 0, MIN_ENCODER_LENGTH-length))
+            if speaker_embs.shape[2]==length and length>1:
+                speaker_embs = torch.nn.functional.pad(speaker_embs, (0, MIN_ENCODER_LENGTH-length), mode="replicate")
+        noise_scale_dp = torch.tensor(noise_scale_dp, dtype=torch.float32)
+        outputs = self.run("encoder", input_symbols.long(), x_lengths.long(), lang_emb_full.float(), speaker_embs.float(), noise_scale_dp)
+        return [output[:, :, :length] for output in outputs]
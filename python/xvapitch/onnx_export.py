@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import shutil
+import inspect
+import argparse
+import traceback
+
+import torch
+import torch.nn as nn
+
+try:
+    from python.xvapitch.onnx_backend import ONNX_PARTS, ONNX_FORMAT, MIN_ENCODER_LENGTH, onnx_model_dir, has_onnx_model, onnx_available, OnnxVoice
+except ModuleNotFoundError:
+    try:
+        from resources.app.python.xvapitch.onnx_backend import ONNX_PARTS, ONNX_FORMAT, MIN_ENCODER_LENGTH, onnx_model_dir, has_onnx_model, onnx_available, OnnxVoice
+    except ModuleNotFoundError:
+        # Run as a script: python python/xvapitch/onnx_export.py
+        from onnx_backend import ONNX_PARTS, ONNX_FORMAT, MIN_ENCODER_LENGTH, onnx_model_dir, has_onnx_model, onnx_available, OnnxVoice
+
+ONNX_OPSET = 13
+
+
+# The exported parts' tensor-only entry points. These mirror xVAPitch.infer_using_vals, up to the point where the
+# durations are rounded, and from where the latents are sampled
+class _EncoderGraph(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.text_encoder = model.text_encoder
+        self.duration_predictor = model.duration_predictor
+
+    def forward(self, input_symbols, x_lengths, lang_emb_full, speaker_embs, noise_scale_dp):
+        x, x_emb, x_mask = self.text_encoder(input_symbols, x_lengths, lang_emb=None, stats=False, lang_emb_full=lang_emb_full)
+        m_p, logs_p = self.text_encoder(x, x_lengths, lang_emb=None, lang_emb_full=lang_emb_full, stats=True, x_mask=x_mask)
+        # (sic) a reshape, not a transpose, as in infer_using_vals
+        lang_emb_full = lang_emb_full.reshape(lang_emb_full.shape[0], lang_emb_full.shape[2], lang_emb_full.shape[1])
+        logw = self.duration_predictor(x, x_mask, g=speaker_embs, reverse=True, noise_scale=noise_scale_dp, lang_emb=lang_emb_full)
+        return x_mask, m_p, logs_p, logw
+
+class _FlowReverseGraph(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.flow = model.flow
+
+    def forward(self, z_p, y_mask, g):
+        return self.flow(z_p, y_mask, g=g, reverse=True)
+
+class _DecoderGraph(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.waveform_decoder = model.waveform_decoder
+
+    def forward(self, z, g):
+        return self.waveform_decoder(z, g=g)
+
+
+# Example inputs for each part, of a given (time) length. The speaker embeddings have either one column for the whole
+# line, or (from the editor's style sliders) one per symbol, which the parts interpolate to their own length
+def _example_inputs (model, part, length, batch_size=1, per_symbol_speaker_embs=True):
+    torch.manual_seed(0)
+    num_symbols = length if part=="encoder" else max(1, length//5)
+    speaker_embs = torch.randn(batch_size, model.args.d_vector_dim, num_symbols if per_symbol_speaker_embs else 1)
+    if part=="encoder":
+        input_symbols = torch.randint(1, model.text_encoder.emb.num_embeddings, (batch_size, length))
+        x_lengths = torch.full((batch_size,), length, dtype=torch.long)
+        lang_emb_full = model.emb_l(torch.zeros(batch_size, length, dtype=torch.long)).detach()
+        return [input_symbols, x_lengths, lang_emb_full, speaker_embs, torch.tensor(0.0)]
+    if part=="flow_reverse":
+        return [torch.randn(batch_size, model.latent_size, length), torch.ones(batch_size, length), speaker_embs]
+    return [torch.randn(batch_size, model.latent_size, length), speaker_embs]
+
+_INPUT_NAMES = {
+    "encoder": ["input_symbols", "x_lengths", "lang_emb_full", "speaker_embs", "noise_scale_dp"],
+    "flow_reverse": ["z_p", "y_mask", "g"],
+    "waveform_decoder": ["z", "g"],
+}
+_OUTPUT_NAMES = {
+    "encoder": ["x_mask", "m_p", "logs_p", "logw"],
+    "flow_reverse": ["z"],
+    "waveform_decoder": ["wav"],
+}
+_DYNAMIC_AXES = {
+    "encoder": {"input_symbols": {0: "batch", 1: "time"}, "x_lengths": {0: "batch"}, "lang_emb_full": {0: "batch", 1: "time"}, "speaker_embs": {0: "batch", 2: "speaker_time"},
+        "x_mask": {0: "batch", 2: "time"}, "m_p": {0: "batch", 2: "time"}, "logs_p": {0: "batch", 2: "time"}, "logw": {0: "batch", 2: "time"}},
+    "flow_reverse": {"z_p": {0: "batch", 2: "frames"}, "y_mask": {0: "batch", 1: "frames"}, "g": {0: "batch", 2: "speaker_time"}, "z": {0: "batch", 2: "frames"}},
+    "waveform_decoder": {"z": {0: "batch", 2: "frames"}, "g": {0: "batch", 2: "speaker_time"}, "wav": {0: "batch", 2: "samples"}},
+}
+_GRAPHS = {"encoder": _EncoderGraph, "flow_reverse": _FlowReverseGraph, "waveform_decoder": _DecoderGraph}
+
+
+# Export an xVAPitch voice (the loaded torch nn.Module) into out_dir, one .onnx file per part. The weight norm is
+# folded into the model's weights first (which doesn't change its outputs), so this is meant for a model loaded just
+# for the export, not one in use
+def export_voice (model, out_dir, opset=ONNX_OPSET):
+    model = model.float().cpu().eval()
+    model.compiled = None
+    model.onnx = None
+    for module in model.modules():
+        if hasattr(module, "weight_g"):
+            torch.nn.utils.remove_weight_norm(module)
+
+    # Written into a temporary folder, then moved into place, so that a failed export doesn't leave a partial model
+    tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+    # The parts have Python control flow on the input lengths, which only the (tracing) TorchScript exporter handles;
+    # newer versions of torch default to the dynamo one
+    export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters.keys() else {}
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        with torch.no_grad():
+            for part in ONNX_PARTS:
+                graph = _GRAPHS[part](model).eval()
+                torch.onnx.export(graph, tuple(_example_inputs(model, part, 50 if part=="encoder" else 120)), f'{tmp_dir}/{part}.onnx', opset_version=opset,
+                    input_names=_INPUT_NAMES[part], output_names=_OUTPUT_NAMES[part], dynamic_axes=_DYNAMIC_AXES[part], do_constant_folding=True, **export_kwargs)
+        with open(f'{tmp_dir}/meta.json', "w", encoding="utf8") as f:
+            json.dump({"format": ONNX_FORMAT, "opset": opset, "torch": torch.__version__, "lang_embeddings": model.emb_l.num_embeddings}, f, indent=4)
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.replace(tmp_dir, out_dir)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return model
+
+
+# Run each exported part against the torch model, at input lengths other than the ones it was exported with.
+# Returns part -> the largest absolute difference in the outputs
+def check_voice (model, onnx_dir, lengths=[MIN_ENCODER_LENGTH, 23, 187]):
+    onnx_voice = OnnxVoice(None, onnx_dir)
+    differences = {}
+    with torch.no_grad():
+        for part in ONNX_PARTS:
+            graph = _GRAPHS[part](model).eval()
+            differences[part] = 0
+            for length in lengths:
+                for batch_size, per_symbol_speaker_embs in [[1, True], [2, False]]:
+                    inputs = _example_inputs(model, part, length, batch_size, per_symbol_speaker_embs)
+                    expected = graph(*inputs)
+                    actual = onnx_voice.run(part, *inputs)
+                    expected = expected if isinstance(expected, (list, tuple)) else [expected]
+                    actual = actual if isinstance(actual, (list, tuple)) else [actual]
+                    for expected_tensor, actual_tensor in zip(expected, actual):
+                        if expected_tensor.shape!=actual_tensor.shape:
+                            raise ValueError(f'{part}: output shape {tuple(actual_tensor.shape)} != {tuple(expected_tensor.shape)}, for length {length}')
+                        differences[part] = max(differences[part], float((expected_tensor-actual_tensor).abs().max()))
+    return differences
+
+
+def export (ckpt_path, force=False, tolerance=1e-3):
+    out_dir = onnx_model_dir(ckpt_path)
+    if not force and has_onnx_model(ckpt_path):
+        print(f'Up to date: {out_dir}')
+        return True
+    try:
+        import logging
+        from python.models_manager import ModelsManager
+        logger = logging.getLogger("onnx_export")
+        models_manager = ModelsManager(logger, False, device="cpu")
+        models_manager.load_model("xvapitch", ckpt_path)
+        model = models_manager.models("xvapitch").model
+
+        export_voice(model, out_dir)
+        differences = check_voice(model, out_dir)
+        print(f'Exported: {ckpt_path} -> {out_dir}')
+        for part in ONNX_PARTS:
+            print(f'    {part}: max difference from torch {differences[part]:.2e}')
+        if max(differences.values())>tolerance:
+            print(f'Failed: the exported model\'s outputs are too far from torch\'s (tolerance {tolerance})')
+            shutil.rmtree(out_dir, ignore_errors=True)
+            return False
+        return True
+    except:
+        print(f'Failed: {ckpt_path}\n{traceback.format_exc()}')
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export xVAPitch voices into ONNX models (voice.onnx/ folders, next to the checkpoints), for the ONNX Runtime backend")
+    parser.add_argument("paths", nargs="+", help="xVAPitch checkpoint files, or folders to search for .pt files")
+    parser.add_argument("--force", action="store_true", help="Re-export voices which already have an up to date model")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Largest difference allowed between the ONNX and torch outputs")
+    args = parser.parse_args()
+
+    if not onnx_available():
+        print("onnxruntime is not installed")
+        sys.exit(1)
+    sys.path.append(".")
+
+    ckpt_paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                ckpt_paths += [os.path.join(root, fname) for fname in sorted(files) if fname.endswith(".pt") and not fname.endswith(".hg.pt")]
+        else:
+            ckpt_paths.append(path)
+
+    failed = [ckpt_path for ckpt_path in ckpt_paths if not export(ckpt_path, force=args.force, tolerance=args.tolerance)]
+    print(f'{len(ckpt_paths)-len(failed)}/{len(ckpt_paths)} voices exported')
+    sys.exit(1 if len(failed) else 0)
@@ -14,7 +14,11 @@ import pykakasi
 import epitran
 # https://www.lexilogos.com/keyboard/pinyin_conversion.htm
 import nltk
-nltk.download('punkt', quiet=True)
+# Only hit the network for the tokenizer data if it's not already installed
+try:
+    nltk.data.find('tokenizers/punkt')
+except LookupError:
+    nltk.download('punkt', quiet=True)
 from nltk.tokenize import word_tokenize
 
 # I really need to find a better way to do this (handling many different possible entry points)
@@ -864,6 +864,50 @@ def generate_path(duration, mask):
     return path
 
 
+def expand_by_durations(duration, x_mask, y_mask, *values):
+    """
+    Length regulation: the same as multiplying each of values by the path from generate_path(duration, x_mask*y_mask),
+    but gathering each frame's symbol instead of building the dense [b, t_x, t_y] path. A frame j goes to the symbol i
+    whose (rounded up) cumulative durations span it, ceil(cum_duration[i-1]) <= j < ceil(cum_duration[i]), and frames
+    past the last symbol, masked frames, and the frames of masked symbols are zeros.
+    duration: [b, t_x]
+    x_mask: [b, 1, t_x]
+    y_mask: [b, t_y]
+    values: [b, c, t_x] each
+    returns: [b, c, t_y] each
+    """
+    b, t_x = duration.shape
+    t_y = y_mask.shape[1]
+    boundaries = torch.ceil(torch.cumsum(duration, 1)).contiguous()
+    frames = torch.arange(t_y, device=duration.device, dtype=boundaries.dtype).unsqueeze(0).expand(b, t_y).contiguous()
+    # The number of symbols ending at or before each frame is the index of the one it falls in
+    indexes = torch.searchsorted(boundaries, frames, right=True)
+    in_range = indexes < t_x
+    indexes = indexes.clamp(max=t_x-1)
+    frame_mask = (torch.gather(x_mask[:, 0, :], 1, indexes) * in_range.to(x_mask.dtype) * y_mask).unsqueeze(1)
+
+    expanded = []
+    for vals in values:
+        gathered = torch.gather(vals, 2, indexes.unsqueeze(1).expand(b, vals.shape[1], t_y))
+        expanded.append(gathered * frame_mask.to(vals.dtype))
+    return expanded
+
+
+# Split a batch's items into buckets of similar lengths, to be run separately: sorted longest first, each bucket takes
+# items while its padded size (items x its longest item) stays within frame_budget, and none is padded to more than
+# 1/min_fill times its own length. Returns lists of item indexes
+def plan_length_buckets (lengths, frame_budget, min_fill=0.5):
+    buckets = []
+    bucket_length = None
+    for index in sorted(range(len(lengths)), key=lambda index: -lengths[index]):
+        length = lengths[index]
+        if not len(buckets) or (len(buckets[-1])+1)*max(1, bucket_length)>frame_budget or length<bucket_length*min_fill:
+            buckets.append([])
+            bucket_length = length
+        buckets[-1].append(index)
+    return buckets
+
+
 def format_time (seconds):
     time_str = ""
     if seconds>60*60*24:
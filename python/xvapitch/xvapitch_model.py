@@ -13,8 +13,17 @@ from python.xvapitch.wavenet import WN
 from python.xvapitch.hifigan import HifiganGenerator
 from python.xvapitch.sdp import StochasticDurationPredictor#, StochasticPredictor
 
-from python.xvapitch.util import maximum_path, rand_segments, segment, sequence_mask, generate_path
+from python.xvapitch.util import maximum_path, rand_segments, segment, sequence_mask, expand_by_durations, plan_length_buckets
 from python.xvapitch.text import get_text_preprocessor, ALL_SYMBOLS, lang_names
+from python.metrics import stage_timer
+
+
+# Chunked waveform decoding: latent frames decoded on each side of a chunk for context (more than the HiFi-GAN's
+# receptive field, of about 13 frames either way), and frames cross-faded between consecutive chunks
+DECODE_CHUNK_CONTEXT = 16
+DECODE_CHUNK_FADE = 4
+# Extra context for chunks which also run the flow (4 couplings of 4 conv layers of kernel 5: 32 frames either way)
+FLOW_CHUNK_CONTEXT = 40
 
 
 class xVAPitch(nn.Module):
@@ -22,6 +31,9 @@ class xVAPitch(nn.Module):
     def __init__(self, args):
         super().__init__()
         self.args = args
+        self.metrics = None # Set by the server, to time the inference stages
+        self.compiled = None # CompiledInference, set by the server when compiled inference is enabled
+        self.onnx = None # OnnxVoice, set when the voice runs on the ONNX Runtime backend
 
         self.args.init_discriminator = True
         self.args.speaker_embedding_channels = 512
@@ -45,9 +57,15 @@ class xVAPitch(nn.Module):
 
         self.inference_noise_scale = 0.333
 
-        self.inference_noise_scale_dp = 0.333
+        # The duration predictor's noise is off at inference: a higher scale seemed to make the durations worse
+        self.inference_noise_scale_dp = 0
         self.noise_scale_dp = 1.0
         self.max_inference_len = None
+        # In batch mode, the flow and waveform decoder run on buckets of lines of similar (predicted) lengths, of up to
+        # this many padded frames each (~46s of audio), rather than on the whole batch padded to its longest line
+        self.batch_frame_budget = 4000
+        # When set, the waveform decoder runs on chunks of up to this many latent frames at a time
+        self.decode_chunk_frames = 0
         self.spec_segment_size = 32
 
 
@@ -157,7 +175,7 @@ class xVAPitch(nn.Module):
         return lang_emb
 
 
-    def infer_advanced (self, logger, plugin_manager, cleaned_text, text, lang_embs, speaker_embs, pace=1.0, editor_data=None, old_sequence=None, pitch_amp=None):
+    def infer_advanced (self, logger, plugin_manager, cleaned_text, text, lang_embs, speaker_embs, pace=1.0, editor_data=None, old_sequence=None, pitch_amp=None, stream_chunk_frames=None):
 
         if (editor_data is not None) and ((editor_data[0] is not None and len(editor_data[0])) or (editor_data[1] is not None and len(editor_data[1]))):
             pitch_pred, dur_pred, energy_pred, em_angry_pred, em_happy_pred, em_sad_pred, em_surprise_pred, _ = editor_data
@@ -202,7 +220,7 @@ class xVAPitch(nn.Module):
             try:
                 logger.info("editor data infer_using_vals")
                 wav, dur_pred, pitch_pred_out, energy_pred, em_pred_out, start_index, end_index, wav_mult = self.infer_using_vals(logger, plugin_manager, cleaned_text, text, lang_embs, \
-                    speaker_embs, pace, dur_pred_existing=dur_pred, pitch_pred_existing=pitch_pred, energy_pred_existing=energy_pred, em_pred_existing=[em_angry_pred, em_happy_pred, em_sad_pred, em_surprise_pred], old_sequence=old_sequence, new_sequence=text, pitch_amp=pitch_amp)
+                    speaker_embs, pace, dur_pred_existing=dur_pred, pitch_pred_existing=pitch_pred, energy_pred_existing=energy_pred, em_pred_existing=[em_angry_pred, em_happy_pred, em_sad_pred, em_surprise_pred], old_sequence=old_sequence, new_sequence=text, pitch_amp=pitch_amp, stream_chunk_frames=stream_chunk_frames)
 
                 [em_angry_pred_out, em_happy_pred_out, em_sad_pred_out, em_surprise_pred_out] = em_pred_out
                 pitch_pred_out = pitch_pred
@@ -218,16 +236,16 @@ class xVAPitch(nn.Module):
                 # return traceback.format_exc()
 
                 logger.info("editor data corrupt; fallback to infer_using_vals")
-                return self.infer_using_vals(logger, plugin_manager, cleaned_text, text, lang_embs, speaker_embs, pace, None, None, None, None, None, None, pitch_amp=pitch_amp)
+                return self.infer_using_vals(logger, plugin_manager, cleaned_text, text, lang_embs, speaker_embs, pace, None, None, None, None, None, None, pitch_amp=pitch_amp, stream_chunk_frames=stream_chunk_frames)
 
         else:
             logger.info("no editor infer_using_vals")
-            return self.infer_using_vals(logger, plugin_manager, cleaned_text, text, lang_embs, speaker_embs, pace, None, None, None, None, None, None, pitch_amp=pitch_amp)
+            return self.infer_using_vals(logger, plugin_manager, cleaned_text, text, lang_embs, speaker_embs, pace, None, None, None, None, None, None, pitch_amp=pitch_amp, stream_chunk_frames=stream_chunk_frames)
 
 
 
 
-    def infer_using_vals (self, logger, plugin_manager, cleaned_text, sequence, lang_embs, speaker_embs, pace, dur_pred_existing, pitch_pred_existing, energy_pred_existing, em_pred_existing, old_sequence, new_sequence, pitch_amp=None):
+    def infer_using_vals (self, logger, plugin_manager, cleaned_text, sequence, lang_embs, speaker_embs, pace, dur_pred_existing, pitch_pred_existing, energy_pred_existing, em_pred_existing, old_sequence, new_sequence, pitch_amp=None, stream_chunk_frames=None):
 
         start_index = None
         end_index = None
@@ -291,19 +309,28 @@ class xVAPitch(nn.Module):
         else: # Individual line from the UI
             lang_emb_full = lang_emb.transpose(2, 1).squeeze(1).unsqueeze(0)
 
-        x, x_emb, x_mask = self.text_encoder(input_symbols, x_lengths, lang_emb=None, stats=False, lang_emb_full=lang_emb_full)
-        m_p, logs_p = self.text_encoder(x, x_lengths, lang_emb=None, lang_emb_full=lang_emb_full, stats=True, x_mask=x_mask)
+        with stage_timer(self.metrics, "text_encoder"):
+            if self.onnx is not None:
+                # The exported encoder runs the duration predictor too, in the same graph
+                x_mask, m_p, logs_p, onnx_logw = self.onnx.encode(input_symbols, x_lengths, lang_emb_full, speaker_embs, self.inference_noise_scale_dp)
+                x_mask, m_p, logs_p, onnx_logw = [tensor.to(speaker_embs.device) for tensor in [x_mask, m_p, logs_p, onnx_logw]]
+                x = m_p
+            else:
+                x, x_emb, x_mask = self.text_encoder(input_symbols, x_lengths, lang_emb=None, stats=False, lang_emb_full=lang_emb_full)
+                m_p, logs_p = self.text_encoder(x, x_lengths, lang_emb=None, lang_emb_full=lang_emb_full, stats=True, x_mask=x_mask)
 
         lang_emb_full = lang_emb_full.reshape(lang_emb_full.shape[0],lang_emb_full.shape[2],lang_emb_full.shape[1])
 
 
-        self.inference_noise_scale_dp = 0 # TEMP DEBUGGING. REMOVE - or should I? It seems to make it worse, the higher it is
-
         # Calculate its own pitch, and duration vals if these were not already provided
         if (dur_pred_existing is None or dur_pred_existing.shape[1]==0) or old_sequence is not None:
             # Predict durations
             self.duration_predictor.logger = logger
-            logw = self.duration_predictor(x, x_mask, g=speaker_embs, reverse=True, noise_scale=self.inference_noise_scale_dp, lang_emb=lang_emb_full)
+            with stage_timer(self.metrics, "duration_predictor"):
+                if self.onnx is not None:
+                    logw = onnx_logw
+                else:
+                    logw = self.duration_predictor(x, x_mask, g=speaker_embs, reverse=True, noise_scale=self.inference_noise_scale_dp, lang_emb=lang_emb_full)
 
             w = torch.exp(logw) * x_mask * self.length_scale
             # w = w * 1.3 # The model seems to generate quite fast speech, so I'm gonna just globally adjust that
@@ -318,28 +345,9 @@ class xVAPitch(nn.Module):
         y_lengths = torch.clamp_min(torch.sum(torch.round(dur_pred), [1, 2]), 1).long()
         y_mask = sequence_mask(y_lengths, None).to(x_mask.dtype)
 
-        if dur_pred.shape[0]>1:
-            attn_all = []
-            m_p_all = []
-            logs_p_all = []
-            for b in range(dur_pred.shape[0]):
-                attn_mask = torch.unsqueeze(x_mask[b,:].unsqueeze(0), 2) * torch.unsqueeze(y_mask[b,:].unsqueeze(0), -1)
-                attn_all.append(generate_path(dur_pred.squeeze(1)[b,:].unsqueeze(0), attn_mask.squeeze(0).transpose(1, 2)))
-                m_p_all.append(torch.matmul(attn_all[-1].transpose(1, 2), m_p[b,:].unsqueeze(0).transpose(1, 2)).transpose(1, 2))
-                logs_p_all.append(torch.matmul(attn_all[-1].transpose(1, 2), logs_p[b,:].unsqueeze(0).transpose(1, 2)).transpose(1, 2))
-            del attn_all
-            m_p = torch.stack(m_p_all, dim=1).squeeze(dim=0)
-            logs_p = torch.stack(logs_p_all, dim=1).squeeze(dim=0)
-            pitch_pred = torch.zeros((x.shape[0], x.shape[0], x.shape[2])).to(x)
-
-        else:
-            attn_mask = torch.unsqueeze(x_mask, 2) * torch.unsqueeze(y_mask, -1)
-            attn = generate_path(dur_pred.squeeze(1), attn_mask.squeeze(0).transpose(1, 2))
-            m_p = torch.matmul(attn.transpose(1, 2), m_p.transpose(1, 2)).transpose(1, 2)
-            logs_p = torch.matmul(attn.transpose(1, 2), logs_p.transpose(1, 2)).transpose(1, 2)
-            pitch_pred = torch.zeros((x.shape[0], x.shape[0], x.shape[2])).to(x)
-
-
+        # Expand the text-rate stats to the frame rate, for the whole batch at once
+        m_p, logs_p = expand_by_durations(dur_pred.squeeze(1), x_mask, y_mask, m_p, logs_p)
+        pitch_pred = torch.zeros((x.shape[0], x.shape[0], x.shape[2])).to(x)
 
 
         emAngry_pred = torch.zeros((x.shape[0], x.shape[0], x.shape[2])).to(x)
@@ -429,7 +437,7 @@ class xVAPitch(nn.Module):
                 ]
                 # rerun infer_advanced so that emValues take effect
                 # second argument ensures no loop
-                return self.infer_advanced (logger, None, cleaned_text, sequence, lang_embs, speaker_embs, pace=pace, editor_data=editor_data, old_sequence=sequence, pitch_amp=None)
+                return self.infer_advanced (logger, None, cleaned_text, sequence, lang_embs, speaker_embs, pace=pace, editor_data=editor_data, old_sequence=sequence, pitch_amp=None, stream_chunk_frames=stream_chunk_frames)
             else:
                 # skip rerunning infer_advanced
                 logger.info("Inference data unchanged by plugins")
@@ -441,17 +449,34 @@ class xVAPitch(nn.Module):
         #     flow.enc.logger = logger
 
         z_p = m_p + torch.randn_like(m_p) * torch.exp(logs_p) * self.inference_noise_scale
-        z = self.flow(z_p, y_mask, g=speaker_embs, reverse=True)
         self.waveform_decoder.logger = logger
-        wav = self.waveform_decoder((z * y_mask.unsqueeze(1))[:, :, : self.max_inference_len], g=speaker_embs)
-
-        # In batch mode, trim the shorter audio waves in the batch. The masking doesn't seem to work, so have to do it manually
         if dur_pred.shape[0]>1:
-            wav_all = []
-            for b in range(dur_pred.shape[0]):
-                percent_to_mask = torch.sum(y_mask[b])/y_mask.shape[1]
-                wav_all.append(wav[b,0,0:int((wav.shape[2]*percent_to_mask).item())])
-            wav = wav_all
+            # Bucketed by length, so that a long line doesn't make the short ones run (padded) at its length
+            wav = [None for _ in range(dur_pred.shape[0])]
+            frame_lengths = [int(length) for length in y_lengths.tolist()]
+            for bucket in plan_length_buckets(frame_lengths, self.batch_frame_budget):
+                bucket_length = max([frame_lengths[b] for b in bucket])
+                bucket_indexes = torch.tensor(bucket, device=z_p.device)
+                bucket_z_p = z_p.index_select(0, bucket_indexes)[:, :, :bucket_length]
+                bucket_y_mask = y_mask.index_select(0, bucket_indexes)[:, :bucket_length]
+                bucket_speaker_embs = speaker_embs.index_select(0, bucket_indexes) if speaker_embs.shape[0]>1 else speaker_embs
+                with stage_timer(self.metrics, "flow"):
+                    z = self._flow_reverse(bucket_z_p, bucket_y_mask, bucket_speaker_embs)
+                with stage_timer(self.metrics, "waveform_decoder"):
+                    bucket_wav = self._decode((z * bucket_y_mask.unsqueeze(1))[:, :, : self.max_inference_len], bucket_speaker_embs)
+
+                # Trim the shorter audio waves in the bucket. The masking doesn't seem to work, so have to do it manually
+                for bi,b in enumerate(bucket):
+                    percent_to_mask = torch.sum(bucket_y_mask[bi])/bucket_y_mask.shape[1]
+                    wav[b] = bucket_wav[bi,0,0:int((bucket_wav.shape[2]*percent_to_mask).item())]
+        elif stream_chunk_frames:
+            # Streaming (single lines): the flow and decoder are run a chunk at a time, as the caller asks for the audio
+            wav = self._decode_chunks(z_p[:, :, : self.max_inference_len], speaker_embs, stream_chunk_frames, y_mask=y_mask[:, : self.max_inference_len])
+        else:
+            with stage_timer(self.metrics, "flow"):
+                z = self._flow_reverse(z_p, y_mask, speaker_embs)
+            with stage_timer(self.metrics, "waveform_decoder"):
+                wav = self._decode((z * y_mask.unsqueeze(1))[:, :, : self.max_inference_len], speaker_embs)
 
 
         start_index = -1 if start_index is None else start_index
@@ -462,7 +487,8 @@ class xVAPitch(nn.Module):
         stretched_energy_mult = None
         if energy_pred_existing is not None and pitch_pred_existing is not None:
             energy_mult = self.expand_vals_by_durations(energy_pred_existing.unsqueeze(0), dur_pred, logger=logger)
-            stretched_energy_mult = torch.nn.functional.interpolate(energy_mult.unsqueeze(0).unsqueeze(0), (1,1,wav.shape[2])).squeeze()
+            wav_length = wav.shape[2] if torch.is_tensor(wav) else y_mask[:, : self.max_inference_len].shape[1]*self._hop_length()
+            stretched_energy_mult = torch.nn.functional.interpolate(energy_mult.unsqueeze(0).unsqueeze(0), (1,1,wav_length)).squeeze()
             stretched_energy_mult = stretched_energy_mult.cpu().detach().numpy()
             energy_pred = energy_pred_existing.squeeze()
         else:
@@ -482,15 +508,87 @@ class xVAPitch(nn.Module):
         if y_lengths is None:
             y_lengths = self.y_lengths_default
 
-        z, _, _, y_mask = self.posterior_encoder(y, y_lengths, g=spk1_emb)
+        if self.compiled is not None:
+            z, _, _, y_mask = self.compiled.run("posterior_encoder", lambda: _PosteriorEncoderPart(self.posterior_encoder), y, y_lengths, spk1_emb)
+        else:
+            z, _, _, y_mask = self.posterior_encoder(y, y_lengths, g=spk1_emb)
         # z_hat = z
         y_mask = y_mask.squeeze(0)
-        z_p = self.flow(z, y_mask, g=spk1_emb)
-        z_hat = self.flow(z_p, y_mask, g=spk2_emb, reverse=True)
+        if self.compiled is not None:
+            z_p = self.compiled.run("flow", lambda: _FlowPart(self.flow), z, y_mask, spk1_emb)
+        else:
+            z_p = self.flow(z, y_mask, g=spk1_emb)
+        z_hat = self._flow_reverse(z_p, y_mask, spk2_emb)
 
-        o_hat = self.waveform_decoder(z_hat * y_mask, g=spk2_emb)
+        o_hat = self._decode(z_hat * y_mask, spk2_emb)
         return o_hat
 
+    # The flow (reversed) and the waveform decoder, compiled if enabled
+    def _flow_reverse (self, z_p, y_mask, g):
+        if self.onnx is not None:
+            return self.onnx.run("flow_reverse", z_p, y_mask, g).to(z_p.device)
+        if self.compiled is not None:
+            return self.compiled.run("flow_reverse", lambda: _FlowPart(self.flow, reverse=True), z_p, y_mask, g)
+        return self.flow(z_p, y_mask, g=g, reverse=True)
+
+    def _decode (self, z, g):
+        if self.decode_chunk_frames and z.shape[2]>self.decode_chunk_frames+DECODE_CHUNK_FADE:
+            return self._decode_chunked(z, g)
+        return self._decode_part(z, g)
+
+    def _decode_part (self, z, g):
+        if self.onnx is not None:
+            return self.onnx.run("waveform_decoder", z, g).to(z.device)
+        if self.compiled is not None:
+            return self.compiled.run("waveform_decoder", lambda: _DecoderPart(self.waveform_decoder), z, g)
+        return self.waveform_decoder(z, g=g)
+
+    # Decode long latents a chunk of decode_chunk_frames at a time, so that the decoder's activations (which are at up
+    # to the audio rate, with hundreds of channels) take the same memory whatever the length
+    def _decode_chunked (self, z, g):
+        return torch.cat(list(self._decode_chunks(z, g, self.decode_chunk_frames)), dim=2)
+
+    # Yield the waveform of z a chunk of chunk_frames at a time, in order. Each chunk is decoded with
+    # DECODE_CHUNK_CONTEXT frames of the neighbouring latents on either side, which are then dropped, and runs on for
+    # DECODE_CHUNK_FADE frames into the next one, where the two are cross-faded. With y_mask, z is the flow's (z_p)
+    # input, and each chunk is run through the reverse flow first, with FLOW_CHUNK_CONTEXT more frames of context
+    def _decode_chunks (self, z, g, chunk_frames, y_mask=None):
+        length = z.shape[2]
+        hop = self._hop_length()
+        context = DECODE_CHUNK_CONTEXT + (FLOW_CHUNK_CONTEXT if y_mask is not None else 0)
+        # The per symbol speaker embeddings (from the editor's style sliders) are stretched over the whole line, the
+        # same as the flow and decoder do with them, before being cut up with the latents
+        if g.shape[2]>1:
+            g = F.interpolate(g.unsqueeze(0).unsqueeze(0), (g.shape[0], g.shape[1], length))[0][0]
+
+        previous_tail = None
+        for start in range(0, length, chunk_frames):
+            end = min(length, start+chunk_frames)
+            tail_end = min(length, end+DECODE_CHUNK_FADE)
+            window_start = max(0, start-context)
+            window_end = min(length, tail_end+context)
+            window_z = z[:, :, window_start:window_end]
+            window_g = g[:, :, window_start:window_end] if g.shape[2]>1 else g
+            if y_mask is not None:
+                window_y_mask = y_mask[:, window_start:window_end]
+                with stage_timer(self.metrics, "flow"):
+                    window_z = self._flow_reverse(window_z, window_y_mask, window_g) * window_y_mask.unsqueeze(1)
+            with stage_timer(self.metrics, "waveform_decoder"):
+                chunk = self._decode_part(window_z, window_g)
+            chunk = chunk[:, :, (start-window_start)*hop:(tail_end-window_start)*hop]
+
+            if previous_tail is not None:
+                fade_in = torch.linspace(0, 1, previous_tail.shape[2]+2, device=chunk.device, dtype=chunk.dtype)[1:-1]
+                chunk = torch.cat([previous_tail*(1-fade_in) + chunk[:, :, :previous_tail.shape[2]]*fade_in, chunk[:, :, previous_tail.shape[2]:]], dim=2)
+            previous_tail = chunk[:, :, (end-start)*hop:]
+            yield chunk[:, :, :(end-start)*hop]
+
+    # Audio samples per latent frame
+    def _hop_length (self):
+        hop = 1
+        for up in self.waveform_decoder.ups:
+            hop *= up.stride[0]
+        return hop
 
 
     def _set_cond_input (self, aux_input):
@@ -548,6 +646,34 @@ class xVAPitch(nn.Module):
 
 
 
+# Tensor-only entry points of the parts run through CompiledInference. The text encoder and the duration predictor
+# are left out: their Python control flow depends on the input length, which a trace would bake in
+class _FlowPart(nn.Module):
+    def __init__(self, flow, reverse=False):
+        super().__init__()
+        self.flow = flow
+        self.reverse = reverse
+
+    def forward(self, x, x_mask, g):
+        return self.flow(x, x_mask, g=g, reverse=self.reverse)
+
+class _DecoderPart(nn.Module):
+    def __init__(self, waveform_decoder):
+        super().__init__()
+        self.waveform_decoder = waveform_decoder
+
+    def forward(self, z, g):
+        return self.waveform_decoder(z, g=g)
+
+class _PosteriorEncoderPart(nn.Module):
+    def __init__(self, posterior_encoder):
+        super().__init__()
+        self.posterior_encoder = posterior_encoder
+
+    def forward(self, y, y_lengths, g):
+        return self.posterior_encoder(y, y_lengths, g=g)
+
+
 class TextEncoder(nn.Module):
     def __init__(
         self,
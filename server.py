@@ -16,20 +16,84 @@ if __name__ == '__main__':
         lines = f.read().split("\n")
         APP_VERSION = lines[1].split('"v')[1].split('"')[0]
 
+    # Start-up timeline. Run with --profile-startup (or XVA_PROFILE_STARTUP=1) to also time every import, and write
+    # the report to startup_profile.txt, next to server.log
+    from python.startup_profiler import StartupProfiler
+    startup_profiler = StartupProfiler(enabled="--profile-startup" in sys.argv or os.environ.get("XVA_PROFILE_STARTUP")=="1")
+
+
+    # Early health check socket
+    # =========================
+    # The port is bound before the heavy imports, so that GET /health answers straight away. Any other requests
+    # arriving before start-up has finished wait for it, and then get handled as normal
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver     import ThreadingMixIn
+    startup_ready = threading.Event()
+
+    class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+        # Prevent issues with socket reuse. This has to be set before the bind, in the constructor
+        allow_reuse_address = True
+    class StartupHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status_code, data):
+            response = json.dumps(data).encode("utf-8")
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        # Liveness: the process is up
+        def _send_health(self):
+            self._send_json(200, {"status": "ready" if startup_ready.is_set() else "starting", "uptime": round(startup_profiler.elapsed(), 2)})
+
+        # Readiness: start-up has finished, and everything in the warm-up manifest has been loaded and run once
+        def _send_ready(self):
+            if not startup_ready.is_set():
+                return self._send_json(503, {"status": "starting", "uptime": round(startup_profiler.elapsed(), 2)})
+            self._send_json(200 if warmup.is_ready() else 503, warmup.status())
+
+        def do_GET(self):
+            if self.path == "/health":
+                return self._send_health()
+            if self.path == "/ready":
+                return self._send_ready()
+            startup_ready.wait()
+            self.__class__ = Handler
+            return self.do_GET()
+
+        def do_POST(self):
+            startup_ready.wait()
+            self.__class__ = Handler
+            return self.do_POST()
+
+    server_thread = None
+    bind_error = None
+    try:
+        server = ThreadedHTTPServer(("",8008), StartupHandler)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+    except:
+        bind_error = traceback.format_exc()
+        with open("./DEBUG_server_error.txt", "w+") as f:
+            f.write(bind_error)
+
 
     # Imports and logger setup
     # ========================
     try:
-        import python.pyinstaller_imports
+        with startup_profiler.step("pyinstaller imports"):
+            import python.pyinstaller_imports
         import numpy
 
         import logging
         from logging.handlers import RotatingFileHandler
-        import json
-        from http.server import BaseHTTPRequestHandler, HTTPServer
-        from socketserver     import ThreadingMixIn
-        from python.audio_post import run_audio_post, prepare_input_audio, mp_ffmpeg_output, normalize_audio, start_microphone_recording, move_recorded_file
-        import ffmpeg
+        import time
+        import base64
+        with startup_profiler.step("audio_post imports"):
+            from python.audio_post import run_audio_post, prepare_input_audio, mp_ffmpeg_output, normalize_audio, start_microphone_recording, move_recorded_file, encode_audio_bytes
+            import ffmpeg
     except:
         print(traceback.format_exc())
         with open("./DEBUG_err_imports.txt", "w+") as f:
@@ -45,7 +109,8 @@ if __name__ == '__main__':
         import torch.jit
         torch.jit.script_method = script_method
         torch.jit.script = script
-        import torch
+        with startup_profiler.step("torch import"):
+            import torch
         import tqdm
         import regex
     except:
@@ -107,26 +172,113 @@ if __name__ == '__main__':
     # ========================
 
 
-    try:
-        from python.plugins_manager import PluginManager
-        plugin_manager = PluginManager(APP_VERSION, PROD, CPU_ONLY, logger)
-        active_plugins = plugin_manager.get_active_plugins_count()
-        logger.info(f'Plugin manager loaded. {active_plugins} active plugins.')
-    except:
-        logger.info("Plugin manager FAILED.")
-        logger.info(traceback.format_exc())
+    from python.server_settings import load_server_settings, DEFAULT_SERVER_SETTINGS
+    server_settings = load_server_settings(logger)
+
+    from python.metrics import Metrics, route_label
+    metrics = Metrics()
 
-    plugin_manager.run_plugins(plist=plugin_manager.plugins["start"]["pre"], event="pre start", data=None)
 
+    # The plugins, and the models manager (with xVAPitch and its default English text pre-processor) don't depend on
+    # each other, so they're initialized concurrently
+    def init_plugin_manager ():
+        try:
+            from python.plugins_manager import PluginManager
+            plugin_manager = PluginManager(APP_VERSION, PROD, CPU_ONLY, logger)
+            active_plugins = plugin_manager.get_active_plugins_count()
+            logger.info(f'Plugin manager loaded. {active_plugins} active plugins.')
+        except:
+            logger.info("Plugin manager FAILED.")
+            logger.info(traceback.format_exc())
+            raise
+
+        plugin_manager.run_plugins(plist=plugin_manager.plugins["start"]["pre"], event="pre start", data=None)
+        return plugin_manager
+
+    # With worker processes, the server and the workers all map the same converted copy of each checkpoint
+    shared_weights_dir = None
+    if server_settings["worker_processes"]>0 and server_settings["shared_weights_dir"]:
+        import tempfile
+        shared_weights_dir = f'{tempfile.gettempdir()}/xva_shared_weights' if server_settings["shared_weights_dir"]=="default" else server_settings["shared_weights_dir"]
+
+    # TorchScript artifacts of the voice models' compiled parts, kept across restarts
+    compiled_cache_dir = None
+    if server_settings["compiled_inference"]:
+        import tempfile
+        compiled_cache_dir = f'{tempfile.gettempdir()}/xva_compiled' if server_settings["compiled_cache_dir"]=="default" else server_settings["compiled_cache_dir"]
 
     # ======================== Models manager
+    def init_models_manager ():
+        try:
+            from python.models_manager import ModelsManager
+            models_manager = ModelsManager(logger, PROD, device="cpu", metrics=metrics, num_replicas=server_settings["voice_replicas"], \
+                checkpoint_cache_mb=server_settings["checkpoint_cache_mb"], weight_dedup=server_settings["weight_dedup"], shared_weights_dir=shared_weights_dir, \
+                cpu_int8=server_settings["cpu_int8_quantization"], compiled_cache_dir=compiled_cache_dir, onnx_backend=server_settings["onnx_backend"], \
+                decode_chunk_frames=server_settings["decode_chunk_frames"])
+        except:
+            logger.info("Models manager failed to initialize")
+            logger.info(traceback.format_exc())
+            raise
+
+        if server_settings["startup_init_xvapitch"]:
+            with startup_profiler.step("xVAPitch init"):
+                models_manager.init_model("xvapitch")
+        return models_manager
+
+    plugin_manager_task = startup_profiler.run_async("plugin manager", init_plugin_manager)
+    models_manager_task = startup_profiler.run_async("models manager", init_models_manager)
+    plugin_manager = plugin_manager_task.result()
+    models_manager = models_manager_task.result()
+
+    from python.residency import ResidencyManager
+    models_manager.residency = ResidencyManager(logger, models_manager, budget_mb=server_settings["model_memory_budget_mb"], idle_ttl_s=server_settings["model_idle_ttl_s"])
+    models_manager.residency.start()
+
+    from python.models_manager import inference_lock, held_instance
     modelsPaths = {}
-    try:
-        from python.models_manager import ModelsManager
-        models_manager = ModelsManager(logger, PROD, device="cpu")
-    except:
-        logger.info("Models manager failed to initialize")
-        logger.info(traceback.format_exc())
+
+    from python.voice_index import VoiceIndex
+    voice_index = VoiceIndex(logger)
+
+    from python.synth_scheduler import SynthScheduler
+    synth_scheduler = SynthScheduler(logger, window_ms=server_settings["synth_coalesce_window_ms"], \
+        max_batch=server_settings["synth_coalesce_max_batch"], token_budget=server_settings["synth_coalesce_token_budget"])
+
+    # Optional inference worker processes. The voices they serve are only loaded in the workers, and in the server process
+    # just for the few endpoints which need them there (see ensure_local_voice)
+    worker_pool = None
+    pool_voices = {} # (model_key, instance_index) -> voice spec of the last /loadModel, for routing to the workers
+    if server_settings["worker_processes"]>0:
+        from python.worker_pool import WorkerPool, WorkerVoice, make_voice_spec
+        worker_pool = WorkerPool(logger, PROD, APP_VERSION, CPU_ONLY, server_settings["worker_processes"], \
+            threads_per_worker=server_settings["worker_threads"], log_dir=os.path.dirname(server_log_path), checkpoint_cache_mb=server_settings["checkpoint_cache_mb"], \
+            weight_dedup=server_settings["weight_dedup"], shared_weights_dir=shared_weights_dir, cpu_int8=server_settings["cpu_int8_quantization"], \
+            compiled_cache_dir=compiled_cache_dir, onnx_backend=server_settings["onnx_backend"], decode_chunk_frames=server_settings["decode_chunk_frames"])
+        worker_pool.start()
+
+    # Load a voice handed to the workers into the server process too, on the first request that needs it there
+    # (streaming, speech-to-speech, /synthesizeSimple). A no-op without the worker pool, or once it's loaded
+    def ensure_local_voice (model_key, instance_index=0):
+        key = (model_key.lower().replace(".", "_").replace(" ", ""), instance_index)
+        if key not in pool_voices.keys():
+            return
+        voice = pool_voices[key]
+        model = models_manager.models(key[0], instance_index=instance_index)
+        if model.ckpt_path==voice["ckpt_path"]:
+            return
+        models_manager.load_model(key[0], voice["ckpt_path"], instance_index=instance_index, n_speakers=voice["n_speakers"], base_lang=voice["base_lang"])
+        if key[0]=="fastpitch1_1" or key[0]=="xvapitch":
+            models_manager.models_bank[key[0]][instance_index].init_arpabet_dicts()
+
+    from python.admission import AdmissionController
+    admission = AdmissionController(logger, server_settings["admission_limits"])
+
+    from python.batch_jobs import BatchJobManager
+    batch_jobs = BatchJobManager(logger, PROD, models_manager, plugin_manager, batch_size=server_settings["batch_job_batch_size"], worker_pool=worker_pool, \
+        voice_affinity=server_settings["batch_job_voice_affinity"])
+
+    from python.warmup import WarmupManager
+    warmup = WarmupManager(logger, PROD, models_manager, plugin_manager, manifest_path=server_settings["warmup_manifest"], worker_pool=worker_pool)
     # ========================
 
 
@@ -136,27 +288,158 @@ if __name__ == '__main__':
 
 
     # Server
-    class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-        pass
-    class Handler(BaseHTTPRequestHandler):
+    class Handler(StartupHandler):
         def _set_response(self):
             self.send_response(200)
             self.send_header("Content-Type", "text/html")
             self.end_headers()
 
+        # For requests asking for the audio back in-memory. The editor values text goes in a (base64) header
+        def _send_audio(self, editor_values, wav, sr, audio_format="wav"):
+            audio_format = "pcm" if audio_format=="pcm" else "wav"
+            audio_bytes = encode_audio_bytes(wav, sr, audio_format)
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/wav" if audio_format=="wav" else f'audio/L16;rate={sr};channels=1')
+            self.send_header("Content-Length", str(len(audio_bytes)))
+            self.send_header("X-Sample-Rate", str(sr))
+            self.send_header("X-Editor-Values", base64.b64encode(editor_values.encode("utf-8")).decode("ascii"))
+            self.end_headers()
+            self.wfile.write(audio_bytes)
+
+        # Newline-delimited JSON progress events for a batch job, until it finishes (or the client goes away)
+        def _stream_job_progress(self, job):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+
+            since = 0
+            while True:
+                version = job.version
+                is_finished = job.is_finished()
+                progress = job.progress(since=since)
+                since = progress["next_since"]
+                self.wfile.write((json.dumps(progress)+"\n").encode("utf-8"))
+                self.wfile.flush()
+                if is_finished:
+                    break
+                job.wait_for_update(version, timeout=5)
+
+        # Raw 16 bit PCM audio for a line, written out a chunk at a time as the voice decodes it. As with the progress
+        # streams, there's no Content-Length: the end of the audio is the end of the response. The instance is held
+        # until the stream is done (or the client goes away), since the decoding happens as the chunks are written
+        def _stream_audio(self, model, post_data):
+            editor_data = [post_data[key] if key in post_data else None for key in ["pitch", "duration", "energy", "emAngry", "emHappy", "emSad", "emSurprise", "editorStyles"]]
+            editor_data = editor_data if any([value is not None for value in editor_data]) else None
+            if "pluginsContext" in post_data:
+                plugin_manager.set_context(post_data["pluginsContext"])
+            plugin_manager.run_plugins(plist=plugin_manager.plugins["synth-line"]["pre"], event="pre synth-line", data=post_data)
+
+            with torch.no_grad(), held_instance(model) as instance:
+                out = instance.infer_stream(plugin_manager, post_data["sequence"], pace=float(post_data["pace"]) if "pace" in post_data else 1.0, editor_data=editor_data, \
+                    base_lang=post_data["base_lang"] if "base_lang" in post_data else "en", base_emb=post_data["base_emb"] if "base_emb" in post_data else "", \
+                    chunk_frames=server_settings["stream_chunk_frames"])
+                if isinstance(out, str):
+                    logger.info(out)
+                    self._set_response()
+                    self.wfile.write(out.encode("utf-8"))
+                    return
+                editor_values, pcm_chunks, sr = out
+
+                self.send_response(200)
+                self.send_header("Content-Type", f'audio/L16;rate={sr};channels=1')
+                self.send_header("X-Sample-Rate", str(sr))
+                self.send_header("X-Editor-Values", base64.b64encode(editor_values.encode("utf-8")).decode("ascii"))
+                self.end_headers()
+                try:
+                    for pcm in pcm_chunks:
+                        self.wfile.write(pcm)
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    logger.info(f'{self.path}: the client went away mid-stream')
+                    pcm_chunks.close()
+                    return
+
+            plugin_manager.run_plugins(plist=plugin_manager.plugins["synth-line"]["post"], event="post synth-line", data=post_data)
+
+        # The long-form options for a request: None unless it asks for it with "long_form" (true, or a dict of options)
+        def _long_form_options(self, post_data):
+            request_options = post_data["long_form"] if "long_form" in post_data else None
+            if not request_options:
+                return None
+            options = dict(DEFAULT_SERVER_SETTINGS["long_form"])
+            options.update(server_settings["long_form"])
+            if isinstance(request_options, dict):
+                options.update(request_options)
+            return options
+
+        def _record_request(self, start_time, is_error):
+            path = route_label(self.path)
+            metrics.inc("xva_requests_total", path=path)
+            if is_error:
+                metrics.inc("xva_request_errors_total", path=path)
+            metrics.observe("xva_request_duration_seconds", time.perf_counter()-start_time, path=path)
+
         def do_GET(self):
+            if self.path == "/health":
+                return self._send_health()
+            if self.path == "/ready":
+                return self._send_ready()
+
+            if self.path == "/metrics":
+                metrics_text = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(metrics_text)))
+                self.end_headers()
+                self.wfile.write(metrics_text)
+                return
+
+            # What's loaded, how big it is, and how long it's been idle
+            if self.path == "/models/resident":
+                return self._send_json(200, models_manager.residency.report())
+
             returnString = "[DEBUG] Get request for {}".format(self.path).encode("utf-8")
             logger.info(returnString)
             self._set_response()
             self.wfile.write(returnString)
 
+        # Over the endpoint class' queue depth. Fail fast, and tell the client when to try again
+        def _reject_busy(self, endpoint_class):
+            content_length = int(self.headers['Content-Length']) if self.headers['Content-Length'] else 0
+            if content_length:
+                self.rfile.read(content_length)
+            retry_after = admission.retry_after(endpoint_class)
+            logger.info(f'Server busy; turning away {self.path} ({endpoint_class}), retry after {retry_after}s')
+            metrics.inc("xva_requests_rejected_total", endpoint_class=endpoint_class)
+            self.send_response(503)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Retry-After", str(retry_after))
+            self.end_headers()
+            self.wfile.write("ERR: SERVER_BUSY".encode("utf-8"))
+
         def do_POST(self):
+            endpoint_class = admission.classify(self.path)
+            if not admission.enter(endpoint_class):
+                self._reject_busy(endpoint_class)
+                return
+            start_time = time.perf_counter()
+            try:
+                self._handle_POST()
+            finally:
+                admission.exit(endpoint_class, time.perf_counter()-start_time)
+
+        def _handle_POST(self):
             global modelsPaths
             post_data = ""
+            request_start = time.perf_counter()
+            request_recorded = False
             try:
                 content_length = int(self.headers['Content-Length'])
                 post_data = json.loads(self.rfile.read(content_length).decode('utf-8')) if content_length else {}
                 req_response = "POST request for {}".format(self.path)
+                req_audio = None
+                req_job_stream = None
+                req_audio_stream = None
 
                 print("POST")
                 print(self.path)
@@ -165,27 +448,7 @@ if __name__ == '__main__':
                 if self.path == "/setAvailableVoices":
                     modelsPaths = json.loads(post_data["modelsPaths"])
                 if self.path == "/getAvailableVoices":
-                    models = {}
-                    for gameId in modelsPaths.keys():
-                        models[gameId] = []
-
-                        modelJSONs = sorted(os.listdir(modelsPaths[gameId]))
-                        for fname in modelJSONs:
-                            if fname.endswith(".json"):
-                                with open(f'{modelsPaths[gameId]}/{fname}', "r") as f:
-                                    jsons = f.read()
-                                    metadata = json.loads(jsons)
-
-                                    models[gameId].append({
-                                        "modelType": metadata["modelType"],
-                                        "author": metadata["author"] if "author" in metadata else "",
-                                        "emb_size": metadata["emb_size"] if "emb_size" in metadata else 1,
-                                        "voiceId": metadata["games"][0]["voiceId"],
-                                        "voiceName": metadata["games"][0]["voiceName"],
-                                        "gender": metadata["games"][0]["gender"] if "gender" in metadata["games"][0] else "other",
-                                        "emb_i": metadata["games"][0]["emb_i"] if "emb_i" in metadata["games"][0] else 0
-                                    })
-                    req_response = json.dumps(models)
+                    req_response = json.dumps(voice_index.get_voices(modelsPaths))
 
 
                 if self.path == "/setVocoder":
@@ -242,24 +505,39 @@ if __name__ == '__main__':
                     post_data["pluginsContext"] = json.loads(post_data["pluginsContext"])
                     n_speakers = post_data["model_speakers"] if "model_speakers" in post_data else None
                     base_lang = post_data["base_lang"] if "base_lang" in post_data else None
+                    # "onnx" or "torch", to pick the voice's backend rather than going by the onnx_backend setting
+                    backend = post_data["backend"] if "backend" in post_data else None
+                    if backend is not None:
+                        models_manager.voice_backends[ckpt+".pt"] = backend
 
 
                     plugin_manager.run_plugins(plist=plugin_manager.plugins["load-model"]["pre"], event="pre load-model", data=post_data)
-                    models_manager.load_model(modelType, ckpt+".pt", instance_index=instance_index, n_speakers=n_speakers, base_lang=base_lang)
+                    if worker_pool is not None:
+                        # Loaded in the workers only; the server process loads it too if and when it needs it (ensure_local_voice)
+                        pool_voices[(modelType, instance_index)] = make_voice_spec(modelType, ckpt+".pt", n_speakers=n_speakers, base_lang=base_lang, backend=backend)
+                        WorkerVoice(worker_pool, pool_voices[(modelType, instance_index)]).load()
+                    else:
+                        models_manager.load_model(modelType, ckpt+".pt", instance_index=instance_index, n_speakers=n_speakers, base_lang=base_lang)
                     plugin_manager.run_plugins(plist=plugin_manager.plugins["load-model"]["post"], event="post load-model", data=post_data)
 
-                    if (
+                    if worker_pool is None and (
                         modelType=="fastpitch1_1"
                         or modelType=="xvapitch"
                     ):
                         models_manager.models_bank[modelType][instance_index].init_arpabet_dicts()
 
+                if self.path == "/prefetchModels":
+                    # Look-ahead hints, from the front-end, of voices which are about to be loaded: {"models": [{"modelType", "model"}]}
+                    for entry in post_data["models"]:
+                        models_manager.prefetch(entry["modelType"], entry["model"]+".pt", page_cache_only=worker_pool is not None)
+
                 if self.path == "/getG2P":
                     text = post_data["text"]
                     base_lang = post_data["base_lang"]
 
                     model = models_manager.models("xVAPitch", instance_index=0)
-                    returnString = model.getG2P(text, base_lang)
+                    with inference_lock(model):
+                        returnString = model.getG2P(text, base_lang)
                     req_response = returnString
 
 
@@ -267,15 +545,22 @@ if __name__ == '__main__':
                     logger.info("POST {}".format(self.path))
                     text = post_data["sequence"]
                     instance_index = post_data["instance_index"] if "instance_index" in post_data else 0
-                    out_path = post_data["outfile"]
+                    out_path = post_data["outfile"] if "outfile" in post_data else None
                     base_lang = post_data["base_lang"] if "base_lang" in post_data else None
                     base_emb = post_data["base_emb"] if "base_emb" in post_data else None
                     useCleanup = post_data["useCleanup"] if "useCleanup" in post_data else None
-
-                    model = models_manager.models("xvapitch", instance_index=instance_index)
-                    req_response = model.infer(plugin_manager, text, out_path, vocoder=None, \
-                        speaker_i=None, editor_data=None, pace=None, old_sequence=None, \
-                        globalAmplitudeModifier=None, base_lang=base_lang, base_emb=base_emb, useSR=False, useCleanup=useCleanup)
+                    returnAudio = post_data["returnAudio"] if "returnAudio" in post_data else None
+
+                    ensure_local_voice("xvapitch", instance_index)
+                    model = models_manager.inference_model("xvapitch", instance_index=instance_index)
+                    with inference_lock(model):
+                        req_response = model.infer(plugin_manager, text, out_path, vocoder=None, \
+                            speaker_i=None, editor_data=None, pace=None, old_sequence=None, \
+                            globalAmplitudeModifier=None, base_lang=base_lang, base_emb=base_emb, useSR=False, useCleanup=useCleanup, return_audio=bool(returnAudio), \
+                            long_form=self._long_form_options(post_data))
+                    if not isinstance(req_response, str):
+                        req_response, wav, sr = req_response
+                        req_audio = [wav, sr, returnAudio]
 
                 if self.path == "/synthesize":
                     logger.info("POST {}".format(self.path))
@@ -302,7 +587,8 @@ if __name__ == '__main__':
                         modelType = post_data["modelType"]
                         text = post_data["sequence"]
                         pace = float(post_data["pace"])
-                        out_path = post_data["outfile"]
+                        out_path = post_data["outfile"] if "outfile" in post_data else None
+                        returnAudio = post_data["returnAudio"] if "returnAudio" in post_data else None
                         base_lang = post_data["base_lang"] if "base_lang" in post_data else None
                         base_emb = post_data["base_emb"] if "base_emb" in post_data else None
                         pitch = post_data["pitch"] if "pitch" in post_data else None
@@ -321,14 +607,45 @@ if __name__ == '__main__':
                         editor_data = [pitch, duration, energy, emAngry, emHappy, emSad, emSurprise, editorStyles]
                         old_sequence = post_data["old_sequence"] if "old_sequence" in post_data else None
 
-                        model = models_manager.models(modelType.lower().replace(".", "_").replace(" ", ""), instance_index=instance_index)
-                        req_response = model.infer(plugin_manager, text, out_path, vocoder=vocoder, \
-                            speaker_i=speaker_i, editor_data=editor_data, pace=pace, old_sequence=old_sequence, \
-                            globalAmplitudeModifier=globalAmplitudeModifier, base_lang=base_lang, base_emb=base_emb, useSR=useSR, useCleanup=useCleanup)
+                        modelKey = modelType.lower().replace(".", "_").replace(" ", "")
+                        model = models_manager.inference_model(modelKey, instance_index=instance_index)
+                        if worker_pool is not None and (modelKey, instance_index) in pool_voices.keys():
+                            model = WorkerVoice(worker_pool, pool_voices[(modelKey, instance_index)], vocoder_path=post_data["waveglowPath"] if vocoder and "waveglow" in vocoder else None)
+                        infer_kwargs = {"text": text, "out_path": out_path, "vocoder": vocoder, \
+                            "speaker_i": speaker_i, "editor_data": editor_data, "pace": pace, "old_sequence": old_sequence, \
+                            "globalAmplitudeModifier": globalAmplitudeModifier, "base_lang": base_lang, "base_emb": base_emb, "useSR": useSR, "useCleanup": useCleanup}
+                        # In-memory mode ("wav" or "pcm"), sending the audio back in the response instead of writing to outfile.
+                        # Only the xVAPitch voices can do this; the FastPitch ones write straight to the file
+                        if returnAudio and modelKey!="xvapitch":
+                            req_response = f'ERR: In-memory audio (returnAudio) is only supported for xVAPitch voices, not {modelType}'
+                        else:
+                            if returnAudio:
+                                infer_kwargs["return_audio"] = True
+                            if modelKey=="xvapitch" and self._long_form_options(post_data) is not None:
+                                infer_kwargs["long_form"] = self._long_form_options(post_data)
+                            req_response = synth_scheduler.infer((modelKey, instance_index), model, plugin_manager, infer_kwargs)
+                            if not isinstance(req_response, str):
+                                req_response, wav, sr = req_response
+                                req_audio = [wav, sr, returnAudio]
 
                         plugin_manager.run_plugins(plist=plugin_manager.plugins["synth-line"]["post"], event="post synth-line", data=post_data)
 
 
+                if self.path == "/synthesize_stream":
+                    # A line of the voice loaded with /loadModel, sent back as raw 16 bit PCM as it's decoded, rather than once it's done
+                    logger.info("POST {}".format(self.path))
+                    if isinstance(post_data["pluginsContext"] if "pluginsContext" in post_data else None, str):
+                        post_data["pluginsContext"] = json.loads(post_data["pluginsContext"])
+                    modelKey = post_data["modelType"].lower().replace(".", "_").replace(" ", "")
+                    instance_index = post_data["instance_index"] if "instance_index" in post_data else 0
+                    ensure_local_voice(modelKey, instance_index)
+                    model = models_manager.inference_model(modelKey, instance_index=instance_index)
+                    if not hasattr(model, "infer_stream"):
+                        req_response = f'ERR: {post_data["modelType"]} voices can\'t stream'
+                    else:
+                        req_audio_stream = [model, post_data]
+
+
                 if self.path == "/synthesize_batch":
                     post_data["pluginsContext"] = json.loads(post_data["pluginsContext"])
 
@@ -341,11 +658,17 @@ if __name__ == '__main__':
                     outputJSON = post_data["outputJSON"]
                     useSR = post_data["useSR"]
                     useCleanup = post_data["useCleanup"]
+                    # The voice(s) the next batches will switch to, if any, read in the background while this one runs
+                    for entry in post_data["prefetch"] if "prefetch" in post_data else []:
+                        models_manager.prefetch(entry["modelType"], entry["model"]+".pt", page_cache_only=worker_pool is not None)
 
                     with torch.no_grad():
                         try:
-                            model = models_manager.models(modelType.lower().replace(".", "_").replace(" ", ""))
-                            req_response = model.infer_batch(plugin_manager, linesBatch, outputJSON=outputJSON, vocoder=vocoder, speaker_i=speaker_i, useSR=useSR, useCleanup=useCleanup)
+                            model = models_manager.inference_model(modelType.lower().replace(".", "_").replace(" ", ""))
+                            if worker_pool is not None and (modelType.lower().replace(".", "_").replace(" ", ""), 0) in pool_voices.keys():
+                                model = WorkerVoice(worker_pool, pool_voices[(modelType.lower().replace(".", "_").replace(" ", ""), 0)])
+                            with inference_lock(model):
+                                req_response = model.infer_batch(plugin_manager, linesBatch, outputJSON=outputJSON, vocoder=vocoder, speaker_i=speaker_i, useSR=useSR, useCleanup=useCleanup)
                         except RuntimeError as e:
                             if "CUDA out of memory" in str(e):
                                 req_response = "CUDA OOM"
@@ -363,6 +686,26 @@ if __name__ == '__main__':
                     plugin_manager.run_plugins(plist=plugin_manager.plugins["batch-synth-line"]["post"], event="post batch-synth-line", data=post_data)
 
 
+                if self.path == "/batch_job/submit":
+                    manifest = post_data["manifest"] if "manifest" in post_data else post_data
+                    if "pluginsContext" in manifest and isinstance(manifest["pluginsContext"], str):
+                        manifest["pluginsContext"] = json.loads(manifest["pluginsContext"])
+                    req_response = json.dumps({"job_id": batch_jobs.submit(manifest)})
+
+                if self.path == "/batch_job/status":
+                    job = batch_jobs.get(post_data["job_id"])
+                    req_response = "ENOENT" if job is None else json.dumps(job.progress(since=post_data["since"] if "since" in post_data else 0))
+
+                if self.path == "/batch_job/stream":
+                    req_job_stream = batch_jobs.get(post_data["job_id"])
+                    req_response = "ENOENT" if req_job_stream is None else ""
+
+                if self.path == "/batch_job/cancel":
+                    req_response = "cancelled" if batch_jobs.cancel(post_data["job_id"]) else "ENOENT"
+
+                if self.path == "/batch_job/list":
+                    req_response = json.dumps(batch_jobs.list_jobs())
+
                 if self.path == "/runSpeechToSpeech":
                     logger.info("POST {}".format(self.path))
                     input_path = post_data["input_path"]
@@ -382,7 +725,10 @@ if __name__ == '__main__':
                     models_manager.load_model("speaker_rep", f'{"./resources/app" if PROD else "."}/python/xvapitch/speaker_rep/speaker_rep.pt')
 
                     try:
-                        out = models_manager.models("xvapitch").run_speech_to_speech(final_path, audio_out_path.replace(".wav", "_tempS2S.wav"), style_emb, models_manager, plugin_manager, vc_strength=vc_strength, useSR=useSR, useCleanup=useCleanup)
+                        ensure_local_voice("xvapitch")
+                        model = models_manager.models("xvapitch")
+                        with inference_lock(model):
+                            out = model.run_speech_to_speech(final_path, audio_out_path.replace(".wav", "_tempS2S.wav"), style_emb, models_manager, plugin_manager, vc_strength=vc_strength, useSR=useSR, useCleanup=useCleanup)
                         if out=="TOO_SHORT":
                             req_response = "TOO_SHORT"
                         else:
@@ -494,6 +840,9 @@ if __name__ == '__main__':
                     if "xvapitch" in list(models_manager.models_bank.keys()):
                         models_manager.models_bank["xvapitch"].refresh_arpabet_dicts()
 
+                    if worker_pool is not None:
+                        worker_pool.broadcast("refresh_arpabet_dicts", {})
+
                 if self.path == "/start_microphone_recording":
                     start_microphone_recording(logger, models_manager, f'{"./resources/app" if PROD else "."}')
                     req_response = ""
@@ -502,9 +851,22 @@ if __name__ == '__main__':
                     file_path = post_data["file_path"]
                     move_recorded_file(PROD, logger, models_manager, f'{"./resources/app" if PROD else "."}', file_path)
 
-                self._set_response()
-                self.wfile.write(req_response.encode("utf-8"))
+                is_error = isinstance(req_response, str) and (req_response.startswith("ERR") or req_response=="CUDA OOM")
+                self._record_request(request_start, is_error)
+                request_recorded = True
+
+                if req_job_stream is not None:
+                    self._stream_job_progress(req_job_stream)
+                elif req_audio_stream is not None:
+                    self._stream_audio(*req_audio_stream)
+                elif req_audio is not None:
+                    self._send_audio(req_response, *req_audio)
+                else:
+                    self._set_response()
+                    self.wfile.write(req_response.encode("utf-8"))
             except Exception as e:
+                if not request_recorded:
+                    self._record_request(request_start, True)
                 with open("./DEBUG_request.txt", "w+") as f:
                     f.write(traceback.format_exc())
                     f.write(str(post_data))
@@ -513,22 +875,30 @@ if __name__ == '__main__':
                 logger.info(traceback.format_exc())
 
 
-    try:
-        # server = HTTPServer(("",8008), Handler)
-        server = ThreadedHTTPServer(("",8008), Handler)
-        # Prevent issues with socket reuse
-        server.allow_reuse_address = True
-    except:
-        with open("./DEBUG_server_error.txt", "w+") as f:
-            f.write(traceback.format_exc())
-        logger.info(traceback.format_exc())
+    # The port couldn't be bound at the start (eg another server is already running on it); nothing to serve on
+    if server_thread is None:
+        logger.info(f'Server failed to start:\n{bind_error}')
+        print(bind_error)
+        if worker_pool is not None:
+            worker_pool.stop()
+        sys.exit(1)
+
+    # The socket has been up since the start; from now on, requests go straight to the full handler
+    server.RequestHandlerClass = Handler
+    startup_ready.set()
+    # Warm up in the background; until it's done, /ready keeps the node out of the load balancer's rotation
+    warmup.start()
     try:
         plugin_manager.run_plugins(plist=plugin_manager.plugins["start"]["post"], event="post start", data=None)
         print("Server ready")
-        logger.info("Server ready")
-        server.serve_forever()
+        logger.info(f'Server ready. Start-up took {startup_profiler.elapsed():.2f}s')
+        startup_profiler.write_report(f'{os.path.dirname(server_log_path)}/startup_profile.txt', logger)
+        while server_thread.is_alive():
+            server_thread.join(1)
 
 
     except KeyboardInterrupt:
         pass
     server.server_close()
+    if worker_pool is not None:
+        worker_pool.stop()
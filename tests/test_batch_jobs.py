@@ -0,0 +1,176 @@
+import logging
+import threading
+
+from python.batch_jobs import BatchJob, BatchJobManager, plan_job_groups
+
+
+def make_line (text, lang="en"):
+    # [sequence, pitch, duration, pace, tempFileLocation, outPath, outFolder, pitch_amp, base_lang, base_emb, vc_content, vc_style]
+    return [text, None, None, 1.0, f'{text}.wav', None, None, None, lang, "", None, None]
+
+def make_group (model, texts, **extra):
+    group = {"modelType": "xVAPitch", "linesBatch": [make_line(text) for text in texts]}
+    if model is not None:
+        group["model"] = model
+    group.update(extra)
+    return group
+
+def plan_summary (plan):
+    return [(group.get("model"), [line[0] for line in group["linesBatch"]], group["line_indexes"]) for group in plan]
+
+
+def test_plan_pools_lines_by_voice_in_first_appearance_order ():
+    groups = [make_group("a", ["a1"]), make_group("b", ["b1", "b2"]), make_group("a", ["a2"]), make_group("c", ["c1"]), make_group("b", ["b3"])]
+    plan = plan_job_groups(groups, {})
+    assert plan_summary(plan) == [
+        ("a", ["a1", "a2"], [0, 3]),
+        ("b", ["b1", "b2", "b3"], [1, 2, 5]),
+        ("c", ["c1"], [4]),
+    ]
+
+def test_plan_runs_the_loaded_voices_first ():
+    groups = [make_group("a", ["a1"]), make_group("b", ["b1"]), make_group("c", ["c1"]), make_group("a", ["a2"])]
+    plan = plan_job_groups(groups, {}, loaded_models=[("xvapitch", "c")])
+    assert [group["model"] for group in plan] == ["c", "a", "b"]
+    assert plan_summary(plan)[1] == ("a", ["a1", "a2"], [0, 3])
+
+def test_plan_keeps_the_loaded_models_default_unshared ():
+    # The default isn't a shared list which a previous call could have left voices in
+    groups = [make_group("a", ["a1"]), make_group("b", ["b1"])]
+    plan_job_groups(groups, {}, loaded_models=[("xvapitch", "b")])
+    assert [group["model"] for group in plan_job_groups(groups, {})] == ["a", "b"]
+
+def test_plan_groups_without_a_model_use_the_previous_voice ():
+    groups = [make_group(None, ["x1"]), make_group("a", ["a1"]), make_group(None, ["a2"]), make_group("b", ["b1"])]
+    plan = plan_job_groups(groups, {})
+    # The lines before any voice is given run first, on whatever is already loaded
+    assert plan_summary(plan) == [
+        (None, ["x1"], [0]),
+        ("a", ["a1", "a2"], [1, 2]),
+        ("b", ["b1"], [3]),
+    ]
+
+def test_plan_splits_a_voice_by_language_and_flags ():
+    groups = [make_group("a", ["a1"]), make_group("a", ["a2"], useSR=True), make_group("a", ["a3"])]
+    groups[0]["linesBatch"].append(make_line("a4", lang="de"))
+    plan = plan_job_groups(groups, {"useSR": False})
+    assert plan_summary(plan) == [
+        ("a", ["a1", "a3"], [0, 3]),
+        ("a", ["a4"], [1]),
+        ("a", ["a2"], [2]),
+    ]
+    assert [group["useSR"] for group in plan] == [False, False, True]
+
+
+class StubModel(object):
+    """infer_batch() records the lines it's given, and can be held until released"""
+
+    def __init__(self, fail_texts=None, hold=False):
+        super(StubModel, self).__init__()
+        self.fail_texts = fail_texts or []
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+
+    def infer_batch (self, plugin_manager, linesBatch, **kwargs):
+        self.batches.append([line[0] for line in linesBatch])
+        self.started.set()
+        self.release.wait(5)
+        if any([line[0] in self.fail_texts for line in linesBatch]):
+            raise ValueError("bad line")
+        return ""
+
+
+class StubModelsManager(object):
+    def __init__(self, model):
+        super(StubModelsManager, self).__init__()
+        self.model = model
+        self.models_bank = {}
+
+    def inference_model (self, modelType):
+        return self.model
+
+
+class StubPluginManager(object):
+    def __init__(self):
+        super(StubPluginManager, self).__init__()
+        self.plugins = {"batch-synth-line": {"pre": [], "post": []}}
+
+    def set_context (self, context):
+        pass
+
+    def run_plugins (self, plist, event="", data=None):
+        pass
+
+
+def make_manager (model, batch_size=16):
+    return BatchJobManager(logging.getLogger("test"), False, StubModelsManager(model), StubPluginManager(), batch_size=batch_size)
+
+def wait_until_finished (job, timeout=5):
+    version = job.version
+    while not job.is_finished():
+        new_version = job.wait_for_update(version, timeout=timeout)
+        assert new_version != version or job.is_finished(), "The job stopped updating"
+        version = new_version
+
+
+def test_progress_counts_lines_finished_in_manifest_order ():
+    model = StubModel(fail_texts=["l3"])
+    manager = make_manager(model)
+    job = BatchJob({"groups": [make_group(None, ["l0", "l1", "l2", "l3", "l4"])]})
+    group = job.groups[0]
+    lines = group["linesBatch"]
+
+    manager._run_lines(job, model, group, lines[3:5], [3, 4])
+    progress = job.progress()
+    # The failing line is found by retrying the batch line by line; it still counts as finished
+    assert progress["lines_done"] == 2 and progress["completed"] == [4] and progress["in_order_done"] == 0
+    assert [error[0] for error in progress["errors"]] == [3]
+
+    manager._run_lines(job, model, group, lines[1:3], [1, 2])
+    assert job.progress()["in_order_done"] == 0
+    manager._run_lines(job, model, group, lines[0:1], [0])
+    progress = job.progress(since=2)
+    assert progress["in_order_done"] == 5 and progress["lines_done"] == 5
+    assert progress["completed"] == [2, 0] and progress["next_since"] == 4
+
+def test_job_runs_to_done ():
+    model = StubModel()
+    manager = make_manager(model, batch_size=2)
+    job_id = manager.submit({"groups": [make_group(None, ["l0", "l1", "l2"])]})
+    job = manager.get(job_id)
+    wait_until_finished(job)
+    assert job.status == "done"
+    assert model.batches == [["l0", "l1"], ["l2"]]
+    assert job.progress()["in_order_done"] == 3
+
+def test_cancel_stops_a_running_job_between_batches ():
+    model = StubModel(hold=True)
+    manager = make_manager(model, batch_size=1)
+    job_id = manager.submit({"groups": [make_group(None, ["l0", "l1", "l2"])]})
+    job = manager.get(job_id)
+    assert model.started.wait(5)
+
+    assert manager.cancel(job_id)
+    model.release.set()
+    wait_until_finished(job)
+    assert job.status == "cancelled"
+    # The batch already running finishes, but no more are started
+    assert model.batches == [["l0"]]
+    assert job.progress()["lines_done"] == 1
+
+def test_cancel_a_queued_job ():
+    model = StubModel(hold=True)
+    manager = make_manager(model)
+    running_id = manager.submit({"groups": [make_group(None, ["l0"])]})
+    assert model.started.wait(5)
+    queued_id = manager.submit({"groups": [make_group(None, ["q0"])]})
+
+    assert manager.cancel(queued_id)
+    assert manager.get(queued_id).status == "cancelled"
+    assert not manager.cancel("no such job")
+    model.release.set()
+    wait_until_finished(manager.get(running_id))
+    assert model.batches == [["l0"]]
@@ -0,0 +1,60 @@
+import pytest
+import torch
+
+from python.xvapitch.util import expand_by_durations, generate_path, sequence_mask
+
+
+# The dense generate_path + matmul length regulation, which expand_by_durations replaces
+def expand_with_path (duration, x_mask, y_mask, *values):
+    path = generate_path(duration, x_mask[:, 0].unsqueeze(2) * y_mask.unsqueeze(1))
+    return [torch.matmul(vals, path) for vals in values]
+
+def make_case (case, generator):
+    b = [1, 1, 2, 4][case%4]
+    t_x = int(torch.randint(1, 40, (1,), generator=generator))
+    x_lengths = torch.randint(1, t_x+1, (b,), generator=generator)
+    x_lengths[0] = t_x
+    x_mask = sequence_mask(x_lengths, t_x).float().unsqueeze(1)
+
+    duration = torch.rand(b, t_x, generator=generator)*6
+    if case%3==0:
+        duration = torch.ceil(duration) # Whole durations
+    if case%5==0:
+        duration[:, ::3] = 0 # Zero-length symbols
+    if case%7:
+        duration = duration*x_mask[:, 0] # Otherwise durations are left on the padding
+    values = [torch.randn(b, 8, t_x, generator=generator) for _ in range(2)]
+
+    y_lengths = torch.clamp_min(torch.sum(torch.round(duration), 1), 1).long()
+    y_mask = sequence_mask(y_lengths, None).float()
+    return duration, x_mask, y_mask, values
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_matches_generate_path (seed):
+    generator = torch.Generator().manual_seed(seed)
+    for case in range(100):
+        duration, x_mask, y_mask, values = make_case(case, generator)
+        expected = expand_with_path(duration, x_mask, y_mask, *values)
+        actual = expand_by_durations(duration, x_mask, y_mask, *values)
+        for expected_vals, actual_vals in zip(expected, actual):
+            assert actual_vals.shape == expected_vals.shape
+            assert float((expected_vals-actual_vals).abs().max()) <= 1e-6
+
+def test_zero_length_symbols_are_skipped ():
+    duration = torch.tensor([[2., 0., 1., 0.]])
+    x_mask = torch.ones(1, 1, 4)
+    y_mask = sequence_mask(torch.tensor([3]), None).float()
+    values = torch.tensor([[[1., 2., 3., 4.]]])
+
+    expanded, = expand_by_durations(duration, x_mask, y_mask, values)
+    assert expanded.tolist() == [[[1., 1., 3.]]]
+    assert torch.equal(expanded, expand_with_path(duration, x_mask, y_mask, values)[0])
+
+def test_catches_a_perturbed_duration ():
+    # The comparison above isn't vacuous: a slightly different duration gives a different expansion
+    generator = torch.Generator().manual_seed(0)
+    duration, x_mask, y_mask, values = make_case(3, generator)
+    expected = expand_with_path(duration, x_mask, y_mask, *values)
+    actual = expand_by_durations(duration*1.01, x_mask, y_mask, *values)
+    assert max([float((e-a).abs().max()) for e, a in zip(expected, actual)]) > 1e-3
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from python.xvapitch.long_form import join_segments, split_long_text
+
+
+def test_short_text_is_one_segment ():
+    assert split_long_text("Hello there. How are you? Fine!", max_chars=200) == [["Hello there. How are you? Fine!", "end"]]
+
+def test_splits_at_sentence_ends ():
+    assert split_long_text("Hello there. How are you? Fine!", max_chars=12) == [
+        ["Hello there.", "sentence"],
+        ["How are you?", "sentence"],
+        ["Fine!", "end"],
+    ]
+
+def test_packs_sentences_up_to_max_chars ():
+    assert split_long_text("One. Two. Three. Four.", max_chars=10) == [["One. Two.", "sentence"], ["Three.", "sentence"], ["Four.", "end"]]
+
+def test_long_sentences_split_at_clauses ():
+    assert split_long_text("One, two, three, four, five, six, seven, eight. Nine.", max_chars=20) == [
+        ["One, two, three,", "clause"],
+        ["four, five, six,", "clause"],
+        ["seven, eight. Nine.", "end"],
+    ]
+
+def test_no_split_points_keeps_the_text_whole ():
+    assert split_long_text("Text with no end punctuation", max_chars=5) == [["Text with no end punctuation", "end"]]
+
+def test_abbreviations_dont_end_sentences ():
+    assert split_long_text("Mr. Smith went to Washington. He said hi.", max_chars=20) == [
+        ["Mr. Smith went to Washington.", "sentence"],
+        ["He said hi.", "end"],
+    ]
+
+def test_trailing_punctuation_and_quotes_stay_with_the_sentence ():
+    assert split_long_text('He said "Stop!" Then left... Really?!', max_chars=10) == [
+        ['He said "Stop!"', "sentence"],
+        ["Then left...", "sentence"],
+        ["Really?!", "end"],
+    ]
+
+@pytest.mark.parametrize("text", ["", "   "])
+def test_empty_text (text):
+    assert split_long_text(text) == []
+
+def test_arpabet_punctuation_isnt_a_split_point ():
+    assert split_long_text("Say {HH, AH0. L OW1!} now. Then stop.", max_chars=10) == [
+        ["Say {HH, AH0. L OW1!} now.", "sentence"],
+        ["Then stop.", "end"],
+    ]
+
+def test_lang_markup_is_closed_and_reopened_across_splits ():
+    text = "\\lang[de][Guten Tag. Wie geht es dir, mein Freund?] And {HH AH0 L OW1.} back to English; ok."
+    assert split_long_text(text, max_chars=30) == [
+        ["\\lang[de][Guten Tag.]", "sentence"],
+        ["\\lang[de][Wie geht es dir,]", "clause"],
+        ["\\lang[de][mein Freund?]", "sentence"],
+        ["And {HH AH0 L OW1.} back to English;", "clause"],
+        ["ok.", "end"],
+    ]
+
+def test_nested_lang_markup ():
+    assert split_long_text("\\lang[de][Eins. \\lang[fr][Deux. Trois.] Vier.] End.", max_chars=8) == [
+        ["\\lang[de][Eins.]", "sentence"],
+        ["\\lang[de][\\lang[fr][Deux.]]", "sentence"],
+        ["\\lang[de][\\lang[fr][Trois.]]", "sentence"],
+        ["\\lang[de][Vier.]", "sentence"],
+        ["End.", "end"],
+    ]
+
+
+def test_join_with_pauses ():
+    joined = join_segments([np.ones(10), np.ones(6)*2], [5])
+    assert joined.dtype == np.float32
+    assert joined.tolist() == [1.0]*10 + [0.0]*5 + [2.0]*6
+
+def test_join_a_single_segment ():
+    assert join_segments([np.ones(4)*2], []).tolist() == [2.0]*4
+
+def test_join_without_pause_or_crossfade_concatenates ():
+    assert join_segments([np.ones(4), np.ones(3)*2], [0]).tolist() == [1.0]*4 + [2.0]*3
+
+def test_crossfade_fades_out_and_in_around_a_pause ():
+    joined = join_segments([np.ones(10), np.ones(10)], [3], crossfade=4)
+    assert len(joined) == 23
+    ramp = np.linspace(0, 1, 4)
+    assert np.allclose(joined[6:10], ramp[::-1])
+    assert np.allclose(joined[10:13], 0)
+    assert np.allclose(joined[13:17], ramp)
+    assert np.allclose(joined[:6], 1) and np.allclose(joined[17:], 1)
+
+def test_crossfade_overlaps_with_no_pause ():
+    joined = join_segments([np.ones(10), np.ones(10), np.ones(5)], [3, 0], crossfade=4)
+    # The last two segments overlap by the crossfade
+    assert len(joined) == 10+3+10+5-4
+    assert np.allclose(joined[-5:], 1)
+
+def test_crossfade_is_capped_by_short_segments ():
+    joined = join_segments([np.ones(2), np.ones(10)], [0], crossfade=4)
+    assert len(joined) == 10
+    assert np.allclose(joined, 1)
+
+def test_join_doesnt_modify_the_inputs ():
+    wavs = [np.ones(10, dtype=np.float32), np.ones(10, dtype=np.float32)]
+    join_segments(wavs, [0], crossfade=4)
+    assert np.allclose(wavs[0], 1) and np.allclose(wavs[1], 1)
@@ -0,0 +1,25 @@
+import os
+import re
+
+from python.metrics import Metrics, KNOWN_ROUTES, route_label
+
+
+def test_known_routes_are_their_own_label_and_anything_else_is_other ():
+    assert route_label("/synthesize")=="/synthesize"
+    assert route_label("/synthesize?x=1")=="other"
+    assert route_label("/no/such/route")=="other"
+
+def test_known_routes_cover_every_route_the_server_handles ():
+    server_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+    with open(server_path, encoding="utf8") as f:
+        routes = set(re.findall(r'self\.path == "([^"]+)"', f.read()))
+    assert len(routes)
+    assert routes - set(KNOWN_ROUTES)==set()
+
+def test_arbitrary_paths_share_one_time_series ():
+    metrics = Metrics()
+    for i in range(50):
+        metrics.inc("xva_requests_total", path=route_label(f'/random/{i}'))
+    rendered = metrics.render()
+    assert 'xva_requests_total{path="other"} 50' in rendered
+    assert "/random/" not in rendered
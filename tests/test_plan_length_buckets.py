@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from python.xvapitch.util import plan_length_buckets
+
+
+def check_buckets (lengths, buckets, frame_budget, min_fill):
+    # Every item is run exactly once
+    assert sorted([index for bucket in buckets for index in bucket]) == list(range(len(lengths)))
+    for bucket in buckets:
+        assert len(bucket)
+        bucket_length = max([lengths[index] for index in bucket])
+        # Padded to its longest item, a bucket stays within the budget, unless it's a single item
+        assert len(bucket)==1 or len(bucket)*bucket_length <= frame_budget
+        # And no item in it is padded to more than 1/min_fill times its own length
+        assert all([lengths[index] >= bucket_length*min_fill for index in bucket])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_lengths (seed):
+    rng = random.Random(seed)
+    lengths = [rng.randint(0, 1500) for _ in range(rng.randint(1, 40))]
+    frame_budget = rng.choice([500, 2000, 8000])
+    min_fill = rng.choice([0, 0.5, 0.8])
+    check_buckets(lengths, plan_length_buckets(lengths, frame_budget, min_fill=min_fill), frame_budget, min_fill)
+
+def test_no_items ():
+    assert plan_length_buckets([], 1000) == []
+
+def test_similar_lengths_share_a_bucket ():
+    assert plan_length_buckets([100, 120, 110], 1000) == [[1, 2, 0]]
+
+def test_the_budget_splits_the_buckets ():
+    # 3 x 300 fits in 1000, a 4th doesn't
+    buckets = plan_length_buckets([300]*5, 1000, min_fill=0)
+    assert buckets == [[0, 1, 2], [3, 4]]
+
+def test_the_budget_exactly_filled ():
+    assert plan_length_buckets([250]*4, 1000) == [[0, 1, 2, 3]]
+
+def test_an_item_longer_than_the_budget_runs_alone ():
+    lengths = [50, 1500, 60, 1200]
+    buckets = plan_length_buckets(lengths, 1000, min_fill=0)
+    assert buckets[0] == [1]
+    assert buckets[1] == [3]
+    assert buckets[2:] == [[2, 0]]
+    check_buckets(lengths, buckets, 1000, 0)
+
+def test_min_fill_splits_short_items_from_long_ones ():
+    lengths = [100, 40, 90, 49, 51]
+    assert plan_length_buckets(lengths, 10000, min_fill=0.5) == [[0, 2, 4], [3, 1]]
+    # Everything together, with no minimum fill
+    assert plan_length_buckets(lengths, 10000, min_fill=0) == [[0, 2, 4, 3, 1]]
+
+def test_zero_lengths ():
+    # A bucket of zero-length items is sized as 1 frame each, so the budget still splits them
+    assert plan_length_buckets([0, 0, 0], 2, min_fill=0.5) == [[0, 1], [2]]
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from python.synth_scheduler import SynthScheduler
+
+
+class StubModel(object):
+    """Stands in for a voice: infer() and infer_coalesced() answer with the text, and record the calls"""
+
+    def __init__(self, coalesced_delay=0, fail_coalesced=False, fail_texts=None):
+        super(StubModel, self).__init__()
+        self.coalesced_delay = coalesced_delay
+        self.fail_coalesced = fail_coalesced
+        self.fail_texts = fail_texts or []
+        self.infer_lock = threading.RLock()
+        self.calls_lock = threading.Lock()
+        self.infer_calls = []
+        self.coalesced_calls = []
+
+    def infer (self, plugin_manager, **infer_kwargs):
+        with self.calls_lock:
+            self.infer_calls.append(infer_kwargs["text"])
+        if infer_kwargs["text"] in self.fail_texts:
+            raise ValueError(infer_kwargs["text"])
+        return f'infer:{infer_kwargs["text"]}'
+
+    def infer_coalesced (self, plugin_manager, requests):
+        with self.calls_lock:
+            self.coalesced_calls.append([request["text"] for request in requests])
+        time.sleep(self.coalesced_delay)
+        if self.fail_coalesced:
+            raise RuntimeError("batch failed")
+        return [f'coalesced:{request["text"]}' for request in requests]
+
+
+class StubPluginManager(object):
+    def __init__(self, mid_plugins=None):
+        super(StubPluginManager, self).__init__()
+        self.plugins = {"synth-line": {"pre": [], "mid": mid_plugins or [], "post": []}}
+
+
+def make_kwargs (text, **overrides):
+    infer_kwargs = {"text": text, "out_path": None, "vocoder": "qnd", "speaker_i": None, "editor_data": [None]*8, "pace": 1.0, \
+        "old_sequence": None, "globalAmplitudeModifier": None, "base_lang": "en", "base_emb": "", "useSR": False, "useCleanup": False}
+    infer_kwargs.update(overrides)
+    return infer_kwargs
+
+# Send the requests from concurrent threads; returns text -> response (or the exception raised)
+def run_concurrently (scheduler, model, texts, stagger=0.0):
+    results = {}
+    def run (text):
+        try:
+            results[text] = scheduler.infer(("xvapitch", 0), model, None, make_kwargs(text))
+        except Exception as e:
+            results[text] = e
+    threads = []
+    for text in texts:
+        threads.append(threading.Thread(target=run, args=(text,)))
+        threads[-1].start()
+        time.sleep(stagger)
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+    return results
+
+
+def test_followers_get_their_own_response_from_the_leaders_batch ():
+    scheduler = SynthScheduler(logging.getLogger("test"), window_ms=300, max_batch=8, token_budget=1500)
+    model = StubModel()
+    texts = [f'line {i}' for i in range(5)]
+
+    results = run_concurrently(scheduler, model, texts)
+
+    assert results=={text: f'coalesced:{text}' for text in texts}
+    assert len(model.coalesced_calls)==1 and sorted(model.coalesced_calls[0])==texts
+    assert model.infer_calls==[]
+    assert scheduler.pending=={}
+
+def test_leftovers_of_a_full_batch_are_promoted_and_run ():
+    scheduler = SynthScheduler(logging.getLogger("test"), window_ms=200, max_batch=2, token_budget=1500)
+    # Slow batches, so that the later requests queue up behind the first one
+    model = StubModel(coalesced_delay=0.1)
+    texts = [f'line {i}' for i in range(7)]
+
+    results = run_concurrently(scheduler, model, texts, stagger=0.01)
+
+    for text in texts:
+        assert results[text] in [f'coalesced:{text}', f'infer:{text}']
+    batches = model.coalesced_calls + [[text] for text in model.infer_calls]
+    assert all([len(batch)<=2 for batch in batches])
+    assert sorted([text for batch in batches for text in batch])==texts
+    assert scheduler.pending=={}
+
+def test_batches_stay_within_the_token_budget ():
+    scheduler = SynthScheduler(logging.getLogger("test"), window_ms=200, max_batch=8, token_budget=15)
+    model = StubModel(coalesced_delay=0.05)
+    # 6 characters each: at most 2 fit in a batch
+    texts = [f'text {i}' for i in range(5)]
+
+    results = run_concurrently(scheduler, model, texts)
+
+    assert sorted(results.keys())==texts
+    for batch in model.coalesced_calls:
+        assert sum([len(text) for text in batch])<=15
+    assert sorted([text for batch in model.coalesced_calls for text in batch] + model.infer_calls)==texts
+
+def test_a_failed_batch_falls_back_to_each_request_on_its_own ():
+    scheduler = SynthScheduler(logging.getLogger("test"), window_ms=300, max_batch=8, token_budget=1500)
+    model = StubModel(fail_coalesced=True, fail_texts=["bad line"])
+    texts = ["line 0", "line 1", "bad line"]
+
+    results = run_concurrently(scheduler, model, texts)
+
+    assert len(model.coalesced_calls)==1
+    assert results["line 0"]=="infer:line 0"
+    assert results["line 1"]=="infer:line 1"
+    # Only the failing request's caller gets its error
+    assert isinstance(results["bad line"], ValueError)
+
+@pytest.mark.parametrize("overrides", [
+    {"editor_data": [[1.0, 2.0], None, None, None, None, None, None, None]},
+    {"editor_data": [None, [3, 4], None, None, None, None, None, None]},
+    {"editor_data": [None, None, None, None, None, None, None, {"style": {"embedding": [0.0], "sliders": [0.5]}}]},
+    {"old_sequence": "the old line"},
+    {"base_emb": [0.0, 1.0]},
+    {"long_form": {"max_chars": 200}},
+])
+def test_can_coalesce_rejects_requests_needing_the_single_line_path (overrides):
+    scheduler = SynthScheduler(logging.getLogger("test"))
+    assert scheduler.can_coalesce(StubModel(), None, make_kwargs("line"))
+    assert not scheduler.can_coalesce(StubModel(), None, make_kwargs("line", **overrides))
+
+def test_can_coalesce_rejects_mid_synth_line_plugins_models_without_batching_and_no_window ():
+    scheduler = SynthScheduler(logging.getLogger("test"))
+    assert scheduler.can_coalesce(StubModel(), StubPluginManager(), make_kwargs("line"))
+    assert not scheduler.can_coalesce(StubModel(), StubPluginManager(mid_plugins=["plugin"]), make_kwargs("line"))
+    assert not scheduler.can_coalesce(object(), None, make_kwargs("line"))
+    assert not SynthScheduler(logging.getLogger("test"), window_ms=0).can_coalesce(StubModel(), None, make_kwargs("line"))
+
+def test_uncoalescable_requests_go_straight_through_infer ():
+    scheduler = SynthScheduler(logging.getLogger("test"), window_ms=300)
+    model = StubModel()
+    response = scheduler.infer(("xvapitch", 0), model, None, make_kwargs("line", old_sequence="old"))
+    assert response=="infer:line"
+    assert model.coalesced_calls==[]
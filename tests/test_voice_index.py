@@ -0,0 +1,59 @@
+import os
+import json
+import logging
+
+from python.voice_index import VoiceIndex
+
+
+def write_voice (dir_path, voice_id, voice_name, mtime=None):
+    json_path = f'{dir_path}/{voice_id}.json'
+    with open(json_path, "w") as f:
+        json.dump({"modelType": "xVAPitch", "author": "", "games": [{"voiceId": voice_id, "voiceName": voice_name, "gender": "female"}]}, f)
+    if mtime is not None:
+        os.utime(json_path, (mtime, mtime))
+    return json_path
+
+def voice_names (voice_index, dir_path):
+    return [voice["voiceName"] for voice in voice_index.get_voices({"game": str(dir_path)})["game"]]
+
+
+def test_voices_are_indexed_and_sorted_by_file (tmp_path):
+    write_voice(tmp_path, "b_voice", "B")
+    write_voice(tmp_path, "a_voice", "A")
+    (tmp_path / "a_voice.pt").write_bytes(b"")
+    assert voice_names(VoiceIndex(logging.getLogger("test")), tmp_path)==["A", "B"]
+
+def test_a_json_edited_in_place_is_parsed_again (tmp_path):
+    write_voice(tmp_path, "voice", "Old name", mtime=1000)
+    voice_index = VoiceIndex(logging.getLogger("test"))
+    assert voice_names(voice_index, tmp_path)==["Old name"]
+
+    # Same file, new contents: the directory's mtime doesn't change
+    dir_mtime = os.stat(tmp_path).st_mtime
+    write_voice(tmp_path, "voice", "New name", mtime=2000)
+    os.utime(tmp_path, (dir_mtime, dir_mtime))
+    assert voice_names(voice_index, tmp_path)==["New name"]
+
+def test_unchanged_jsons_are_not_parsed_again (tmp_path):
+    write_voice(tmp_path, "voice", "Name", mtime=1000)
+    voice_index = VoiceIndex(logging.getLogger("test"))
+    voice_names(voice_index, tmp_path)
+
+    parsed = []
+    read_voice_json = voice_index._read_voice_json
+    voice_index._read_voice_json = lambda json_path: parsed.append(json_path) or read_voice_json(json_path)
+    assert voice_names(voice_index, tmp_path)==["Name"]
+    assert parsed==[]
+
+def test_added_and_removed_voices_are_picked_up (tmp_path):
+    first_path = write_voice(tmp_path, "first", "First", mtime=1000)
+    voice_index = VoiceIndex(logging.getLogger("test"))
+    assert voice_names(voice_index, tmp_path)==["First"]
+
+    write_voice(tmp_path, "second", "Second", mtime=1000)
+    os.remove(first_path)
+    os.utime(tmp_path, (5000, 5000))
+    assert voice_names(voice_index, tmp_path)==["Second"]
+
+def test_a_missing_directory_has_no_voices (tmp_path):
+    assert voice_names(VoiceIndex(logging.getLogger("test")), tmp_path / "missing")==[]